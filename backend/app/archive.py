@@ -0,0 +1,114 @@
+# app/archive.py
+# 冷聊天归档。长期不活跃的聊天把全部消息压缩成一行写入 chat_archives 并从 messages 删除，
+# 让热数据的分区和索引保持小；之后读取或继续该聊天时再原样恢复到 messages。
+# 归档由定时任务执行：python -m app.archive (例如每天一次的 cron)，多个实例同时执行也是安全的。
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import time
+import uuid
+import zlib
+from typing import List
+from sqlalchemy import delete, func, insert, select, update
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from dotenv import load_dotenv
+from . import metrics, models
+from .database import async_engine, recent_writes
+
+load_dotenv()
+
+ARCHIVE_IDLE_DAYS = float(os.getenv("ARCHIVE_IDLE_DAYS", "90"))     # 最后一条消息距今超过这么多天的聊天会被归档
+ARCHIVE_BATCH_SIZE = int(os.getenv("ARCHIVE_BATCH_SIZE", "100"))    # 每次执行最多归档多少个聊天
+REHYDRATE_INSERT_CHUNK = 1000 # 恢复时每条 INSERT 的行数，避免超过单条语句的参数个数上限
+
+chat_rehydrate_seconds = metrics.Histogram("chat_rehydrate_seconds", "Duration of restoring archived chats on read.")
+
+_COLUMNS = ("id", "sender_type", "content", "timestamp", "order_in_chat")
+
+def _compress(rows) -> bytes:
+    data = [[str(r.id), r.sender_type, r.content, r.timestamp.isoformat(), r.order_in_chat] for r in rows]
+    return zlib.compress(json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode(), 6)
+
+def _decompress(chat_id: uuid.UUID, payload: bytes) -> List[dict]:
+    rows = []
+    for message_id, sender_type, content, timestamp, order_in_chat in json.loads(zlib.decompress(payload)):
+        rows.append({
+            "id": uuid.UUID(message_id), "chat_id": chat_id, "sender_type": sender_type, "content": content,
+            "timestamp": datetime.datetime.fromisoformat(timestamp), "order_in_chat": order_in_chat,
+        })
+    return rows
+
+async def archive_chat(chat_id: uuid.UUID, cutoff: datetime.datetime) -> bool:
+    """在一个事务中归档一个聊天；聊天在此期间又有了新消息或正被其他事务锁定时跳过并返回 False。"""
+    async with async_engine.begin() as conn:
+        # 与发送消息时预留序号的 UPDATE 争用同一行锁，归档和新消息不会交错
+        locked = await conn.scalar(
+            select(models.Chat.id)
+            .where(models.Chat.id == chat_id, models.Chat.archived_at.is_(None), models.Chat.last_message_at < cutoff)
+            .with_for_update(skip_locked=True)
+        )
+        if locked is None:
+            return False
+        result = await conn.execute(
+            delete(models.Message)
+            .where(models.Message.chat_id == chat_id)
+            .returning(*(getattr(models.Message, column) for column in _COLUMNS))
+        )
+        rows = sorted(result.all(), key=lambda r: r.order_in_chat)
+        await conn.execute(insert(models.ChatArchive).values(chat_id=chat_id, message_count=len(rows), payload=_compress(rows)))
+        await conn.execute(update(models.Chat).where(models.Chat.id == chat_id).values(archived_at=func.now()))
+        return True
+
+async def archive_idle_chats(idle_days: float = ARCHIVE_IDLE_DAYS, batch_size: int = ARCHIVE_BATCH_SIZE) -> int:
+    """归档最多 batch_size 个不活跃的聊天 (由 ix_chats_last_message_at_unarchived 支撑)，返回归档的聊天数。"""
+    cutoff = datetime.datetime.now(datetime.timezone.utc) - datetime.timedelta(days=idle_days)
+    async with async_engine.connect() as conn:
+        result = await conn.execute(
+            select(models.Chat.id)
+            .where(models.Chat.archived_at.is_(None), models.Chat.last_message_at < cutoff)
+            .order_by(models.Chat.last_message_at)
+            .limit(batch_size)
+        )
+        chat_ids = result.scalars().all()
+    archived = 0
+    for chat_id in chat_ids:
+        archived += await archive_chat(chat_id, cutoff)
+    return archived
+
+async def rehydrate(chat_id: uuid.UUID) -> int:
+    """把归档的消息恢复到 messages 并清除归档标记，返回恢复的消息数；并发恢复同一聊天时只有一个会真正执行。"""
+    start = time.perf_counter()
+    async with async_engine.begin() as conn:
+        # DELETE ... RETURNING 同时锁住归档行，后到的事务等待后拿不到数据
+        payload = await conn.scalar(
+            delete(models.ChatArchive).where(models.ChatArchive.chat_id == chat_id).returning(models.ChatArchive.payload)
+        )
+        rows = _decompress(chat_id, payload) if payload is not None else []
+        for i in range(0, len(rows), REHYDRATE_INSERT_CHUNK):
+            await conn.execute(pg_insert(models.Message).values(rows[i:i + REHYDRATE_INSERT_CHUNK]).on_conflict_do_nothing())
+        await conn.execute(update(models.Chat).where(models.Chat.id == chat_id).values(archived_at=None))
+    recent_writes.mark(chat_id)
+    chat_rehydrate_seconds.observe(time.perf_counter() - start)
+    return len(rows)
+
+async def _main():
+    parser = argparse.ArgumentParser(description="Archive chats that have been idle for a long time.")
+    parser.add_argument("--idle-days", type=float, default=ARCHIVE_IDLE_DAYS)
+    parser.add_argument("--batch-size", type=int, default=ARCHIVE_BATCH_SIZE)
+    args = parser.parse_args()
+    try:
+        total = 0
+        # 一批一批地归档，直到没有符合条件的聊天
+        while True:
+            archived = await archive_idle_chats(args.idle_days, args.batch_size)
+            total += archived
+            if archived < args.batch_size:
+                break
+    finally:
+        await async_engine.dispose()
+    print(f"Archived {total} chats idle for more than {args.idle_days:g} days")
+
+if __name__ == "__main__":
+    asyncio.run(_main())
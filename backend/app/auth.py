@@ -1,22 +1,25 @@
 # app/auth.py
 import os
+import time
+from collections import OrderedDict
+from dataclasses import dataclass
 from datetime import datetime, timedelta, timezone
-from typing import Optional
-from passlib.context import CryptContext
+from typing import Dict, Optional, Set, Tuple
 from jose import JWTError, jwt
-from fastapi import Depends, HTTPException, status
+from fastapi import Depends, HTTPException, Request, status
 from fastapi.security import OAuth2PasswordBearer, HTTPBearer
 from fastapi.security.http import HTTPAuthorizationCredentials # 导入这个
-from sqlalchemy.orm import Session
-from . import models, schemas
-from .database import get_db
+from sqlalchemy import select
+from sqlalchemy.ext.asyncio import AsyncSession
+from . import metrics, models, schemas, passwords
+from .database import get_async_db
 from dotenv import load_dotenv
 import uuid # 导入 uuid
 
 load_dotenv()
 
 # --- 密码哈希和验证 ---
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+pwd_context = passwords.pwd_context
 
 def verify_password(plain_password, hashed_password):
     return pwd_context.verify(plain_password, hashed_password)
@@ -24,6 +27,31 @@ def verify_password(plain_password, hashed_password):
 def get_password_hash(password):
     return pwd_context.hash(password)
 
+def _password_pool_busy():
+    return HTTPException(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        detail="Server is busy, please retry shortly",
+        headers={"Retry-After": str(passwords.PASSWORD_RETRY_AFTER)},
+    )
+
+# bcrypt 是 CPU 密集型操作，在 async 路由中交给专用进程池执行；进程池满时返回 503
+async def verify_and_update_password_async(plain_password, hashed_password):
+    """返回 (是否匹配, 新哈希或 None)；哈希参数过时时由调用方保存新哈希。"""
+    try:
+        return await passwords.verify_and_update(plain_password, hashed_password)
+    except passwords.PasswordPoolSaturated:
+        raise _password_pool_busy()
+
+async def verify_password_async(plain_password, hashed_password):
+    valid, _ = await verify_and_update_password_async(plain_password, hashed_password)
+    return valid
+
+async def get_password_hash_async(password):
+    try:
+        return await passwords.hash_password(password)
+    except passwords.PasswordPoolSaturated:
+        raise _password_pool_busy()
+
 # --- JWT 相关的配置 ---
 SECRET_KEY = os.getenv("SECRET_KEY", "your-super-secret-key") # 从 .env 获取，或使用默认值
 ALGORITHM = "HS256"
@@ -42,32 +70,140 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
-def get_user_by_username(db: Session, username: str):
-    return db.query(models.User).filter(models.User.username == username).first()
+async def get_user_by_username(db: AsyncSession, username: str):
+    result = await db.execute(select(models.User).where(models.User.username == username))
+    return result.scalars().first()
+
+async def get_user_by_email(db: AsyncSession, email: str):
+    result = await db.execute(select(models.User).where(models.User.email == email))
+    return result.scalars().first()
+
+# --- 已认证用户 (principal) 缓存 ---
+# 缓存条目数上限和存活时间；多 worker 部署时，其他 worker 上的用户变更最迟在 TTL 后生效
+PRINCIPAL_CACHE_SIZE = int(os.getenv("PRINCIPAL_CACHE_SIZE", "10000"))
+PRINCIPAL_CACHE_TTL = float(os.getenv("PRINCIPAL_CACHE_TTL", "60"))
+
+@dataclass(frozen=True)
+class Principal:
+    """轻量的已认证用户，只包含路由常用的字段，不需要加载 ORM User。"""
+    id: uuid.UUID
+    username: str
+
+class PrincipalCache:
+    """以 token 为键的有界 LRU + TTL 缓存，条目不会比 token 本身的 exp 活得更久。"""
+
+    def __init__(self, maxsize: int = PRINCIPAL_CACHE_SIZE, ttl: float = PRINCIPAL_CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries: "OrderedDict[str, Tuple[Principal, float]]" = OrderedDict()
+        self._tokens_by_user: Dict[uuid.UUID, Set[str]] = {}
+
+    def get(self, token: str) -> Optional[Principal]:
+        entry = self._entries.get(token)
+        if entry is None:
+            return None
+        principal, expires_at = entry
+        if expires_at <= time.time():
+            self._remove(token)
+            return None
+        self._entries.move_to_end(token)
+        return principal
+
+    def put(self, token: str, principal: Principal, token_exp: float):
+        if self.maxsize <= 0:
+            return
+        self._remove(token)
+        self._entries[token] = (principal, min(token_exp, time.time() + self.ttl))
+        self._tokens_by_user.setdefault(principal.id, set()).add(token)
+        while len(self._entries) > self.maxsize:
+            self._remove(next(iter(self._entries)))
 
-def get_user_by_email(db: Session, email: str):
-    return db.query(models.User).filter(models.User.email == email).first()
+    def invalidate_user(self, user_id: uuid.UUID):
+        for token in list(self._tokens_by_user.get(user_id, ())):
+            self._remove(token)
+
+    def clear(self):
+        self._entries.clear()
+        self._tokens_by_user.clear()
+
+    def _remove(self, token: str):
+        entry = self._entries.pop(token, None)
+        if entry is None:
+            return
+        tokens = self._tokens_by_user.get(entry[0].id)
+        if tokens is not None:
+            tokens.discard(token)
+            if not tokens:
+                del self._tokens_by_user[entry[0].id]
+
+principal_cache = PrincipalCache()
+
+def invalidate_user(user_id: uuid.UUID):
+    """修改或删除用户的代码在提交后调用，丢弃该用户所有已缓存的 token，本进程的下一个请求重新读取用户。
+
+    其他 worker 进程上的缓存最迟在 PRINCIPAL_CACHE_TTL 秒后过期。
+    """
+    principal_cache.invalidate_user(user_id)
+
+auth_phase_seconds = metrics.Histogram("auth_phase_seconds", "Time spent authenticating a request, by phase.", ("route", "phase"))
+
+def route_label(request: Request) -> str:
+    """返回请求匹配到的路由模板 (例如 /chats/{chat_id}/message)，用作指标标签。"""
+    route = request.scope.get("route")
+    return getattr(route, "path", "unmatched")
+
+async def authenticate_token(token: str, db: AsyncSession, route: str) -> Principal:
+    """校验 JWT 并返回 Principal，失败时抛出 401；HTTP 依赖和 WebSocket 共用。"""
+    with auth_phase_seconds.time(route=route, phase="cache_lookup"):
+        principal = principal_cache.get(token)
+    if principal is not None:
+        return principal
 
-async def get_current_user(credentials: HTTPAuthorizationCredentials = Depends(oauth2_scheme), db: Session = Depends(get_db)):
-    token = credentials.credentials # 从 credentials 中提取 token 字符串
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail="Could not validate credentials",
         headers={"WWW-Authenticate": "Bearer"},
     )
     try:
-        payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
+        with auth_phase_seconds.time(route=route, phase="jwt_decode"):
+            payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
         username: str = payload.get("username")
         user_id: str = payload.get("user_id")
         if username is None or user_id is None:
             raise credentials_exception
         token_data = schemas.TokenData(username=username, user_id=uuid.UUID(user_id))
-    except JWTError:
+    except (JWTError, ValueError):
         raise credentials_exception
-    user = db.query(models.User).filter(models.User.id == token_data.user_id).first()
-    if user is None:
+    # 只确认用户仍然存在，不加载完整的 ORM 对象
+    with auth_phase_seconds.time(route=route, phase="principal_load"):
+        result = await db.execute(select(models.User.id, models.User.username).where(models.User.id == token_data.user_id))
+        row = result.first()
+    if row is None:
         raise credentials_exception
+    principal = Principal(id=row.id, username=row.username)
+    principal_cache.put(token, principal, float(payload.get("exp", time.time() + PRINCIPAL_CACHE_TTL)))
+    return principal
+
+def token_expires_at(token: str) -> Optional[float]:
+    """返回已校验过的 token 的过期时间戳 (没有 exp 时为 None)，供长连接判断何时需要重新认证。"""
+    exp = jwt.get_unverified_claims(token).get("exp")
+    return float(exp) if exp is not None else None
+
+async def get_current_principal(request: Request, credentials: HTTPAuthorizationCredentials = Depends(oauth2_scheme), db: AsyncSession = Depends(get_async_db)) -> Principal:
+    return await authenticate_token(credentials.credentials, db, route_label(request))
+
+async def get_current_user(request: Request, principal: Principal = Depends(get_current_principal), db: AsyncSession = Depends(get_async_db)):
+    """需要完整 ORM User 的路由 (例如 /users/me/) 使用；只需要 user_id 的路由请用 get_current_principal。"""
+    with auth_phase_seconds.time(route=route_label(request), phase="user_load"):
+        user = await db.get(models.User, principal.id)
+    if user is None:
+        principal_cache.invalidate_user(principal.id)
+        raise HTTPException(
+            status_code=status.HTTP_401_UNAUTHORIZED,
+            detail="Could not validate credentials",
+            headers={"WWW-Authenticate": "Bearer"},
+        )
     return user
 
 async def get_current_active_user(current_user: models.User = Depends(get_current_user)):
-    return current_user
\ No newline at end of file
+    return current_user
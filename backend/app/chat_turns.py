@@ -0,0 +1,159 @@
+# app/chat_turns.py
+# 按聊天串行化对话轮次。同一聊天并发发送的消息如果同时读取历史，后一轮看到的是前一轮只有用户消息、还没有 AI 回复的历史；
+# 这里让每一轮从预留序号到保存 AI 回复期间持有该聊天的租约 (chats.turn_token / turn_expires_at)，后到的一轮等前一轮结束后再开始。
+# 每一轮在进入 LLM 网关排队之前用 acquire 获取租约，预留序号的 UPDATE 只校验租约仍属于本轮并续期 (held_condition)；
+# 异步回复任务 (reply_jobs) 入队时不获取租约，只等同步的一轮结束 (enqueue_condition)，任务执行时以任务 id 为令牌获取租约；
+# 同步的一轮还要等该聊天已入队的任务都执行完 (jobs_done_condition)，回复顺序与消息的顺序一致。
+# 数据库是唯一的锁，进程内只用事件在释放时立即唤醒本进程的等待者，
+# 其他进程的等待者按 CHAT_TURN_POLL_INTERVAL 轮询。执行者异常退出时租约在 CHAT_TURN_LEASE_SECONDS 后失效。
+import asyncio
+import datetime
+import os
+import time
+import uuid
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Awaitable, Dict, Optional, TypeVar
+from sqlalchemy import exists, func, or_, select, update
+from sqlalchemy.engine import Row
+from dotenv import load_dotenv
+from . import metrics, models
+from .database import autocommit_engine
+
+load_dotenv()
+
+CHAT_TURN_LEASE_SECONDS = float(os.getenv("CHAT_TURN_LEASE_SECONDS", "300"))     # 应大于一轮对话 (含 LLM 调用) 的最长耗时
+CHAT_TURN_WAIT_TIMEOUT = float(os.getenv("CHAT_TURN_WAIT_TIMEOUT", "120"))       # 等待同一聊天上一轮结束的最长时间，超时返回 409
+CHAT_TURN_POLL_INTERVAL = float(os.getenv("CHAT_TURN_POLL_INTERVAL", "0.2"))     # 上一轮在其他进程中时多久重试一次
+
+chat_turn_wait_seconds = metrics.Histogram("chat_turn_wait_seconds", "Time a chat turn waited for the previous turn in the same chat to finish.")
+
+T = TypeVar("T")
+
+async def run_to_completion(aw: Awaitable[T]) -> T:
+    """在单独的任务中执行 aw 并等待它完成；期间的取消 (包括多次 task.cancel()) 推迟到完成之后再抛出。
+
+    用于释放租约之前必须完成的写入。anyio 的 CancelScope(shield=True) 挡不住直接对 asyncio 任务调用的 cancel()，
+    WebSocket 收尾时回复任务可能被取消两次，第二次会打断正在进行的保存。
+    """
+    task = asyncio.ensure_future(aw)
+    cancelled = False
+    while not task.done():
+        try:
+            await asyncio.shield(task)
+        except asyncio.CancelledError:
+            if task.done():
+                break
+            cancelled = True
+    if cancelled:
+        raise asyncio.CancelledError()
+    return task.result()
+
+class TurnBusy(Exception):
+    """在 CHAT_TURN_WAIT_TIMEOUT 内没有等到同一聊天的上一轮结束。"""
+
+def lease_condition(token: uuid.UUID):
+    """获取租约的 UPDATE 附加的条件：聊天没有进行中的轮次 (或其租约已过期)，或者租约已经属于本轮。"""
+    return or_(models.Chat.turn_token == token, models.Chat.turn_expires_at.is_(None), models.Chat.turn_expires_at < func.now())
+
+def jobs_done_condition():
+    """同步的轮次获取租约时附加的条件：该聊天没有排队中或执行中的回复任务，先入队的消息先得到回复。"""
+    return ~exists().where(models.ReplyJob.chat_id == models.Chat.id, models.ReplyJob.status.in_(("queued", "running")))
+
+def enqueue_condition():
+    """入队的消息预留序号时附加的条件 (不获取租约)：聊天空闲，或者租约由该聊天的回复任务持有。
+
+    回复任务的租约令牌就是任务 id；任务按序号依次执行，入队不需要等正在执行的任务结束，只需要等同步的一轮结束。
+    """
+    return or_(
+        models.Chat.turn_expires_at.is_(None),
+        models.Chat.turn_expires_at < func.now(),
+        exists().where(models.ReplyJob.id == models.Chat.turn_token, models.ReplyJob.chat_id == models.Chat.id),
+    )
+
+def held_condition(token: uuid.UUID):
+    """本轮已经用 acquire 持有租约时附加的条件：租约仍属于本轮 (没有过期后被其他轮次获取)。"""
+    return models.Chat.turn_token == token
+
+def lease_values(token: uuid.UUID) -> Dict:
+    return {"turn_token": token, "turn_expires_at": func.now() + datetime.timedelta(seconds=CHAT_TURN_LEASE_SECONDS)}
+
+class ChatTurns:
+    def __init__(self):
+        self._released: Dict[uuid.UUID, asyncio.Event] = {}
+
+    async def wait(self, chat_id: uuid.UUID, timeout: float):
+        """等待本进程释放该聊天的租约，最多 timeout 秒 (租约在其他进程时只能等到超时再重试)。"""
+        event = self._released.setdefault(chat_id, asyncio.Event())
+        try:
+            await asyncio.wait_for(event.wait(), timeout=timeout)
+        except asyncio.TimeoutError:
+            pass
+
+    async def run_with_lease(self, chat_id: uuid.UUID, user_id: uuid.UUID, stmt, timeout: float = CHAT_TURN_WAIT_TIMEOUT) -> Optional[Row]:
+        """执行带 lease_condition 的 UPDATE ... RETURNING，返回第一行；聊天被其他轮次占用时等待后重试。
+
+        聊天不存在或不属于该用户时返回 None，等待超过 timeout 秒抛出 TurnBusy (timeout 为 0 时只尝试一次)。
+        """
+        start = time.monotonic()
+        waited = False
+        while True:
+            async with autocommit_engine.connect() as conn:
+                row = (await conn.execute(stmt)).first()
+                if row is None:
+                    # 只有拿不到租约时才多查一次，区分聊天不存在和正被占用
+                    owned = await conn.scalar(select(models.Chat.id).where(models.Chat.id == chat_id, models.Chat.user_id == user_id))
+            if row is not None:
+                if waited:
+                    chat_turn_wait_seconds.observe(time.monotonic() - start)
+                return row
+            if owned is None:
+                return None
+            remaining = start + timeout - time.monotonic()
+            if remaining <= 0:
+                raise TurnBusy()
+            waited = True
+            await self.wait(chat_id, min(remaining, CHAT_TURN_POLL_INTERVAL))
+
+    async def acquire(self, chat_id: uuid.UUID, user_id: uuid.UUID, token: uuid.UUID, timeout: float = CHAT_TURN_WAIT_TIMEOUT, after_jobs: bool = True) -> bool:
+        """单独获取租约 (不预留序号)，聊天不存在时返回 False。
+
+        after_jobs 为 True 时还要等该聊天排队中的回复任务都执行完；回复任务自己获取租约时传 False。
+        """
+        conditions = [models.Chat.id == chat_id, models.Chat.user_id == user_id, lease_condition(token)]
+        if after_jobs:
+            conditions.append(jobs_done_condition())
+        stmt = (
+            update(models.Chat)
+            .where(*conditions)
+            .values(**lease_values(token))
+            .returning(models.Chat.id)
+        )
+        return await self.run_with_lease(chat_id, user_id, stmt, timeout) is not None
+
+    async def release(self, chat_id: uuid.UUID, token: uuid.UUID):
+        """释放租约；租约已过期并被其他轮次获取时不会影响对方。客户端断开导致的取消不会打断释放。"""
+        try:
+            await run_to_completion(self._clear(chat_id, token))
+        finally:
+            event = self._released.pop(chat_id, None)
+            if event is not None:
+                event.set()
+
+    async def _clear(self, chat_id: uuid.UUID, token: uuid.UUID):
+        async with autocommit_engine.connect() as conn:
+            await conn.execute(
+                update(models.Chat)
+                .where(models.Chat.id == chat_id, models.Chat.turn_token == token)
+                .values(turn_token=None, turn_expires_at=None)
+            )
+
+    @asynccontextmanager
+    async def hold(self, chat_id: uuid.UUID, token: Optional[uuid.UUID] = None) -> AsyncIterator[uuid.UUID]:
+        """生成本轮的租约令牌 (由 acquire 获取租约；回复任务传入任务 id)，退出时 (包括被取消) 释放。"""
+        token = token or uuid.uuid4()
+        try:
+            yield token
+        finally:
+            await self.release(chat_id, token)
+
+turns = ChatTurns()
@@ -1,9 +1,16 @@
 # app/database.py
 import os
-from sqlalchemy import create_engine
+import time
+from contextvars import ContextVar
+from typing import Dict, List, Optional
+from sqlalchemy import create_engine, event, exc
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker, AsyncSession
+from sqlalchemy.pool import AsyncAdaptedQueuePool
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.orm import sessionmaker, Session # 导入 Session
 from dotenv import load_dotenv
+from . import metrics
 
 # 加载环境变量
 load_dotenv()
@@ -11,13 +18,159 @@ load_dotenv()
 # 从环境变量获取数据库URL
 DATABASE_URL = os.getenv("DATABASE_URL")
 
+def _async_url(url: str) -> str:
+    # 异步驱动使用的 URL，例如 postgresql://... -> postgresql+asyncpg://...
+    return make_url(url).set(drivername="postgresql+asyncpg").render_as_string(hide_password=False)
+
+# 也可以通过 ASYNC_DATABASE_URL 单独指定
+ASYNC_DATABASE_URL = os.getenv("ASYNC_DATABASE_URL") or _async_url(DATABASE_URL)
+# 可选的只读副本；不设置时所有读取都走主库
+DATABASE_REPLICA_URL = os.getenv("DATABASE_REPLICA_URL")
+
+# 连接池 (每个引擎、每个 worker 进程各一个)
+DB_POOL_SIZE = int(os.getenv("DB_POOL_SIZE", "5"))
+DB_MAX_OVERFLOW = int(os.getenv("DB_MAX_OVERFLOW", "10"))
+DB_POOL_TIMEOUT = float(os.getenv("DB_POOL_TIMEOUT", "30"))   # 连接池耗尽时最多等待多久 (秒)
+DB_POOL_RECYCLE = int(os.getenv("DB_POOL_RECYCLE", "-1"))     # 连接使用超过这么多秒后重建，-1 表示不限制
+DB_POOL_PRE_PING = os.getenv("DB_POOL_PRE_PING", "false").lower() in ("1", "true", "yes")
+# 单条语句的超时 (毫秒)，0 表示不限制；迁移会在自己的事务里取消这个限制
+DB_STATEMENT_TIMEOUT_MS = int(os.getenv("DB_STATEMENT_TIMEOUT_MS", "0"))
+# 写入后这么多秒内，同一用户/聊天的读取走主库，避免副本复制延迟导致读不到刚写入的数据
+DB_READ_YOUR_WRITES_SECONDS = float(os.getenv("DB_READ_YOUR_WRITES_SECONDS", "5"))
+
+db_pool_checkout_seconds = metrics.Histogram(
+    "db_pool_checkout_seconds", "Time spent waiting for a pooled connection (including opening new ones), by engine.", ("engine",),
+    buckets=(0.0001, 0.0005, 0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0),
+)
+db_pool_timeouts_total = metrics.Counter("db_pool_timeouts_total", "Pool checkouts that timed out, by engine.", ("engine",))
+db_pool_connections_in_use = metrics.Gauge("db_pool_connections_in_use", "Connections checked out of the pool, by engine.", ("engine",))
+
+def _timed_pool(label: str):
+    class TimedPool(AsyncAdaptedQueuePool):
+        # 异步引擎在 greenlet 中同步地等待连接，这里的耗时就是请求实际等待连接池的时间
+        def _do_get(self):
+            start = time.perf_counter()
+            try:
+                return super()._do_get()
+            except exc.TimeoutError:
+                db_pool_timeouts_total.inc(engine=label)
+                raise
+            finally:
+                db_pool_checkout_seconds.observe(time.perf_counter() - start, engine=label)
+    return TimedPool
+
+_POOL_OPTIONS = dict(
+    pool_size=DB_POOL_SIZE, max_overflow=DB_MAX_OVERFLOW, pool_timeout=DB_POOL_TIMEOUT,
+    pool_recycle=DB_POOL_RECYCLE, pool_pre_ping=DB_POOL_PRE_PING,
+)
+
+def _create_async_engine(url: str, label: str):
+    connect_args = {}
+    if DB_STATEMENT_TIMEOUT_MS > 0:
+        connect_args["server_settings"] = {"statement_timeout": str(DB_STATEMENT_TIMEOUT_MS)}
+    return create_async_engine(url, poolclass=_timed_pool(label), connect_args=connect_args, **_POOL_OPTIONS)
+
 # 创建 SQLAlchemy 引擎
-engine = create_engine(DATABASE_URL)
+engine = create_engine(
+    DATABASE_URL,
+    connect_args={"options": f"-c statement_timeout={DB_STATEMENT_TIMEOUT_MS}"} if DB_STATEMENT_TIMEOUT_MS > 0 else {},
+    **_POOL_OPTIONS,
+)
+
+# 异步引擎，供 async def 路由使用，避免阻塞事件循环
+async_engine = _create_async_engine(ASYNC_DATABASE_URL, "primary")
+
+# 只读副本的引擎；没有配置副本时就是主库引擎本身
+replica_engine = _create_async_engine(_async_url(DATABASE_REPLICA_URL), "replica") if DATABASE_REPLICA_URL else async_engine
+
+# 与 async_engine 共用连接池的自动提交视图：单条写语句不需要 BEGIN/COMMIT，只有一次往返
+autocommit_engine = async_engine.execution_options(isolation_level="AUTOCOMMIT")
+
+# 按请求统计执行的 SQL 语句数 (用于基准测试)；计数器由 main.py 的中间件在每个请求开始时设置
+_query_counter: ContextVar[Optional[List[int]]] = ContextVar("query_counter", default=None)
+
+def start_query_count() -> List[int]:
+    counter = [0]
+    _query_counter.set(counter)
+    return counter
+
+db_queries_total = metrics.Counter("db_queries_total", "SQL statements executed, by statement type.", ("operation",))
+db_query_duration_seconds = metrics.Histogram(
+    "db_query_duration_seconds", "SQL statement execution time, by statement type.", ("operation",),
+    buckets=(0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5),
+)
+
+_OPERATIONS = {"SELECT", "INSERT", "UPDATE", "DELETE", "BEGIN", "COMMIT", "ROLLBACK", "WITH"}
+
+def _operation(statement: str) -> str:
+    # 只取语句的第一个关键字作为标签，避免把 SQL 文本带进指标
+    keyword = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else ""
+    return keyword if keyword in _OPERATIONS else "OTHER"
+
+def _before_query(conn, cursor, statement, parameters, context, executemany):
+    counter = _query_counter.get()
+    if counter is not None:
+        counter[0] += 1
+    db_queries_total.inc(operation=_operation(statement))
+    if context is not None: # 方言初始化等内部语句没有执行上下文
+        context._query_started_at = time.perf_counter()
+
+def _after_query(conn, cursor, statement, parameters, context, executemany):
+    started_at = getattr(context, "_query_started_at", None)
+    if started_at is not None:
+        db_query_duration_seconds.observe(time.perf_counter() - started_at, operation=_operation(statement))
+
+def _instrument(target, label: str):
+    event.listen(target, "before_cursor_execute", _before_query)
+    event.listen(target, "after_cursor_execute", _after_query)
+    event.listen(target, "checkout", lambda *args: db_pool_connections_in_use.inc(engine=label))
+    event.listen(target, "checkin", lambda *args: db_pool_connections_in_use.dec(engine=label))
+
+_instrument(engine, "sync")
+_instrument(async_engine.sync_engine, "primary")
+if replica_engine is not async_engine:
+    _instrument(replica_engine.sync_engine, "replica")
 
 # 创建一个 SessionLocal 类
 # 每次数据库操作时，我们都会创建一个 SessionLocal 实例
 SessionLocal = sessionmaker(autocommit=False, autoflush=False, bind=engine)
 
+# 异步会话工厂；expire_on_commit=False 使提交后的对象仍可直接序列化，无需再次访问数据库
+AsyncSessionLocal = async_sessionmaker(bind=async_engine, autoflush=False, expire_on_commit=False)
+
+ReplicaSessionLocal = async_sessionmaker(bind=replica_engine, autoflush=False, expire_on_commit=False)
+
+class RecentWrites:
+    """记录最近写入过的用户/聊天 id，在 DB_READ_YOUR_WRITES_SECONDS 内这些 id 的读取改走主库。
+
+    只在当前进程内有效；多 worker 部署时，紧接着落到其他 worker 的读取仍可能读到复制延迟内的旧数据。
+    """
+
+    MAX_KEYS = 100_000
+
+    def __init__(self, window: float = DB_READ_YOUR_WRITES_SECONDS):
+        self.window = window
+        self._until: Dict[str, float] = {}
+
+    def mark(self, *keys):
+        now = time.monotonic()
+        if len(self._until) >= self.MAX_KEYS:
+            self._until = {key: until for key, until in self._until.items() if until > now}
+        for key in keys:
+            self._until[str(key)] = now + self.window
+
+    def is_recent(self, *keys) -> bool:
+        now = time.monotonic()
+        return any(self._until.get(str(key), 0) > now for key in keys)
+
+recent_writes = RecentWrites()
+
+def read_session(*keys) -> AsyncSession:
+    """只读查询使用的会话：配置了副本且这些用户/聊天最近没有写入时走副本，否则走主库。"""
+    if replica_engine is async_engine or recent_writes.is_recent(*keys):
+        return AsyncSessionLocal()
+    return ReplicaSessionLocal()
+
 # 创建一个 Base 类，ORM 模型将继承自它
 Base = declarative_base()
 
@@ -27,4 +180,9 @@ def get_db():
     try:
         yield db
     finally:
-        db.close()
\ No newline at end of file
+        db.close()
+
+# 依赖项，用于获取异步数据库会话
+async def get_async_db():
+    async with AsyncSessionLocal() as db:
+        yield db
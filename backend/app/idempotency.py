@@ -0,0 +1,147 @@
+# app/idempotency.py
+# Idempotency-Key 支持。客户端重试或重复点击时带同一个键再次提交，不会再触发一次 LLM 调用和一轮重复的对话：
+# 第一个请求执行期间，重复的请求等待它完成并得到同样的结果；完成后的结果保存 IDEMPOTENCY_TTL_SECONDS 秒。
+# 执行失败 (抛出异常) 的请求不保存结果，删除键，重试会重新执行。过期的键由 python -m app.idempotency 定期清理。
+import argparse
+import asyncio
+import datetime
+import hashlib
+import json
+import os
+import time
+import uuid
+from typing import Any, Dict, Optional, Tuple
+from sqlalchemy import delete, func, or_, select, tuple_, update
+from sqlalchemy.dialects.postgresql import insert as pg_insert
+from dotenv import load_dotenv
+from . import metrics, models
+from .database import async_engine, autocommit_engine
+
+load_dotenv()
+
+IDEMPOTENCY_TTL_SECONDS = float(os.getenv("IDEMPOTENCY_TTL_SECONDS", "86400"))        # 结果保存多久
+IDEMPOTENCY_LEASE_SECONDS = float(os.getenv("IDEMPOTENCY_LEASE_SECONDS", "300"))      # 执行中的请求的租约，执行者异常退出后重试的请求可以接管
+IDEMPOTENCY_WAIT_TIMEOUT = float(os.getenv("IDEMPOTENCY_WAIT_TIMEOUT", "120"))        # 重复的请求最多等待第一个请求多久，超时返回 409
+IDEMPOTENCY_POLL_INTERVAL = float(os.getenv("IDEMPOTENCY_POLL_INTERVAL", "0.25"))     # 第一个请求在其他进程执行时的轮询间隔
+IDEMPOTENCY_PURGE_BATCH = 1000
+MAX_KEY_LENGTH = 255
+
+idempotent_requests_total = metrics.Counter(
+    "idempotent_requests_total", "Requests carrying an Idempotency-Key, by outcome.", ("outcome",)
+)
+
+class KeyReused(Exception):
+    """同一个键被用于内容不同的请求。"""
+
+class InProgress(Exception):
+    """使用该键的第一个请求仍在执行，等待超时。"""
+
+def fingerprint(*parts: Any) -> str:
+    """请求的摘要 (路由、路径参数、请求体)，用于识别同一个键被用在了不同的请求上。"""
+    return hashlib.sha256(json.dumps(parts, sort_keys=True, default=str, ensure_ascii=False).encode()).hexdigest()
+
+_waiters: Dict[Tuple[uuid.UUID, str], asyncio.Event] = {}
+
+def _notify(user_id: uuid.UUID, key: str):
+    event = _waiters.pop((user_id, key), None)
+    if event is not None:
+        event.set()
+
+async def begin(user_id: uuid.UUID, key: str, request_hash: str) -> Tuple[Optional[uuid.UUID], Optional[dict]]:
+    """领取该键。返回 (owner, None) 表示由调用方执行请求并在结束时调用 complete / abandon；
+    返回 (None, response) 表示该请求已经执行过，response 是保存的结果。"""
+    table = models.IdempotencyKey
+    owner = uuid.uuid4()
+    values = {
+        "request_hash": request_hash,
+        "status": "pending",
+        "owner": owner,
+        "locked_until": func.now() + datetime.timedelta(seconds=IDEMPOTENCY_LEASE_SECONDS),
+        "created_at": func.now(),
+        "expires_at": func.now() + datetime.timedelta(seconds=IDEMPOTENCY_TTL_SECONDS),
+    }
+    insert_stmt = pg_insert(table).values(user_id=user_id, key=key, **values)
+    # 已过期的键，或执行者租约已过期的 pending 键，由本请求接管
+    claim = insert_stmt.on_conflict_do_update(
+        index_elements=[table.user_id, table.key],
+        set_=values,
+        where=or_(table.expires_at < func.now(), (table.status == "pending") & (table.locked_until < func.now())),
+    ).returning(table.owner)
+    deadline = time.monotonic() + IDEMPOTENCY_WAIT_TIMEOUT
+    waited = False
+    while True:
+        async with autocommit_engine.connect() as conn:
+            if await conn.scalar(claim) == owner:
+                idempotent_requests_total.inc(outcome="retried" if waited else "executed")
+                return owner, None
+            existing = (await conn.execute(
+                select(table.request_hash, table.status, table.response).where(table.user_id == user_id, table.key == key)
+            )).first()
+        if existing is None:
+            continue # 第一个请求失败后删除了键，重新领取
+        if existing.request_hash != request_hash:
+            idempotent_requests_total.inc(outcome="key_reused")
+            raise KeyReused()
+        if existing.status == "done":
+            idempotent_requests_total.inc(outcome="replayed")
+            return None, existing.response
+        remaining = deadline - time.monotonic()
+        if remaining <= 0:
+            idempotent_requests_total.inc(outcome="in_progress")
+            raise InProgress()
+        # 第一个请求仍在执行：在本进程时完成后立即唤醒，否则按轮询间隔重新查询
+        waited = True
+        event = _waiters.setdefault((user_id, key), asyncio.Event())
+        try:
+            await asyncio.wait_for(event.wait(), timeout=min(remaining, IDEMPOTENCY_POLL_INTERVAL))
+        except asyncio.TimeoutError:
+            pass
+
+async def complete(user_id: uuid.UUID, key: str, owner: uuid.UUID, response: dict):
+    """保存执行结果 (JSON)，之后使用该键的请求直接得到它。"""
+    try:
+        async with autocommit_engine.connect() as conn:
+            await conn.execute(
+                update(models.IdempotencyKey)
+                .where(models.IdempotencyKey.user_id == user_id, models.IdempotencyKey.key == key, models.IdempotencyKey.owner == owner)
+                .values(status="done", response=response)
+            )
+    finally:
+        _notify(user_id, key)
+
+async def abandon(user_id: uuid.UUID, key: str, owner: uuid.UUID):
+    """执行失败：删除键，等待中的重复请求会接管并重新执行。"""
+    try:
+        async with autocommit_engine.connect() as conn:
+            await conn.execute(
+                delete(models.IdempotencyKey)
+                .where(models.IdempotencyKey.user_id == user_id, models.IdempotencyKey.key == key, models.IdempotencyKey.owner == owner)
+            )
+    finally:
+        _notify(user_id, key)
+
+async def purge_expired(batch_size: int = IDEMPOTENCY_PURGE_BATCH) -> int:
+    """删除最多 batch_size 个过期的键 (由 ix_idempotency_keys_expires_at 支撑)，返回删除的行数。"""
+    table = models.IdempotencyKey
+    expired = select(table.user_id, table.key).where(table.expires_at < func.now()).limit(batch_size)
+    async with autocommit_engine.connect() as conn:
+        result = await conn.execute(delete(table).where(tuple_(table.user_id, table.key).in_(expired)))
+        return result.rowcount
+
+async def _main():
+    parser = argparse.ArgumentParser(description="Delete expired idempotency keys.")
+    parser.add_argument("--batch-size", type=int, default=IDEMPOTENCY_PURGE_BATCH)
+    args = parser.parse_args()
+    try:
+        total = 0
+        while True:
+            deleted = await purge_expired(args.batch_size)
+            total += deleted
+            if deleted < args.batch_size:
+                break
+    finally:
+        await async_engine.dispose()
+    print(f"Deleted {total} expired idempotency keys")
+
+if __name__ == "__main__":
+    asyncio.run(_main())
@@ -0,0 +1,165 @@
+# app/llm_cache.py
+# 开场几轮对话 (例如对同一角色的相同问候) 的 LLM 回复缓存，按角色开启。
+import asyncio
+import hashlib
+import json
+import os
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+from dotenv import load_dotenv
+from . import metrics
+
+load_dotenv()
+
+# 缓存条目上限 (0 表示关闭)、存活时间，以及只有历史不超过多少条时才使用缓存
+LLM_CACHE_MAX_ENTRIES = int(os.getenv("LLM_CACHE_MAX_ENTRIES", "2048"))
+LLM_CACHE_TTL = float(os.getenv("LLM_CACHE_TTL", "3600"))
+LLM_CACHE_MAX_CONTEXT_MESSAGES = int(os.getenv("LLM_CACHE_MAX_CONTEXT_MESSAGES", "2"))
+
+llm_cache_hits_total = metrics.Counter("llm_cache_hits_total", "LLM response cache hits.", ("role",))
+llm_cache_misses_total = metrics.Counter("llm_cache_misses_total", "LLM response cache misses that called upstream.", ("role",))
+llm_cache_coalesced_total = metrics.Counter("llm_cache_coalesced_total", "Requests that waited for an identical in-flight upstream call.", ("role",))
+
+def _normalize(text: str) -> str:
+    return " ".join(text.split()).casefold()
+
+def is_cacheable(chat_history: List[Dict[str, str]], summary: Optional[str]) -> bool:
+    """只缓存开场几轮：有摘要或历史较长时，相同的用户消息也不应得到相同的回复。"""
+    return LLM_CACHE_MAX_ENTRIES > 0 and not summary and len(chat_history) <= LLM_CACHE_MAX_CONTEXT_MESSAGES
+
+def make_key(
+    role_id,
+    role_version,
+    model: str,
+    temperature: float,
+    chat_history: List[Dict[str, str]],
+    user_message: str,
+) -> str:
+    """由角色 (含版本)、模型参数、规范化后的上下文和用户消息计算缓存键。"""
+    payload = {
+        "role": str(role_id),
+        "version": str(role_version),
+        "model": model,
+        "temperature": temperature,
+        "context": [[msg["sender_type"], _normalize(msg["content"])] for msg in chat_history],
+        "message": _normalize(user_message),
+    }
+    return hashlib.sha256(json.dumps(payload, ensure_ascii=False, sort_keys=True).encode()).hexdigest()
+
+class _LeaderCancelled(Exception):
+    """发起上游调用的请求被取消 (例如客户端断开)，等待者需要自己重试。"""
+
+class ResponseCache:
+    """有界 LRU + TTL 缓存，带 single-flight：相同键的并发请求只发起一次上游调用。"""
+
+    def __init__(self, maxsize: int = LLM_CACHE_MAX_ENTRIES, ttl: float = LLM_CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries: "OrderedDict[str, Tuple[str, float]]" = OrderedDict()
+        self._in_flight: Dict[str, asyncio.Future] = {}
+
+    def get(self, key: str) -> Optional[str]:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        value, expires_at = entry
+        if expires_at <= time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return value
+
+    def put(self, key: str, value: str):
+        if self.maxsize <= 0:
+            return
+        self._entries[key] = (value, time.monotonic() + self.ttl)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.maxsize:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        self._entries.clear()
+
+    async def join(self, key: str, label: str = "") -> Optional[str]:
+        """返回缓存值；相同键的上游调用正在进行时等待并共享它的结果或异常。
+
+        返回 None 表示需要由调用方发起上游调用：应立即 (中间不 await) 调用 lead 登记，之后相同键的请求会等待它。
+        """
+        while True:
+            value = self.get(key)
+            if value is not None:
+                llm_cache_hits_total.inc(role=label)
+                return value
+            leader = self._in_flight.get(key)
+            if leader is None:
+                return None
+            llm_cache_coalesced_total.inc(role=label)
+            try:
+                return await asyncio.shield(leader)
+            except _LeaderCancelled:
+                continue
+
+    def lead(self, key: str, label: str = "") -> "Flight":
+        """登记由调用方发起的上游调用，调用方结束时必须调用返回值的 finish 或 fail。"""
+        llm_cache_misses_total.inc(role=label)
+        future = asyncio.get_running_loop().create_future()
+        # 没有等待者时也标记异常已被读取，避免 "exception was never retrieved" 日志
+        future.add_done_callback(lambda f: f.exception())
+        self._in_flight[key] = future
+        return Flight(self, key, future)
+
+    async def get_or_compute(self, key: str, compute: Callable[[], Awaitable[str]], label: str = "") -> str:
+        """返回缓存值；未命中时调用 compute，同键的并发请求共享这一次调用的结果或异常。
+
+        异常不会被缓存。
+        """
+        value = await self.join(key, label)
+        if value is not None:
+            return value
+        flight = self.lead(key, label)
+        try:
+            value = await compute()
+        except BaseException as e:
+            flight.fail(e)
+            raise
+        flight.finish(value)
+        return value
+
+class Flight:
+    """一次进行中的上游调用 (见 ResponseCache.lead)，流式回复在流结束后才能给出结果。"""
+
+    def __init__(self, cache: ResponseCache, key: str, future: asyncio.Future):
+        self.cache = cache
+        self.key = key
+        self.future = future
+
+    def finish(self, value: str):
+        """写入缓存并把结果交给等待者。"""
+        if self.future.done():
+            return
+        self.cache.put(self.key, value)
+        self.future.set_result(value)
+        self._done()
+
+    def fail(self, error: BaseException):
+        """把异常交给等待者 (不缓存)；调用方被取消或提前退出时等同于 cancel。"""
+        if isinstance(error, (asyncio.CancelledError, GeneratorExit)):
+            self.cancel()
+        elif not self.future.done():
+            self.future.set_exception(error)
+            self._done()
+
+    def cancel(self):
+        """没有得到可缓存的结果，等待者改为自己发起上游调用；已经 finish 或 fail 时什么也不做。"""
+        if not self.future.done():
+            self.future.set_exception(_LeaderCancelled())
+            self._done()
+
+    def _done(self):
+        if self.cache._in_flight.get(self.key) is self.future:
+            del self.cache._in_flight[self.key]
+
+response_cache = ResponseCache()
+
+llm_cache_entries = metrics.Gauge("llm_cache_entries", "Entries currently held in the LLM response cache.", function=lambda: len(response_cache._entries))
@@ -0,0 +1,166 @@
+# app/llm_gateway.py
+# 所有上游 LLM 调用的入口：全局并发上限、按用户的令牌桶限流，以及按用户轮转的公平等待队列。
+import asyncio
+import os
+import time
+from collections import OrderedDict, deque
+from contextlib import asynccontextmanager
+from typing import Deque, Dict, Hashable
+from dotenv import load_dotenv
+from . import metrics
+
+load_dotenv()
+
+# 同时进行中的上游调用上限，以及排队等待的最长时间 (秒)
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "32"))
+LLM_MAX_QUEUE_TIME = float(os.getenv("LLM_MAX_QUEUE_TIME", "30"))
+# 每个用户每分钟可发起的对话轮数及突发容量，LLM_RATE_PER_MINUTE=0 表示不限流
+LLM_RATE_PER_MINUTE = float(os.getenv("LLM_RATE_PER_MINUTE", "20"))
+LLM_RATE_BURST = int(os.getenv("LLM_RATE_BURST", "5"))
+
+# 后台任务 (例如聊天摘要) 使用的队列键，不参与按用户限流
+BACKGROUND_KEY = "__background__"
+
+class RateLimited(Exception):
+    def __init__(self, retry_after: float):
+        super().__init__(f"Rate limit exceeded, retry after {retry_after:.1f}s")
+        self.retry_after = retry_after
+
+class QueueTimeout(Exception):
+    """在 LLM_MAX_QUEUE_TIME 内没有等到空闲的上游并发槽位。"""
+
+class TokenBucket:
+    def __init__(self, rate_per_second: float, capacity: int):
+        self.rate = rate_per_second
+        self.capacity = capacity
+        self.tokens = float(capacity)
+        self.updated_at = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+        self.updated_at = now
+
+    def take(self) -> bool:
+        self._refill()
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return True
+        return False
+
+    def retry_after(self) -> float:
+        return max(0.0, (1 - self.tokens) / self.rate)
+
+    def is_full(self) -> bool:
+        self._refill()
+        return self.tokens >= self.capacity
+
+llm_gateway_wait_seconds = metrics.Histogram("llm_gateway_wait_seconds", "Time spent waiting for an upstream LLM slot.")
+llm_gateway_rate_limited_total = metrics.Counter("llm_gateway_rate_limited_total", "Chat turns rejected by the per-user rate limit.")
+llm_gateway_queue_timeouts_total = metrics.Counter("llm_gateway_queue_timeouts_total", "Chat turns that gave up waiting for an upstream LLM slot.")
+
+class LLMGateway:
+    """上游并发槽位的分配器。
+
+    有空闲槽位且没有人排队时直接进入；否则按用户排队，释放槽位时在有等待者的用户之间轮转分配，
+    避免少数重度用户的突发请求排在所有人前面。
+    """
+
+    def __init__(
+        self,
+        max_concurrency: int = LLM_MAX_CONCURRENCY,
+        max_queue_time: float = LLM_MAX_QUEUE_TIME,
+        rate_per_minute: float = LLM_RATE_PER_MINUTE,
+        burst: int = LLM_RATE_BURST,
+    ):
+        self.max_concurrency = max_concurrency
+        self.max_queue_time = max_queue_time
+        self.rate_per_second = rate_per_minute / 60
+        self.burst = burst
+        self.in_flight = 0
+        self._queues: "OrderedDict[Hashable, Deque[asyncio.Future]]" = OrderedDict()
+        self._buckets: Dict[Hashable, TokenBucket] = {}
+
+    @property
+    def queue_depth(self) -> int:
+        return sum(len(waiters) for waiters in self._queues.values())
+
+    def check_rate(self, key: Hashable):
+        """消耗该用户的一个令牌，超出限额时抛出 RateLimited。应在产生任何副作用之前调用。"""
+        if self.rate_per_second <= 0:
+            return
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            if len(self._buckets) > 10000:
+                # 令牌已回满的用户与新用户等价，可以丢弃
+                self._buckets = {k: b for k, b in self._buckets.items() if not b.is_full()}
+            bucket = self._buckets[key] = TokenBucket(self.rate_per_second, self.burst)
+        if not bucket.take():
+            llm_gateway_rate_limited_total.inc()
+            raise RateLimited(bucket.retry_after())
+
+    async def acquire(self, key: Hashable):
+        start = time.monotonic()
+        if self.in_flight < self.max_concurrency and not self._queues:
+            self.in_flight += 1
+            llm_gateway_wait_seconds.observe(0.0)
+            return
+
+        waiter = asyncio.get_running_loop().create_future()
+        self._queues.setdefault(key, deque()).append(waiter)
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), timeout=self.max_queue_time)
+        except (asyncio.TimeoutError, asyncio.CancelledError) as e:
+            if waiter.done():
+                # 超时/取消的同时刚好分配到了槽位，把它交还给下一个等待者
+                self.release()
+            else:
+                waiter.cancel()
+                self._discard(key, waiter)
+            if isinstance(e, asyncio.TimeoutError):
+                llm_gateway_queue_timeouts_total.inc()
+                raise QueueTimeout() from None
+            raise
+        finally:
+            llm_gateway_wait_seconds.observe(time.monotonic() - start)
+
+    def release(self):
+        self.in_flight -= 1
+        self._dispatch()
+
+    @asynccontextmanager
+    async def slot(self, key: Hashable):
+        await self.acquire(key)
+        try:
+            yield
+        finally:
+            self.release()
+
+    def _dispatch(self):
+        while self.in_flight < self.max_concurrency and self._queues:
+            key, waiters = next(iter(self._queues.items()))
+            waiter = waiters.popleft()
+            if waiters:
+                self._queues.move_to_end(key) # 轮到下一个用户
+            else:
+                del self._queues[key]
+            if waiter.done():
+                continue
+            self.in_flight += 1
+            waiter.set_result(None)
+
+    def _discard(self, key: Hashable, waiter: asyncio.Future):
+        waiters = self._queues.get(key)
+        if waiters is None:
+            return
+        try:
+            waiters.remove(waiter)
+        except ValueError:
+            pass
+        if not waiters:
+            del self._queues[key]
+
+gateway = LLMGateway()
+
+llm_gateway_queue_depth = metrics.Gauge("llm_gateway_queue_depth", "Chat turns waiting for an upstream LLM slot.", function=lambda: gateway.queue_depth)
+llm_gateway_in_flight = metrics.Gauge("llm_gateway_in_flight", "Upstream LLM calls currently holding a slot.", function=lambda: gateway.in_flight)
@@ -1,11 +1,24 @@
 # app/llm_service.py
+import asyncio
+import logging
 import os
-from openai import AsyncOpenAI # 修改为 AsyncOpenAI
+import random
+import time
+from collections import deque
+from dataclasses import dataclass
+import httpx
+import openai
+from openai import AsyncOpenAI, DefaultAsyncHttpxClient # 修改为 AsyncOpenAI
 from dotenv import load_dotenv
-from typing import List, Dict, Optional
+from . import llm_cache, llm_gateway, metrics
+from typing import AsyncIterator, Awaitable, Callable, Deque, List, Dict, Optional, Sequence, Tuple, TypeVar
+
+T = TypeVar("T")
 
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 # 从 .env 文件获取 Qwen API Key 和 Base URL
 QINIU_OPENAI_API_KEY = os.getenv("QINIU_OPENAI_API_KEY")
 QINIU_OPENAI_BASE_URL = os.getenv("QINIU_OPENAI_BASE_URL") # 直接从 .env 获取，确保一致
@@ -15,21 +28,104 @@ if not QINIU_OPENAI_API_KEY:
 if not QINIU_OPENAI_BASE_URL:
     raise ValueError("QINIU_OPENAI_BASE_URL environment variable not set.")
 
-# 初始化 AsyncOpenAI 客户端，指向七牛云的兼容接口
-client = AsyncOpenAI(
-    api_key=QINIU_OPENAI_API_KEY,
-    base_url=QINIU_OPENAI_BASE_URL,
+# 上下文窗口配置：整段 prompt 的 token 预算、每轮最多从数据库读取的历史消息条数，
+# 以及积累多少条被挤出窗口的消息后才合并进摘要
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "6000"))
+CONTEXT_MAX_MESSAGES = int(os.getenv("CONTEXT_MAX_MESSAGES", "40"))
+SUMMARY_MIN_BATCH = int(os.getenv("SUMMARY_MIN_BATCH", "6"))
+SUMMARY_MAX_TOKENS = int(os.getenv("SUMMARY_MAX_TOKENS", "400"))
+# 一次摘要调用最多合并多少 token 的新消息；积压较多的聊天 (例如早期版本留下的长聊天) 分多批合并
+SUMMARY_BATCH_TOKENS = int(os.getenv("SUMMARY_BATCH_TOKENS", "3000"))
+
+DEFAULT_TEMPERATURE = 0.7
+
+# 到上游的 HTTP 连接池：连接数略大于网关的并发上限，保持长连接以省去 TLS 握手
+LLM_MAX_CONNECTIONS = int(os.getenv("LLM_MAX_CONNECTIONS", str(llm_gateway.LLM_MAX_CONCURRENCY + 8)))
+LLM_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("LLM_MAX_KEEPALIVE_CONNECTIONS", str(LLM_MAX_CONNECTIONS)))
+LLM_KEEPALIVE_EXPIRY = float(os.getenv("LLM_KEEPALIVE_EXPIRY", "60"))
+
+# 上游调用的容错配置：
+# LLM_MODELS 是按优先级排列的回退链，逗号分隔，每项为 "模型ID" 或 "模型ID@Base URL" (省略时使用 QINIU_OPENAI_BASE_URL)
+LLM_MODELS = os.getenv("LLM_MODELS", "qwen3-235b-a22b-thinking-2507")
+LLM_ATTEMPT_TIMEOUT = float(os.getenv("LLM_ATTEMPT_TIMEOUT", "60")) # 单次请求 (流式为首个数据块) 的截止时间，秒
+LLM_STREAM_IDLE_TIMEOUT = float(os.getenv("LLM_STREAM_IDLE_TIMEOUT", "30")) # 流式响应相邻两个数据块的最长间隔，秒
+LLM_MAX_RETRIES = int(os.getenv("LLM_MAX_RETRIES", "2")) # 每个后端对可重试错误的重试次数
+LLM_RETRY_BASE_DELAY = float(os.getenv("LLM_RETRY_BASE_DELAY", "0.5"))
+LLM_RETRY_MAX_DELAY = float(os.getenv("LLM_RETRY_MAX_DELAY", "4"))
+# 对冲请求：第一个请求超过近期 p95 延迟仍未返回时再发一个，采用先返回的结果
+LLM_HEDGE_ENABLED = os.getenv("LLM_HEDGE_ENABLED", "false").lower() in ("1", "true", "yes")
+LLM_HEDGE_MIN_DELAY = float(os.getenv("LLM_HEDGE_MIN_DELAY", "2"))
+LLM_HEDGE_MIN_SAMPLES = int(os.getenv("LLM_HEDGE_MIN_SAMPLES", "20"))
+# 流式请求附带 stream_options.include_usage，让上游在最后一个数据块返回 token 用量；上游不支持时可关闭
+LLM_STREAM_INCLUDE_USAGE = os.getenv("LLM_STREAM_INCLUDE_USAGE", "true").lower() in ("1", "true", "yes")
+
+class LLMUnavailable(Exception):
+    """回退链上的所有后端都失败了。"""
+
+@dataclass(frozen=True)
+class LLMBackend:
+    model: str
+    base_url: str
+
+def _parse_backends(spec: str) -> List[LLMBackend]:
+    backends = []
+    for item in spec.split(","):
+        item = item.strip()
+        if not item:
+            continue
+        model, _, base_url = item.partition("@")
+        backends.append(LLMBackend(model=model.strip(), base_url=base_url.strip() or QINIU_OPENAI_BASE_URL))
+    if not backends:
+        raise ValueError("LLM_MODELS must name at least one model.")
+    return backends
+
+LLM_BACKENDS = _parse_backends(LLM_MODELS)
+
+def primary_model() -> str:
+    return LLM_BACKENDS[0].model
+
+# 所有后端共用一个 HTTP 连接池；重试由本模块控制，因此关闭 SDK 自带的重试
+_http_client = DefaultAsyncHttpxClient(
+    limits=httpx.Limits(
+        max_connections=LLM_MAX_CONNECTIONS,
+        max_keepalive_connections=LLM_MAX_KEEPALIVE_CONNECTIONS,
+        keepalive_expiry=LLM_KEEPALIVE_EXPIRY,
+    ),
 )
+_clients: Dict[str, AsyncOpenAI] = {}
 
-async def get_qwen_response(
+def _client_for(base_url: str) -> AsyncOpenAI:
+    client = _clients.get(base_url)
+    if client is None:
+        client = _clients[base_url] = AsyncOpenAI(
+            api_key=QINIU_OPENAI_API_KEY,
+            base_url=base_url,
+            http_client=_http_client,
+            max_retries=0,
+        )
+    return client
+
+# 初始化 AsyncOpenAI 客户端，指向七牛云的兼容接口
+client = _client_for(QINIU_OPENAI_BASE_URL)
+
+def estimate_tokens(text: str) -> int:
+    """粗略估算 token 数：中日韩字符按每字 1 个 token，其余字符按每 4 个 1 个 token。"""
+    if not text:
+        return 0
+    cjk = sum(1 for ch in text if "\u2e80" <= ch <= "\u9fff" or "\uac00" <= ch <= "\ud7af" or "\uff00" <= ch <= "\uffef")
+    return cjk + (len(text) - cjk + 3) // 4
+
+# 每条消息在 chat 格式中的额外开销 (role、分隔符等)
+MESSAGE_TOKEN_OVERHEAD = 4
+
+def _message_tokens(content: str) -> int:
+    return estimate_tokens(content) + MESSAGE_TOKEN_OVERHEAD
+
+def build_prompt_prefix(
     system_prompt: str,
-    chat_history: List[Dict[str, str]], # 聊天历史，包含 sender_type 和 content
-    user_message: str,
     few_shot_examples: Optional[List[Dict[str, str]]] = None,
-    temperature: float = 0.7,
-    max_tokens: int = 500,
-    model: str = "qwen3-235b-a22b-thinking-2507" # 使用你的模型ID
-) -> str:
+) -> Tuple[Dict[str, str], ...]:
+    """构建每轮都相同的 prompt 前缀 (系统提示 + few-shot 示例)，返回不可变的元组以便缓存复用。"""
     messages = []
 
     # 添加系统提示
@@ -42,6 +138,60 @@ async def get_qwen_response(
                 messages.append({"role": "user", "content": example["user"]})
             if "ai" in example: # 注意 Few-shot 示例中的 AI 回复在 OpenAI API 中通常用 'assistant' 角色
                 messages.append({"role": "assistant", "content": example["ai"]})
+    return tuple(messages)
+
+def count_prompt_tokens(messages: Sequence[Dict[str, str]]) -> int:
+    return sum(_message_tokens(msg["content"]) for msg in messages)
+
+def build_context(
+    chat_history: List[Dict[str, str]],
+    user_message: str,
+    prefix_tokens: int,
+    summary: Optional[str] = None,
+    token_budget: int = CONTEXT_TOKEN_BUDGET,
+) -> List[Dict[str, str]]:
+    """从最新一条往前保留能放进 token 预算的历史消息，返回按时间顺序排列的保留部分。
+
+    prompt 前缀 (prefix_tokens)、摘要和当前用户消息总是会发送，先从预算中扣除。
+    """
+    remaining = token_budget - prefix_tokens - _message_tokens(user_message)
+    if summary:
+        remaining -= _message_tokens(summary)
+
+    kept = []
+    for msg in reversed(chat_history):
+        remaining -= _message_tokens(msg["content"])
+        if remaining < 0:
+            break
+        kept.append(msg)
+    kept.reverse()
+    return kept
+
+def summary_batch_size(messages: Sequence[Dict[str, str]], token_budget: int = SUMMARY_BATCH_TOKENS) -> int:
+    """从头开始能放进一次摘要调用的消息条数；至少为 1，超长的单条消息由 summarize_history 截断。"""
+    remaining = token_budget
+    for count, msg in enumerate(messages):
+        remaining -= _message_tokens(msg["content"])
+        if remaining < 0:
+            return max(1, count)
+    return len(messages)
+
+def build_messages(
+    system_prompt: str,
+    chat_history: List[Dict[str, str]],
+    user_message: str,
+    few_shot_examples: Optional[List[Dict[str, str]]] = None,
+    summary: Optional[str] = None,
+    prompt_prefix: Optional[Sequence[Dict[str, str]]] = None,
+) -> List[Dict[str, str]]:
+    # 优先使用角色缓存中预先构建好的前缀，避免每轮重新拼装
+    if prompt_prefix is None:
+        prompt_prefix = build_prompt_prefix(system_prompt, few_shot_examples)
+    messages = list(prompt_prefix)
+
+    # 添加早期对话的摘要 (已被挤出上下文窗口的部分)
+    if summary:
+        messages.append({"role": "system", "content": f"以下是你们之前对话的摘要，请据此保持上下文连贯：\n{summary}"})
 
     # 添加历史消息
     for msg in chat_history:
@@ -51,15 +201,277 @@ async def get_qwen_response(
 
     # 添加当前用户消息
     messages.append({"role": "user", "content": user_message})
+    return messages
 
-    try:
-        completion = await client.chat.completions.create(
-            model=model,
+class _LatencyWindow:
+    """最近若干次成功请求的耗时，用于计算对冲延迟。"""
+
+    def __init__(self, size: int = 200):
+        self.samples: Deque[float] = deque(maxlen=size)
+
+    def record(self, seconds: float):
+        self.samples.append(seconds)
+
+    def hedge_delay(self) -> float:
+        if len(self.samples) < LLM_HEDGE_MIN_SAMPLES:
+            return LLM_HEDGE_MIN_DELAY
+        ordered = sorted(self.samples)
+        return max(LLM_HEDGE_MIN_DELAY, ordered[int(len(ordered) * 0.95) - 1])
+
+_latencies: Dict[LLMBackend, _LatencyWindow] = {}
+
+def _latency_window(backend: LLMBackend) -> _LatencyWindow:
+    return _latencies.setdefault(backend, _LatencyWindow())
+
+# role 标签为角色名，后台摘要调用为 "summary"
+llm_call_phase_seconds = metrics.Histogram("llm_call_phase_seconds", "Time spent in an LLM call, by phase (build_prompt, upstream).", ("role", "mode", "phase"))
+llm_request_duration_seconds = metrics.Histogram("llm_request_duration_seconds", "Duration of successful upstream LLM requests.", ("model", "role", "mode"))
+llm_time_to_first_token_seconds = metrics.Histogram("llm_time_to_first_token_seconds", "Time from starting a streamed reply to its first content token, including retries and fallback.", ("model", "role"))
+llm_tokens_per_second = metrics.Histogram(
+    "llm_tokens_per_second", "Completion tokens generated per second.", ("model", "role", "mode"),
+    buckets=(1, 2.5, 5, 10, 20, 30, 50, 75, 100, 150, 200, 300, 500),
+)
+llm_tokens_total = metrics.Counter("llm_tokens_total", "Token usage reported by the upstream API.", ("model", "role", "type"))
+
+def _record_usage(backend: LLMBackend, label: str, mode: str, usage, generation_seconds: float):
+    """记录上游返回的 token 用量和生成速度；usage 为空时 (上游未返回) 不记录。"""
+    if usage is None:
+        return
+    llm_tokens_total.inc(usage.prompt_tokens or 0, model=backend.model, role=label, type="prompt")
+    llm_tokens_total.inc(usage.completion_tokens or 0, model=backend.model, role=label, type="completion")
+    if usage.completion_tokens and generation_seconds > 0:
+        llm_tokens_per_second.observe(usage.completion_tokens / generation_seconds, model=backend.model, role=label, mode=mode)
+
+def _is_retryable(exc: BaseException) -> bool:
+    if isinstance(exc, (asyncio.TimeoutError, openai.APITimeoutError, openai.APIConnectionError, httpx.TransportError)):
+        return True
+    if isinstance(exc, openai.APIStatusError):
+        return exc.status_code in (408, 409, 429) or exc.status_code >= 500
+    return False
+
+def _is_rejected(exc: BaseException) -> bool:
+    """请求本身被上游拒绝 (不可重试的 4xx，例如参数错误或鉴权失败)，换一个后端也不会成功。"""
+    return isinstance(exc, openai.APIStatusError) and 400 <= exc.status_code < 500 and not _is_retryable(exc)
+
+def _backends_for(model: Optional[str]) -> List[LLMBackend]:
+    # 显式指定的模型替换回退链的第一项，其余后端仍作为回退
+    if model is None or model == LLM_BACKENDS[0].model:
+        return LLM_BACKENDS
+    return [LLMBackend(model=model, base_url=LLM_BACKENDS[0].base_url)] + LLM_BACKENDS[1:]
+
+async def _with_fallback(operation: Callable[[LLMBackend], Awaitable[T]], model: Optional[str]) -> T:
+    """依次尝试回退链上的后端；可重试的错误先在同一后端按带抖动的指数退避重试，其他错误直接换下一个后端。
+
+    被拒绝的请求 (不可重试的 4xx) 不重试也不回退，直接抛出 LLMUnavailable。
+    """
+    last_error: Optional[BaseException] = None
+    for backend in _backends_for(model):
+        for attempt in range(LLM_MAX_RETRIES + 1):
+            try:
+                return await operation(backend)
+            except Exception as e:
+                last_error = e
+                logger.warning("LLM call to %s failed (attempt %d)", backend.model, attempt + 1, exc_info=e)
+                if _is_rejected(e):
+                    raise LLMUnavailable(f"LLM request rejected by {backend.model}: {e!r}") from e
+                if not _is_retryable(e) or attempt == LLM_MAX_RETRIES:
+                    break
+                await asyncio.sleep(random.uniform(0, min(LLM_RETRY_MAX_DELAY, LLM_RETRY_BASE_DELAY * 2 ** attempt)))
+    raise LLMUnavailable(f"All LLM backends failed: {last_error!r}") from last_error
+
+async def _attempt_completion(backend: LLMBackend, messages: List[Dict[str, str]], temperature: float, max_tokens: int, label: str) -> str:
+    start = time.monotonic()
+    completion = await asyncio.wait_for(
+        _client_for(backend.base_url).chat.completions.create(
+            model=backend.model,
             messages=messages,
             temperature=temperature,
             max_tokens=max_tokens,
+            timeout=LLM_ATTEMPT_TIMEOUT,
+        ),
+        timeout=LLM_ATTEMPT_TIMEOUT,
+    )
+    content = completion.choices[0].message.content if completion.choices else None
+    if not content:
+        # 例如思考模型把 max_tokens 全用在了推理上，换下一个后端
+        raise ValueError(f"Empty completion from {backend.model}")
+    elapsed = time.monotonic() - start
+    _latency_window(backend).record(elapsed)
+    llm_request_duration_seconds.observe(elapsed, model=backend.model, role=label, mode="complete")
+    _record_usage(backend, label, "complete", completion.usage, elapsed)
+    return content
+
+async def _hedged_completion(backend: LLMBackend, messages: List[Dict[str, str]], temperature: float, max_tokens: int, label: str) -> str:
+    if not LLM_HEDGE_ENABLED:
+        return await _attempt_completion(backend, messages, temperature, max_tokens, label)
+
+    pending = {asyncio.ensure_future(_attempt_completion(backend, messages, temperature, max_tokens, label))}
+    try:
+        done, pending = await asyncio.wait(pending, timeout=_latency_window(backend).hedge_delay())
+        if not done:
+            pending.add(asyncio.ensure_future(_attempt_completion(backend, messages, temperature, max_tokens, label)))
+        error: Optional[BaseException] = None
+        while done or pending:
+            for task in done:
+                if task.exception() is None:
+                    return task.result()
+                error = task.exception()
+            if not pending:
+                break
+            done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+        raise error
+    finally:
+        # 采用先返回的结果，取消另一个请求
+        for task in pending:
+            task.cancel()
+
+async def _complete(messages: List[Dict[str, str]], model: Optional[str], temperature: float, max_tokens: int, label: str) -> str:
+    return await _with_fallback(lambda backend: _hedged_completion(backend, messages, temperature, max_tokens, label), model)
+
+async def get_qwen_response(
+    system_prompt: str,
+    chat_history: List[Dict[str, str]], # 聊天历史，包含 sender_type 和 content
+    user_message: str,
+    few_shot_examples: Optional[List[Dict[str, str]]] = None,
+    temperature: float = DEFAULT_TEMPERATURE,
+    max_tokens: int = 500,
+    model: Optional[str] = None, # 默认使用 LLM_MODELS 回退链
+    summary: Optional[str] = None,
+    prompt_prefix: Optional[Sequence[Dict[str, str]]] = None,
+    cache_key: Optional[str] = None,
+    role_label: str = "",
+) -> str:
+    """返回 AI 回复；回退链上所有后端都失败时抛出 LLMUnavailable，调用方不应把错误当作回复保存。
+
+    cache_key 不为空时使用回复缓存 (见 llm_cache)，相同的并发请求共享一次上游调用；出错的回复不会被缓存。
+    role_label 用作缓存和延迟指标的 role 标签。
+    """
+    with llm_call_phase_seconds.time(role=role_label, mode="complete", phase="build_prompt"):
+        messages = build_messages(system_prompt, chat_history, user_message, few_shot_examples, summary, prompt_prefix)
+
+    with llm_call_phase_seconds.time(role=role_label, mode="complete", phase="upstream"):
+        if cache_key:
+            return await llm_cache.response_cache.get_or_compute(
+                cache_key, lambda: _complete(messages, model, temperature, max_tokens, role_label), label=role_label
+            )
+        return await _complete(messages, model, temperature, max_tokens, role_label)
+
+async def stream_qwen_response(
+    system_prompt: str,
+    chat_history: List[Dict[str, str]],
+    user_message: str,
+    few_shot_examples: Optional[List[Dict[str, str]]] = None,
+    temperature: float = DEFAULT_TEMPERATURE,
+    max_tokens: int = 500,
+    model: Optional[str] = None,
+    summary: Optional[str] = None,
+    prompt_prefix: Optional[Sequence[Dict[str, str]]] = None,
+    cache_key: Optional[str] = None,
+    role_label: str = "",
+) -> AsyncIterator[str]:
+    """以流式方式逐块返回回复内容 (stream=True)。
+
+    思考模型的 reasoning_content 不会返回给调用方，只产出最终回复的文本片段。
+    在收到首个数据块之前按回退链重试；之后上游出错或超时时异常直接抛出，由调用方决定如何处理已生成的部分内容。
+    cache_key 命中时一次性产出缓存的回复；相同 cache_key 的请求正在生成时 (流式或非流式) 等待它完成，再一次性产出它的回复，
+    不重复调用上游。完整结束的流会写入缓存。
+    """
+    flight = None
+    if cache_key:
+        cached = await llm_cache.response_cache.join(cache_key, label=role_label)
+        if cached is not None:
+            yield cached
+            return
+        flight = llm_cache.response_cache.lead(cache_key, label=role_label)
+
+    try:
+        with llm_call_phase_seconds.time(role=role_label, mode="stream", phase="build_prompt"):
+            messages = build_messages(system_prompt, chat_history, user_message, few_shot_examples, summary, prompt_prefix)
+
+        start = time.monotonic()
+        backend, stream, iterator, chunk = await _with_fallback(
+            lambda backend: _open_stream(backend, messages, temperature, max_tokens), model
         )
-        return completion.choices[0].message.content
-    except Exception as e:
-        print(f"Error calling Qwen API: {e}")
-        return "Sorry, I am unable to respond at the moment."
\ No newline at end of file
+        chunks = []
+        usage = None
+        first_token_at = None
+        try:
+            while chunk is not None:
+                if chunk.choices:
+                    delta = chunk.choices[0].delta.content
+                    if delta:
+                        if first_token_at is None:
+                            first_token_at = time.monotonic()
+                            llm_time_to_first_token_seconds.observe(first_token_at - start, model=backend.model, role=role_label)
+                        chunks.append(delta)
+                        yield delta
+                if getattr(chunk, "usage", None) is not None:
+                    usage = chunk.usage # include_usage 时最后一个数据块没有 choices，只带用量
+                chunk = await _next_chunk(iterator, LLM_STREAM_IDLE_TIMEOUT)
+            end = time.monotonic()
+            llm_call_phase_seconds.observe(end - start, role=role_label, mode="stream", phase="upstream")
+            llm_request_duration_seconds.observe(end - start, model=backend.model, role=role_label, mode="stream")
+            _record_usage(backend, role_label, "stream", usage, end - (first_token_at or start))
+            if flight is not None and chunks:
+                flight.finish("".join(chunks))
+        finally:
+            # 客户端断开或调用方提前退出时，关闭上游连接，避免继续消耗 token
+            await stream.close()
+    except BaseException as e:
+        # 上游出错时等待者得到同样的异常；客户端断开 (GeneratorExit / 取消) 时等待者自己重新发起
+        if flight is not None:
+            flight.fail(e)
+        raise
+    finally:
+        if flight is not None:
+            flight.cancel()
+
+async def _next_chunk(iterator, timeout: float):
+    try:
+        return await asyncio.wait_for(iterator.__anext__(), timeout=timeout)
+    except StopAsyncIteration:
+        return None
+
+async def _open_stream(backend: LLMBackend, messages: List[Dict[str, str]], temperature: float, max_tokens: int):
+    """建立流式请求并等到首个数据块 (思考模型的推理内容也算)，返回 (backend, stream, 迭代器, 首个数据块)。"""
+    stream = await asyncio.wait_for(
+        _client_for(backend.base_url).chat.completions.create(
+            model=backend.model,
+            messages=messages,
+            temperature=temperature,
+            max_tokens=max_tokens,
+            stream=True,
+            stream_options={"include_usage": True} if LLM_STREAM_INCLUDE_USAGE else openai.NOT_GIVEN,
+            timeout=LLM_ATTEMPT_TIMEOUT,
+        ),
+        timeout=LLM_ATTEMPT_TIMEOUT,
+    )
+    iterator = stream.__aiter__()
+    try:
+        first = await _next_chunk(iterator, LLM_ATTEMPT_TIMEOUT)
+    except BaseException:
+        await stream.close()
+        raise
+    return backend, stream, iterator, first
+
+async def summarize_history(
+    previous_summary: Optional[str],
+    chat_history: List[Dict[str, str]],
+    model: Optional[str] = None,
+) -> Optional[str]:
+    """把已有摘要和新被挤出窗口的消息合并成新的摘要，失败时返回 None (保留旧摘要)。
+
+    调用方用 summary_batch_size 控制每批的消息数；单条消息按字符截断到 SUMMARY_BATCH_TOKENS (每个字符至多 1 个 token)。
+    """
+    transcript = "\n".join(
+        f"{'用户' if msg['sender_type'] == 'user' else '角色'}: {msg['content'][:SUMMARY_BATCH_TOKENS]}" for msg in chat_history
+    )
+    messages = [
+        {"role": "system", "content": "你是对话摘要助手。请把已有摘要与新增的对话合并成一段简洁的中文摘要，保留人物、事实、用户偏好和未完成的话题，不要添加对话中没有的内容。"},
+        {"role": "user", "content": f"已有摘要：\n{previous_summary or '(无)'}\n\n新增对话：\n{transcript}"},
+    ]
+    try:
+        return await _complete(messages, model, 0.3, SUMMARY_MAX_TOKENS, "summary")
+    except LLMUnavailable:
+        logger.exception("Error summarizing chat history")
+        return None
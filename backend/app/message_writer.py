@@ -0,0 +1,160 @@
+# app/message_writer.py
+# 聊天消息的写入。默认每条消息一条自动提交的 INSERT ... RETURNING (一次往返)；
+# 开启 MESSAGE_WRITE_BEHIND 后，多个请求的消息在一个很短的时间窗口内合并成一条多行 INSERT 提交，
+# 每个请求等待自己那一批提交成功 (持久化确认) 后再返回，把逐行提交的 fsync 摊到整批上。
+import asyncio
+import datetime
+import logging
+import os
+import time
+import uuid
+from typing import Dict, List, Optional, Tuple
+from sqlalchemy import func, insert, select, update
+from sqlalchemy.dialects.postgresql import aggregate_order_by, array_agg
+from dotenv import load_dotenv
+from . import metrics, models, schemas
+from .database import autocommit_engine, recent_writes
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+MESSAGE_WRITE_BEHIND = os.getenv("MESSAGE_WRITE_BEHIND", "false").lower() in ("1", "true", "yes")
+# 收到第一条待写消息后最多再等多久凑一批 (秒)，以及一批最多多少行
+MESSAGE_FLUSH_INTERVAL = float(os.getenv("MESSAGE_FLUSH_INTERVAL", "0.005"))
+MESSAGE_FLUSH_MAX_BATCH = int(os.getenv("MESSAGE_FLUSH_MAX_BATCH", "500"))
+
+message_writer_batch_rows = metrics.Histogram(
+    "message_writer_batch_rows", "Messages written per write-behind flush.",
+    buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500, 1000),
+)
+message_writer_flush_seconds = metrics.Histogram("message_writer_flush_seconds", "Duration of write-behind flushes.")
+message_writer_failures_total = metrics.Counter("message_writer_failures_total", "Messages that could not be written.")
+
+_Pending = Tuple[Dict, asyncio.Future]
+
+async def _insert_rows(rows: List[Dict]) -> Dict[uuid.UUID, datetime.datetime]:
+    """一条多行 INSERT (自动提交)，返回 id -> 数据库生成的 timestamp。
+
+    同一条语句里按聊天汇总本批消息，更新 chats 上的消息数、最后活动时间和最后一条消息预览。
+    """
+    inserted = (
+        insert(models.Message).values(rows)
+        .returning(models.Message.id, models.Message.chat_id, models.Message.content, models.Message.timestamp, models.Message.order_in_chat)
+        .cte("inserted")
+    )
+    per_chat = (
+        select(
+            inserted.c.chat_id,
+            func.count().label("message_count"),
+            func.max(inserted.c.timestamp).label("last_message_at"),
+            array_agg(aggregate_order_by(
+                func.left(inserted.c.content, models.MESSAGE_PREVIEW_LENGTH), inserted.c.order_in_chat.desc()
+            ))[1].label("preview"),
+        )
+        .group_by(inserted.c.chat_id)
+        .subquery("per_chat")
+    )
+    chat_summary = (
+        update(models.Chat)
+        .where(models.Chat.id == per_chat.c.chat_id)
+        .values(
+            message_count=models.Chat.message_count + per_chat.c.message_count,
+            last_message_at=func.greatest(models.Chat.last_message_at, per_chat.c.last_message_at),
+            last_message_preview=per_chat.c.preview,
+        )
+        .cte("chat_summary")
+    )
+    async with autocommit_engine.connect() as conn:
+        result = await conn.execute(select(inserted.c.id, inserted.c.timestamp).add_cte(chat_summary))
+        return {row.id: row.timestamp for row in result}
+
+class MessageWriter:
+    def __init__(self, interval: float = MESSAGE_FLUSH_INTERVAL, max_batch: int = MESSAGE_FLUSH_MAX_BATCH):
+        self.interval = interval
+        self.max_batch = max_batch
+        self._pending: List[_Pending] = []
+        self._has_pending = asyncio.Event()
+        self._batch_full = asyncio.Event()
+        self._task: Optional[asyncio.Task] = None
+        self._closing = False
+
+    async def write(self, row: Dict) -> datetime.datetime:
+        """排队写入一行，等到所在批次提交后返回其 timestamp；该行写入失败时抛出对应的数据库异常。"""
+        if self._closing:
+            return (await _insert_rows([row]))[row["id"]]
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((row, future))
+        self._has_pending.set()
+        if len(self._pending) >= self.max_batch:
+            self._batch_full.set()
+        # 请求被取消 (客户端断开) 时消息仍会写入
+        return await asyncio.shield(future)
+
+    async def close(self):
+        """停止接收新的批次并写完所有待写消息 (应用关闭时调用)。"""
+        self._closing = True
+        self._has_pending.set()
+        self._batch_full.set()
+        if self._task is not None:
+            await self._task
+
+    async def _run(self):
+        while True:
+            await self._has_pending.wait()
+            if not self._closing:
+                # 组提交窗口：等一小段时间或直到凑满一批
+                try:
+                    await asyncio.wait_for(self._batch_full.wait(), timeout=self.interval)
+                except asyncio.TimeoutError:
+                    pass
+            batch, self._pending = self._pending[:self.max_batch], self._pending[self.max_batch:]
+            if len(self._pending) < self.max_batch:
+                self._batch_full.clear()
+            if not self._pending:
+                self._has_pending.clear()
+            if batch:
+                await self._flush(batch)
+            elif self._closing:
+                return
+
+    async def _flush(self, batch: List[_Pending]):
+        start = time.perf_counter()
+        try:
+            timestamps = await _insert_rows([row for row, _ in batch])
+        except Exception as e:
+            # 整批失败 (例如其中一行违反约束) 时逐行重试，只让出错的那一行失败
+            logger.warning("Write-behind batch of %d failed, retrying row by row", len(batch), exc_info=e)
+            for row, future in batch:
+                try:
+                    timestamp = (await _insert_rows([row]))[row["id"]]
+                except Exception as row_error:
+                    message_writer_failures_total.inc()
+                    if not future.done():
+                        future.set_exception(row_error)
+                else:
+                    if not future.done():
+                        future.set_result(timestamp)
+            return
+        finally:
+            message_writer_batch_rows.observe(len(batch))
+            message_writer_flush_seconds.observe(time.perf_counter() - start)
+        for row, future in batch:
+            if not future.done():
+                future.set_result(timestamps[row["id"]])
+
+writer = MessageWriter()
+
+def message_row(chat_id: uuid.UUID, sender_type: str, content: str, order_in_chat: int) -> Dict:
+    return {"id": uuid.uuid4(), "chat_id": chat_id, "sender_type": sender_type, "content": content, "order_in_chat": order_in_chat}
+
+async def save_message(row: Dict) -> Dict:
+    """保存一条消息并返回与 schemas.MessageResponse 一致的字典；是否合并写入由 MESSAGE_WRITE_BEHIND 决定。"""
+    if MESSAGE_WRITE_BEHIND:
+        timestamp = await writer.write(row)
+    else:
+        timestamp = (await _insert_rows([row]))[row["id"]]
+    recent_writes.mark(row["chat_id"])
+    return schemas.MessageResponse.model_validate({**row, "timestamp": timestamp}).model_dump(mode="json")
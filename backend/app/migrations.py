@@ -0,0 +1,215 @@
+# app/migrations.py
+# 版本化的数据库迁移。启动时 (或部署时执行 python -m app.migrations) 在一个事务里持有 advisory 锁依次应用未执行的迁移，
+# 多个 worker 同时启动时只有一个会真正执行，其余的等锁释放后发现已是最新版本直接跳过。
+import asyncio
+import logging
+import os
+import time
+from dataclasses import dataclass
+from typing import Awaitable, Callable, List
+from sqlalchemy import text
+from sqlalchemy.ext.asyncio import AsyncConnection
+from dotenv import load_dotenv
+from .database import Base, async_engine
+from . import models
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+# 启动时是否执行迁移和默认角色初始化；生产环境可设为 false，改为部署流程中单独执行 python -m app.migrations
+DB_MIGRATE_ON_STARTUP = os.getenv("DB_MIGRATE_ON_STARTUP", "true").lower() in ("1", "true", "yes")
+
+# pg_advisory_xact_lock 的键，任意固定的 64 位整数即可
+MIGRATION_LOCK_KEY = 7263510482
+
+@dataclass(frozen=True)
+class Migration:
+    version: int
+    name: str
+    apply: Callable[[AsyncConnection], Awaitable[None]]
+
+async def _baseline(conn: AsyncConnection):
+    # 全新数据库按当前模型建表；已有表会被跳过，所以此后的迁移都必须是幂等的 (IF NOT EXISTS 等)
+    await conn.run_sync(Base.metadata.create_all)
+
+async def _chat_ordering_and_summaries(conn: AsyncConnection):
+    # 升级在引入迁移之前由 create_all 创建的数据库，补齐之后新增的列、索引和约束
+    statements = [
+        "ALTER TABLE roles ADD COLUMN IF NOT EXISTS response_cache_enabled BOOLEAN NOT NULL DEFAULT false",
+        "ALTER TABLE chats ADD COLUMN IF NOT EXISTS next_order INTEGER NOT NULL DEFAULT 0",
+        "ALTER TABLE chats ADD COLUMN IF NOT EXISTS summary TEXT",
+        "ALTER TABLE chats ADD COLUMN IF NOT EXISTS summarized_until INTEGER NOT NULL DEFAULT -1",
+        # 已有聊天的下一个序号接在现有消息之后
+        """
+        UPDATE chats SET next_order = sub.max_order + 1
+        FROM (SELECT chat_id, MAX(order_in_chat) AS max_order FROM messages GROUP BY chat_id) AS sub
+        WHERE chats.id = sub.chat_id AND chats.next_order <= sub.max_order
+        """,
+        "CREATE INDEX IF NOT EXISTS ix_chats_user_id_created_at_id ON chats (user_id, created_at DESC, id DESC)",
+        """
+        DO $$ BEGIN
+            IF NOT EXISTS (SELECT 1 FROM pg_constraint WHERE conname = 'uq_messages_chat_id_order_in_chat') THEN
+                ALTER TABLE messages ADD CONSTRAINT uq_messages_chat_id_order_in_chat UNIQUE (chat_id, order_in_chat);
+            END IF;
+        END $$
+        """,
+    ]
+    for statement in statements:
+        await conn.execute(text(statement))
+
+async def _chat_list_summaries(conn: AsyncConnection):
+    # 聊天列表的冗余统计列：按已有消息回填，没有消息的聊天以创建时间作为最后活动时间
+    statements = [
+        "ALTER TABLE chats ADD COLUMN IF NOT EXISTS message_count INTEGER NOT NULL DEFAULT 0",
+        "ALTER TABLE chats ADD COLUMN IF NOT EXISTS last_message_at TIMESTAMPTZ",
+        "ALTER TABLE chats ADD COLUMN IF NOT EXISTS last_message_preview TEXT",
+        f"""
+        UPDATE chats SET message_count = sub.message_count, last_message_at = sub.last_message_at, last_message_preview = sub.preview
+        FROM (
+            SELECT chat_id, COUNT(*) AS message_count, MAX(timestamp) AS last_message_at,
+                   (array_agg(left(content, {models.MESSAGE_PREVIEW_LENGTH}) ORDER BY order_in_chat DESC))[1] AS preview
+            FROM messages GROUP BY chat_id
+        ) AS sub
+        WHERE chats.id = sub.chat_id
+        """,
+        "UPDATE chats SET last_message_at = created_at WHERE last_message_at IS NULL",
+        "ALTER TABLE chats ALTER COLUMN last_message_at SET DEFAULT now(), ALTER COLUMN last_message_at SET NOT NULL",
+        "CREATE INDEX IF NOT EXISTS ix_chats_user_id_last_message_at_id ON chats (user_id, last_message_at DESC, id DESC)",
+        # 列表改为按最近活动排序后不再使用按创建时间的索引
+        "DROP INDEX IF EXISTS ix_chats_user_id_created_at_id",
+    ]
+    for statement in statements:
+        await conn.execute(text(statement))
+
+async def _message_search_index(conn: AsyncConnection):
+    # 消息搜索用存储的 tsvector 生成列 (每个中日韩文字单独成词，见 models.MESSAGE_SEARCH_VECTOR)，不需要 contrib 扩展；
+    # 已有的大表加生成列会重写整表，请在维护窗口执行 python -m app.migrations
+    await conn.execute(text(
+        f"ALTER TABLE messages ADD COLUMN IF NOT EXISTS search_vector tsvector GENERATED ALWAYS AS ({models.MESSAGE_SEARCH_VECTOR}) STORED"
+    ))
+    # btree_gin 可用时把 chat_id 放进同一个 GIN 索引，按用户的聊天逐个查找时只扫描这些聊天的倒排项；
+    # 否则只索引 search_vector。两者都开启 fastupdate，发送消息时的插入不需要逐个更新倒排项
+    result = await conn.execute(text("SELECT 1 FROM pg_available_extensions WHERE name = 'btree_gin'"))
+    if result.first() is not None:
+        await conn.execute(text("CREATE EXTENSION IF NOT EXISTS btree_gin"))
+        await conn.execute(text(
+            "CREATE INDEX IF NOT EXISTS ix_messages_chat_id_search_vector ON messages USING gin (chat_id, search_vector) WITH (fastupdate = on)"
+        ))
+    else:
+        await conn.execute(text(
+            "CREATE INDEX IF NOT EXISTS ix_messages_search_vector ON messages USING gin (search_vector) WITH (fastupdate = on)"
+        ))
+
+async def _partition_messages(conn: AsyncConnection):
+    # 把 messages 改为按 chat_id 哈希分区。全新数据库由 create_all 直接建出分区父表，只需补建子表；
+    # 旧的普通表在事务内改名、按模型建分区表并整表复制 (期间会锁住写入，大表请在维护窗口执行 python -m app.migrations)
+    result = await conn.execute(text("SELECT 1 FROM pg_partitioned_table WHERE partrelid = 'messages'::regclass"))
+    if result.first() is None:
+        for statement in [
+            "ALTER TABLE messages RENAME TO messages_unpartitioned",
+            # 索引名在 schema 内必须唯一，旧表的索引改名或删除后再建新表
+            "ALTER INDEX messages_pkey RENAME TO messages_unpartitioned_pkey",
+            "ALTER INDEX uq_messages_chat_id_order_in_chat RENAME TO uq_messages_unpartitioned_chat_id_order_in_chat",
+            "DROP INDEX IF EXISTS ix_messages_chat_id_search_vector",
+            "DROP INDEX IF EXISTS ix_messages_search_vector",
+            "ALTER TABLE messages_unpartitioned DROP CONSTRAINT IF EXISTS messages_chat_id_fkey",
+        ]:
+            await conn.execute(text(statement))
+        await conn.run_sync(models.Message.__table__.create)
+        await _create_message_partitions(conn)
+        await conn.execute(text(
+            "INSERT INTO messages (id, chat_id, sender_type, content, timestamp, order_in_chat) "
+            "SELECT id, chat_id, sender_type, content, timestamp, order_in_chat FROM messages_unpartitioned"
+        ))
+        await conn.execute(text("DROP TABLE messages_unpartitioned"))
+        # 在分区父表上重建搜索索引，之后新建的分区会自动带上
+        await _message_search_index(conn)
+    else:
+        await _create_message_partitions(conn)
+
+async def _create_message_partitions(conn: AsyncConnection):
+    for remainder in range(models.MESSAGE_PARTITIONS):
+        await conn.execute(text(
+            f"CREATE TABLE IF NOT EXISTS messages_p{remainder} PARTITION OF messages "
+            f"FOR VALUES WITH (MODULUS {models.MESSAGE_PARTITIONS}, REMAINDER {remainder})"
+        ))
+
+async def _chat_archives(conn: AsyncConnection):
+    await conn.execute(text("ALTER TABLE chats ADD COLUMN IF NOT EXISTS archived_at TIMESTAMPTZ"))
+    await conn.execute(text(
+        "CREATE INDEX IF NOT EXISTS ix_chats_last_message_at_unarchived ON chats (last_message_at) WHERE archived_at IS NULL"
+    ))
+    await conn.run_sync(models.ChatArchive.__table__.create, checkfirst=True)
+
+async def _reply_jobs(conn: AsyncConnection):
+    await conn.run_sync(models.ReplyJob.__table__.create, checkfirst=True)
+
+async def _idempotency_and_turn_leases(conn: AsyncConnection):
+    await conn.execute(text("ALTER TABLE chats ADD COLUMN IF NOT EXISTS turn_token UUID, ADD COLUMN IF NOT EXISTS turn_expires_at TIMESTAMPTZ"))
+    await conn.run_sync(models.IdempotencyKey.__table__.create, checkfirst=True)
+
+async def _reply_job_chat_order(conn: AsyncConnection):
+    await conn.execute(text(
+        "CREATE INDEX IF NOT EXISTS ix_reply_jobs_pending_chat_id_order_in_chat ON reply_jobs (chat_id, order_in_chat) "
+        "WHERE status IN ('queued', 'running')"
+    ))
+
+# 按版本号追加新迁移，已发布的迁移不要修改
+MIGRATIONS: List[Migration] = [
+    Migration(1, "baseline", _baseline),
+    Migration(2, "chat ordering, summaries and response cache flag", _chat_ordering_and_summaries),
+    Migration(3, "chat list summaries", _chat_list_summaries),
+    Migration(4, "message search index", _message_search_index),
+    Migration(5, "hash-partitioned messages", _partition_messages),
+    Migration(6, "chat archives", _chat_archives),
+    Migration(7, "reply jobs", _reply_jobs),
+    Migration(8, "idempotency keys and chat turn leases", _idempotency_and_turn_leases),
+    Migration(9, "reply job per-chat ordering", _reply_job_chat_order),
+]
+
+async def migrate(seed_roles: bool = True) -> List[int]:
+    """应用所有未执行的迁移并 (可选) 初始化默认角色，返回本次应用的版本号。"""
+    async with async_engine.begin() as conn:
+        # 迁移可能需要复制整表，不受 DB_STATEMENT_TIMEOUT_MS 限制
+        await conn.execute(text("SET LOCAL statement_timeout = 0"))
+        # 事务级锁，提交或回滚时自动释放；DDL 在 PostgreSQL 中也是事务性的，失败时整体回滚
+        await conn.execute(text("SELECT pg_advisory_xact_lock(:key)"), {"key": MIGRATION_LOCK_KEY})
+        await conn.execute(text(
+            "CREATE TABLE IF NOT EXISTS schema_migrations ("
+            "version INTEGER PRIMARY KEY, name TEXT NOT NULL, applied_at TIMESTAMPTZ NOT NULL DEFAULT now())"
+        ))
+        result = await conn.execute(text("SELECT version FROM schema_migrations"))
+        done = {row.version for row in result}
+        applied = []
+        for migration in MIGRATIONS:
+            if migration.version in done:
+                continue
+            await migration.apply(conn)
+            await conn.execute(
+                text("INSERT INTO schema_migrations (version, name) VALUES (:version, :name)"),
+                {"version": migration.version, "name": migration.name},
+            )
+            applied.append(migration.version)
+        if seed_roles:
+            await models.create_default_roles(conn)
+    return applied
+
+async def run_startup():
+    """lifespan 启动时调用；DB_MIGRATE_ON_STARTUP=false 时完全跳过数据库结构相关的工作。"""
+    if not DB_MIGRATE_ON_STARTUP:
+        return
+    start = time.perf_counter()
+    applied = await migrate()
+    if applied:
+        logger.info("Applied migrations %s in %.2fs", applied, time.perf_counter() - start)
+
+async def _main():
+    try:
+        applied = await migrate()
+    finally:
+        await async_engine.dispose()
+    print(f"Applied migrations: {applied or 'none, already up to date'}")
+
+if __name__ == "__main__":
+    asyncio.run(_main())
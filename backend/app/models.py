@@ -1,8 +1,10 @@
 # app/models.py
 import uuid
-from sqlalchemy import Column, Integer, String, Text, Boolean, DateTime, ForeignKey, func
-from sqlalchemy.dialects.postgresql import UUID, JSONB
-from sqlalchemy.orm import relationship, Session # 导入 Session
+from sqlalchemy import Column, Computed, Integer, String, Text, Boolean, DateTime, ForeignKey, Index, LargeBinary, UniqueConstraint, func
+from sqlalchemy.dialects.postgresql import TSVECTOR, UUID, JSONB, insert as pg_insert
+from sqlalchemy.ext.asyncio import AsyncConnection, AsyncSession
+from sqlalchemy.orm import deferred, relationship
+from typing import Union
 from .database import Base
 
 class User(Base):
@@ -26,6 +28,7 @@ class Role(Base):
     system_prompt = Column(Text, nullable=False)
     few_shot_examples = Column(JSONB, nullable=True) # PostgreSQL 特有，用于存储JSON
     is_active = Column(Boolean, default=True, nullable=False)
+    response_cache_enabled = Column(Boolean, default=False, server_default="false", nullable=False) # 是否缓存开场几轮的 LLM 回复
     created_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
     updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now(), nullable=False)
 
@@ -38,6 +41,20 @@ class Chat(Base):
     user_id = Column(UUID(as_uuid=True), ForeignKey("users.id"), nullable=False)
     role_id = Column(UUID(as_uuid=True), ForeignKey("roles.id"), nullable=False)
     title = Column(String(255), nullable=True)
+    # 下一条消息的 order_in_chat；发送消息时用 UPDATE ... RETURNING 原子地预留序号
+    next_order = Column(Integer, default=0, server_default="0", nullable=False)
+    # 早期对话的滚动摘要，以及已并入摘要的最后一条消息的 order_in_chat (-1 表示尚无摘要)
+    summary = Column(Text, nullable=True)
+    summarized_until = Column(Integer, default=-1, server_default="-1", nullable=False)
+    # 聊天列表用的冗余统计，与消息写入在同一条语句 (同一事务) 中更新，列表无需再逐个聊天查询消息
+    message_count = Column(Integer, default=0, server_default="0", nullable=False)
+    last_message_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
+    last_message_preview = Column(Text, nullable=True) # 最后一条消息的前 MESSAGE_PREVIEW_LENGTH 个字符
+    # 非空表示消息已被归档到 chat_archives，读取时再恢复 (见 app/archive.py)
+    archived_at = Column(DateTime(timezone=True), nullable=True)
+    # 进行中的对话轮次的租约 (见 app/chat_turns.py)：同一聊天同时只有一轮在读取历史和生成回复，执行者异常退出时租约到期自动失效
+    turn_token = Column(UUID(as_uuid=True), nullable=True)
+    turn_expires_at = Column(DateTime(timezone=True), nullable=True)
     created_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
     updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now(), nullable=False)
 
@@ -45,18 +62,90 @@ class Chat(Base):
     role = relationship("Role", back_populates="chats")
     messages = relationship("Message", back_populates="chat", order_by="Message.order_in_chat")
 
+MESSAGE_PREVIEW_LENGTH = 100
+
+# 聊天列表按 (last_message_at, id) 倒序做游标分页
+Index("ix_chats_user_id_last_message_at_id", Chat.user_id, Chat.last_message_at.desc(), Chat.id.desc())
+# 归档任务查找长期不活跃且尚未归档的聊天
+Index("ix_chats_last_message_at_unarchived", Chat.last_message_at, postgresql_where=Chat.archived_at.is_(None))
+
+# 中日韩文字 (假名、汉字、谚文) 的正则字符范围。这些文字不用空格分词，全文检索时每个字单独作为一个词，
+# 连续的字用词组查询 (<->) 匹配，相当于子串匹配；app/search.py 用同一个范围切分搜索词
+CJK_CHAR_RANGES = r"\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff"
+MESSAGE_SEARCH_VECTOR = f"to_tsvector('simple'::regconfig, regexp_replace(content, '([{CJK_CHAR_RANGES}])', ' \\1 ', 'g'))"
+
+# messages 按 chat_id 哈希分区，按聊天查询只扫描一个分区；分区数在迁移后不能再修改
+MESSAGE_PARTITIONS = 16
+
 class Message(Base):
     __tablename__ = "messages"
+    __table_args__ = (
+        # 保证同一聊天内序号唯一，同时作为按 chat_id 查询/排序的复合索引
+        UniqueConstraint("chat_id", "order_in_chat", name="uq_messages_chat_id_order_in_chat"),
+        # 分区子表 messages_p0 .. messages_p{MESSAGE_PARTITIONS-1} 由迁移创建
+        {"postgresql_partition_by": "HASH (chat_id)"},
+    )
 
     id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
-    chat_id = Column(UUID(as_uuid=True), ForeignKey("chats.id"), nullable=False)
+    # 分区表的主键必须包含分区键
+    chat_id = Column(UUID(as_uuid=True), ForeignKey("chats.id"), primary_key=True, nullable=False)
     sender_type = Column(String(10), nullable=False) # 'user' or 'ai'
     content = Column(Text, nullable=False)
     timestamp = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
     order_in_chat = Column(Integer, nullable=False)
+    # 搜索用的 tsvector，写入时由数据库计算并存储，GIN 索引由迁移创建；读取消息时默认不加载
+    search_vector = deferred(Column(TSVECTOR, Computed(MESSAGE_SEARCH_VECTOR, persisted=True)))
 
     chat = relationship("Chat", back_populates="messages")
 
+class ReplyJob(Base):
+    __tablename__ = "reply_jobs"
+
+    # 异步生成 AI 回复的任务 (见 app/reply_jobs.py)；用户消息在入队时已经保存
+    id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
+    chat_id = Column(UUID(as_uuid=True), ForeignKey("chats.id"), nullable=False)
+    user_id = Column(UUID(as_uuid=True), ForeignKey("users.id"), nullable=False)
+    order_in_chat = Column(Integer, nullable=False) # AI 回复的序号，用户消息是它的前一条
+    status = Column(String(10), server_default="queued", nullable=False) # queued / running / done / failed
+    attempts = Column(Integer, server_default="0", nullable=False)
+    # queued：最早可执行的时间 (重试退避)；running：租约到期时间，worker 异常退出后到期的任务会被重新领取
+    run_after = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
+    error = Column(Text, nullable=True)
+    created_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
+    updated_at = Column(DateTime(timezone=True), server_default=func.now(), onupdate=func.now(), nullable=False)
+
+# worker 领取任务时只扫描未完成的任务
+Index("ix_reply_jobs_pending_run_after", ReplyJob.run_after, postgresql_where=ReplyJob.status.in_(("queued", "running")))
+# 领取时检查同一聊天中是否有更早的未完成任务
+Index("ix_reply_jobs_pending_chat_id_order_in_chat", ReplyJob.chat_id, ReplyJob.order_in_chat, postgresql_where=ReplyJob.status.in_(("queued", "running")))
+
+class ChatArchive(Base):
+    __tablename__ = "chat_archives"
+
+    # 一个归档聊天的全部消息，zlib 压缩的 JSON
+    chat_id = Column(UUID(as_uuid=True), ForeignKey("chats.id"), primary_key=True)
+    message_count = Column(Integer, nullable=False)
+    payload = Column(LargeBinary, nullable=False)
+    archived_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
+
+class IdempotencyKey(Base):
+    __tablename__ = "idempotency_keys"
+
+    # 带 Idempotency-Key 头的请求及其结果 (见 app/idempotency.py)，同一用户重复提交同一个键时返回保存的结果
+    user_id = Column(UUID(as_uuid=True), ForeignKey("users.id"), primary_key=True)
+    key = Column(String(255), primary_key=True)
+    request_hash = Column(String(64), nullable=False) # 同一个键只能用于同一个请求
+    status = Column(String(10), server_default="pending", nullable=False) # pending / done
+    # 正在执行该请求的一方；pending 的租约到期后可被重试的请求接管，旧的执行者不能再写入结果
+    owner = Column(UUID(as_uuid=True), nullable=False)
+    locked_until = Column(DateTime(timezone=True), nullable=False)
+    response = Column(JSONB, nullable=True)
+    created_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
+    expires_at = Column(DateTime(timezone=True), nullable=False)
+
+# 定期清理过期的键
+Index("ix_idempotency_keys_expires_at", IdempotencyKey.expires_at)
+
 # ... (app/models.py 文件前面已有的模型定义) ...
 
 # 默认角色数据
@@ -87,11 +176,10 @@ DEFAULT_ROLES = [
     }
 ]
 
-def create_default_roles(db: Session):
-    for role_data in DEFAULT_ROLES:
-        # 检查角色是否已存在，避免重复创建
-        existing_role = db.query(Role).filter(Role.name == role_data["name"]).first()
-        if not existing_role:
-            db_role = Role(**role_data)
-            db.add(db_role)
-    db.commit()
\ No newline at end of file
+async def create_default_roles(db: Union[AsyncSession, AsyncConnection]):
+    """一条 INSERT ... ON CONFLICT (name) DO NOTHING 写入所有默认角色，已存在的同名角色保持不变。"""
+    await db.execute(
+        pg_insert(Role)
+        .values([{"id": uuid.uuid4(), **role_data} for role_data in DEFAULT_ROLES])
+        .on_conflict_do_nothing(index_elements=[Role.name])
+    )
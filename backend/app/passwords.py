@@ -0,0 +1,79 @@
+# app/passwords.py
+# bcrypt 哈希/校验放在独立的、有大小上限的进程池中执行，避免登录高峰占满默认线程池。
+# 本模块只依赖 passlib，子进程导入它时不会创建数据库引擎或 LLM 客户端。
+import asyncio
+import multiprocessing
+import os
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional, Tuple
+from passlib.context import CryptContext
+from dotenv import load_dotenv
+from . import metrics
+
+load_dotenv()
+
+# bcrypt 成本因子；修改后旧哈希会在用户下次登录时透明地重新计算
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+# 进程池大小，以及进程池中执行 + 排队的请求上限，超过上限直接拒绝 (503)
+PASSWORD_POOL_SIZE = int(os.getenv("PASSWORD_POOL_SIZE", str(min(4, os.cpu_count() or 1))))
+PASSWORD_QUEUE_LIMIT = int(os.getenv("PASSWORD_QUEUE_LIMIT", "64"))
+PASSWORD_RETRY_AFTER = int(os.getenv("PASSWORD_RETRY_AFTER", "1")) # 秒
+
+pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto", bcrypt__rounds=BCRYPT_ROUNDS)
+
+class PasswordPoolSaturated(Exception):
+    """进程池已满，调用方应返回 503 并带上 Retry-After。"""
+
+_pool: Optional[ProcessPoolExecutor] = None
+_in_flight = 0
+
+password_pool_in_flight = metrics.Gauge(
+    "password_pool_in_flight", "Password hash/verify calls running or queued in the process pool.",
+    function=lambda: _in_flight,
+)
+password_pool_capacity = metrics.Gauge(
+    "password_pool_capacity", "Maximum password calls admitted to the process pool.",
+    function=lambda: PASSWORD_QUEUE_LIMIT,
+)
+password_pool_rejected_total = metrics.Counter(
+    "password_pool_rejected_total", "Password calls rejected because the process pool was saturated.",
+)
+
+def _hash(password: str) -> str:
+    return pwd_context.hash(password)
+
+def _verify_and_update(password: str, hashed_password: str) -> Tuple[bool, Optional[str]]:
+    return pwd_context.verify_and_update(password, hashed_password)
+
+def _get_pool() -> ProcessPoolExecutor:
+    # 首次使用时才创建，避免导入模块 (以及 uvicorn --reload) 时就启动子进程。
+    # 使用 spawn：在带事件循环和线程的进程里 fork 不安全
+    global _pool
+    if _pool is None:
+        _pool = ProcessPoolExecutor(max_workers=PASSWORD_POOL_SIZE, mp_context=multiprocessing.get_context("spawn"))
+    return _pool
+
+async def _submit(fn, *args):
+    global _in_flight
+    if _in_flight >= PASSWORD_QUEUE_LIMIT:
+        password_pool_rejected_total.inc()
+        raise PasswordPoolSaturated()
+    _in_flight += 1
+    try:
+        return await asyncio.get_running_loop().run_in_executor(_get_pool(), fn, *args)
+    finally:
+        _in_flight -= 1
+
+async def hash_password(password: str) -> str:
+    return await _submit(_hash, password)
+
+async def verify_and_update(password: str, hashed_password: str) -> Tuple[bool, Optional[str]]:
+    """校验密码；若哈希参数已过时 (例如 BCRYPT_ROUNDS 改变)，同时返回新哈希，否则第二项为 None。"""
+    return await _submit(_verify_and_update, password, hashed_password)
+
+def shutdown_pool():
+    # 在应用关闭时调用：uvicorn 收到信号后会直接以该信号退出，不会执行 atexit 中的进程池清理
+    global _pool
+    if _pool is not None:
+        _pool.shutdown(wait=True, cancel_futures=True)
+        _pool = None
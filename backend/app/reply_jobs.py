@@ -0,0 +1,191 @@
+# app/reply_jobs.py
+# 异步回复任务。入队接口保存用户消息并写入 reply_jobs 后立即返回 202，HTTP worker 不再为整个 LLM 调用占着请求和数据库会话；
+# 每个进程内有 REPLY_JOB_WORKERS 个协程用 FOR UPDATE SKIP LOCKED 从表中领取任务并生成回复。
+# 任务领取时带租约，进程重启或崩溃后租约到期的任务会被其他 worker (或重启后的进程) 重新执行。
+# 同一聊天的任务按 order_in_chat 逐个领取，前一个任务结束 (完成或最终失败) 之前后面的任务不会被领取。
+import asyncio
+import datetime
+import logging
+import os
+import time
+import uuid
+from typing import Awaitable, Callable, Dict, List
+from sqlalchemy import exists, func, select, update
+from sqlalchemy.orm import aliased
+from sqlalchemy.engine import Row
+from dotenv import load_dotenv
+from . import metrics, models
+from .database import autocommit_engine
+
+load_dotenv()
+
+logger = logging.getLogger(__name__)
+
+REPLY_JOB_WORKERS = int(os.getenv("REPLY_JOB_WORKERS", "4"))                       # 每个进程并发执行的任务数，0 表示本进程不执行任务
+REPLY_JOB_POLL_INTERVAL = float(os.getenv("REPLY_JOB_POLL_INTERVAL", "1"))         # 队列为空时多久检查一次其他进程入队的任务 (秒)
+REPLY_JOB_LEASE_SECONDS = float(os.getenv("REPLY_JOB_LEASE_SECONDS", "300"))       # 租约时长，应大于一次回复生成的最长耗时
+REPLY_JOB_MAX_ATTEMPTS = int(os.getenv("REPLY_JOB_MAX_ATTEMPTS", "3"))
+REPLY_JOB_RETRY_DELAY = float(os.getenv("REPLY_JOB_RETRY_DELAY", "2"))             # 第 n 次失败后等待 REPLY_JOB_RETRY_DELAY * 2^(n-1) 秒再重试
+
+TERMINAL_STATUSES = ("done", "failed")
+
+reply_jobs_total = metrics.Counter("reply_jobs_total", "Reply jobs finished, by outcome.", ("status",))
+reply_jobs_running = metrics.Gauge("reply_jobs_running", "Reply jobs currently being processed by this process.")
+reply_job_queue_seconds = metrics.Histogram("reply_job_queue_seconds", "Time from enqueueing a reply job to a worker claiming it.")
+
+class JobFailed(Exception):
+    """不可重试的失败 (例如聊天已被删除)，任务直接标记为 failed。"""
+
+class JobDeferred(Exception):
+    """暂时不能执行 (例如聊天正被同步接口的一轮对话占用)，任务放回队列稍后再领取，不计入重试次数。"""
+
+async def claim(limit: int = 1) -> List[Row]:
+    """领取最多 limit 个到期的任务 (包括租约已过期的 running 任务) 并设置租约。
+
+    同一聊天中还有更早的未完成任务 (排队、退避或执行中) 时不领取，回复按用户消息的顺序生成。
+    """
+    earlier = aliased(models.ReplyJob)
+    pending = (
+        select(models.ReplyJob.id)
+        .where(
+            models.ReplyJob.status.in_(("queued", "running")),
+            models.ReplyJob.run_after <= func.now(),
+            ~exists().where(
+                earlier.chat_id == models.ReplyJob.chat_id,
+                earlier.order_in_chat < models.ReplyJob.order_in_chat,
+                earlier.status.in_(("queued", "running")),
+            ),
+        )
+        .order_by(models.ReplyJob.run_after)
+        .limit(limit)
+        .with_for_update(skip_locked=True)
+        .cte("pending")
+    )
+    stmt = (
+        update(models.ReplyJob)
+        .where(models.ReplyJob.id.in_(select(pending.c.id)))
+        .values(
+            status="running",
+            attempts=models.ReplyJob.attempts + 1,
+            run_after=func.now() + datetime.timedelta(seconds=REPLY_JOB_LEASE_SECONDS),
+        )
+        .returning(
+            models.ReplyJob.id, models.ReplyJob.chat_id, models.ReplyJob.user_id, models.ReplyJob.order_in_chat,
+            models.ReplyJob.attempts, models.ReplyJob.created_at, func.now().label("claimed_at"),
+        )
+    )
+    async with autocommit_engine.connect() as conn:
+        return (await conn.execute(stmt)).all()
+
+async def _finish(job: Row, status: str, error: str = None, retry_after: float = None, release_attempt: bool = False):
+    """记录一次执行的结果；attempts 作为防护令牌，租约过期后已被其他 worker 重新领取的任务不会被旧的执行者覆盖。"""
+    values = {"status": status, "error": error}
+    if retry_after is not None:
+        values["run_after"] = func.now() + datetime.timedelta(seconds=retry_after)
+    if release_attempt:
+        values["attempts"] = models.ReplyJob.attempts - 1
+    async with autocommit_engine.connect() as conn:
+        await conn.execute(
+            update(models.ReplyJob)
+            .where(models.ReplyJob.id == job.id, models.ReplyJob.attempts == job.attempts)
+            .values(**values)
+        )
+
+class ReplyJobPool:
+    def __init__(self, workers: int = REPLY_JOB_WORKERS):
+        self.workers = workers
+        self._handler: Callable[[Row], Awaitable[None]] = None
+        self._wakeup = asyncio.Event()
+        self._finished: Dict[uuid.UUID, asyncio.Event] = {}
+        self._tasks: List[asyncio.Task] = []
+
+    def start(self, handler: Callable[[Row], Awaitable[None]]):
+        """启动 worker 协程；handler 生成并保存一个任务的回复，抛出 JobFailed 表示不可重试的失败，JobDeferred 表示稍后再执行。"""
+        self._handler = handler
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        """停止 worker；正在执行的任务放回队列，由其他进程或重启后的进程继续。"""
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def notify(self):
+        """本进程刚入队了任务，唤醒空闲的 worker 立即领取，不必等到下一次轮询。"""
+        self._wakeup.set()
+
+    async def wait_finished(self, job_id: uuid.UUID, timeout: float):
+        """等待本进程完成该任务，最多 timeout 秒；任务在其他进程执行时只能等到超时，由调用方重新查询状态。"""
+        event = self._finished.setdefault(job_id, asyncio.Event())
+        try:
+            await asyncio.wait_for(event.wait(), timeout=timeout)
+        except asyncio.TimeoutError:
+            pass
+        finally:
+            if self._finished.get(job_id) is event and not event.is_set():
+                del self._finished[job_id]
+
+    async def _worker(self):
+        while True:
+            self._wakeup.clear()
+            try:
+                jobs = await claim(1)
+            except Exception:
+                logger.exception("Failed to claim reply jobs")
+                jobs = []
+            if not jobs:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=REPLY_JOB_POLL_INTERVAL)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            try:
+                await self._run(jobs[0])
+            except Exception:
+                # 记录结果失败 (例如数据库暂时不可用)：租约到期后任务会被重新领取
+                logger.exception("Failed to record reply job %s", jobs[0].id)
+
+    async def _run(self, job: Row):
+        reply_job_queue_seconds.observe(max(0.0, (job.claimed_at - job.created_at).total_seconds()))
+        if job.attempts > REPLY_JOB_MAX_ATTEMPTS:
+            # 租约多次到期 (例如每次执行都导致进程崩溃)，不再重试
+            await _finish(job, "failed", "Job lease expired too many times")
+            reply_jobs_total.inc(status="failed")
+            self._notify_finished(job.id)
+            return
+        reply_jobs_running.inc()
+        start = time.perf_counter()
+        try:
+            await self._handler(job)
+        except asyncio.CancelledError:
+            # 进程关闭：把任务放回队列并且不计入重试次数
+            await _finish(job, "queued", retry_after=0, release_attempt=True)
+            raise
+        except JobDeferred:
+            await _finish(job, "queued", retry_after=REPLY_JOB_POLL_INTERVAL, release_attempt=True)
+            reply_jobs_total.inc(status="deferred")
+        except JobFailed as e:
+            await _finish(job, "failed", str(e))
+            reply_jobs_total.inc(status="failed")
+        except Exception as e:
+            logger.warning("Reply job %s attempt %d failed after %.1fs", job.id, job.attempts, time.perf_counter() - start, exc_info=e)
+            if job.attempts < REPLY_JOB_MAX_ATTEMPTS:
+                await _finish(job, "queued", repr(e), retry_after=REPLY_JOB_RETRY_DELAY * 2 ** (job.attempts - 1))
+                reply_jobs_total.inc(status="retried")
+            else:
+                await _finish(job, "failed", repr(e))
+                reply_jobs_total.inc(status="failed")
+        else:
+            await _finish(job, "done")
+            reply_jobs_total.inc(status="done")
+        finally:
+            reply_jobs_running.dec()
+        self._notify_finished(job.id)
+
+    def _notify_finished(self, job_id: uuid.UUID):
+        event = self._finished.pop(job_id, None)
+        if event is not None:
+            event.set()
+
+pool = ReplyJobPool()
@@ -0,0 +1,98 @@
+# app/role_registry.py
+import asyncio
+import datetime
+import os
+import time
+import uuid
+from dataclasses import dataclass
+from typing import Dict, List, Optional, Tuple
+from sqlalchemy import select, func
+from sqlalchemy.ext.asyncio import AsyncSession
+from dotenv import load_dotenv
+from . import models, llm_service
+
+load_dotenv()
+
+# 每隔多少秒向数据库核对一次角色版本戳；其他 worker 修改角色后，最迟在这个间隔后生效
+ROLE_CACHE_CHECK_INTERVAL = float(os.getenv("ROLE_CACHE_CHECK_INTERVAL", "5"))
+
+@dataclass(frozen=True)
+class CachedRole:
+    """角色的只读快照，附带预先构建好的 prompt 前缀。字段与 schemas.RoleResponse 对应。"""
+    id: uuid.UUID
+    name: str
+    description: str
+    system_prompt: str
+    few_shot_examples: Optional[List[dict]]
+    is_active: bool
+    response_cache_enabled: bool
+    created_at: datetime.datetime
+    updated_at: datetime.datetime
+    prompt_prefix: Tuple[Dict[str, str], ...] # 系统提示 + few-shot，请勿修改
+    prefix_tokens: int
+
+def _snapshot(role: models.Role) -> CachedRole:
+    prompt_prefix = llm_service.build_prompt_prefix(role.system_prompt, role.few_shot_examples)
+    return CachedRole(
+        id=role.id,
+        name=role.name,
+        description=role.description,
+        system_prompt=role.system_prompt,
+        few_shot_examples=role.few_shot_examples,
+        is_active=role.is_active,
+        response_cache_enabled=role.response_cache_enabled,
+        created_at=role.created_at,
+        updated_at=role.updated_at,
+        prompt_prefix=prompt_prefix,
+        prefix_tokens=llm_service.count_prompt_tokens(prompt_prefix),
+    )
+
+class RoleRegistry:
+    """进程内的角色缓存。
+
+    版本戳为 roles 表的 (行数, 最大 updated_at)，任何 worker 新增、修改或删除角色都会改变它。
+    缓存每隔 ROLE_CACHE_CHECK_INTERVAL 秒用一条聚合查询核对版本戳，变化时整体重新加载；
+    本进程内修改角色后调用 invalidate() 立即失效。
+    """
+
+    def __init__(self, check_interval: float = ROLE_CACHE_CHECK_INTERVAL):
+        self.check_interval = check_interval
+        self._roles: Dict[uuid.UUID, CachedRole] = {}
+        self._active: List[CachedRole] = []
+        self._version = None
+        self._checked_at = 0.0
+        self._lock = asyncio.Lock()
+
+    def invalidate(self):
+        self._version = None
+        self._checked_at = 0.0
+
+    async def _ensure_fresh(self, db: AsyncSession):
+        if self._version is not None and time.monotonic() - self._checked_at < self.check_interval:
+            return
+        async with self._lock:
+            # 等锁期间其他协程可能已经刷新过
+            if self._version is not None and time.monotonic() - self._checked_at < self.check_interval:
+                return
+            result = await db.execute(select(func.count(models.Role.id), func.max(models.Role.updated_at)))
+            version = tuple(result.one())
+            if version != self._version:
+                result = await db.execute(select(models.Role).order_by(models.Role.created_at))
+                roles = [_snapshot(role) for role in result.scalars().all()]
+                self._roles = {role.id: role for role in roles}
+                self._active = [role for role in roles if role.is_active]
+                self._version = version
+            self._checked_at = time.monotonic()
+
+    async def get(self, db: AsyncSession, role_id: uuid.UUID, active_only: bool = False) -> Optional[CachedRole]:
+        await self._ensure_fresh(db)
+        role = self._roles.get(role_id)
+        if role is None or (active_only and not role.is_active):
+            return None
+        return role
+
+    async def active_roles(self, db: AsyncSession) -> List[CachedRole]:
+        await self._ensure_fresh(db)
+        return self._active
+
+role_registry = RoleRegistry()
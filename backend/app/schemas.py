@@ -1,7 +1,7 @@
 # app/schemas.py
 import datetime
 import uuid
-from typing import List, Literal, Optional
+from typing import List, Literal, Optional, Tuple
 from pydantic import BaseModel, EmailStr, Field
 
 # --- User Schemas ---
@@ -36,6 +36,7 @@ class RoleBase(BaseModel):#AI角色创建
     system_prompt: str
     few_shot_examples: Optional[List[dict]] = None # 存储 JSON 列表
     is_active: bool = True
+    response_cache_enabled: bool = False # 开启后，相同的开场对话会复用缓存的 LLM 回复
 
 class RoleCreate(RoleBase):
     pass
@@ -65,6 +66,10 @@ class MessageResponse(MessageBase):
     class Config:
         from_attributes = True
 
+class MessagePage(BaseModel):
+    items: List[MessageResponse]
+    next_cursor: Optional[int] = None # 继续翻页时作为 before/after 传入的 order_in_chat，没有更多数据时为 None
+
 # --- Chat Schemas ---
 class ChatBase(BaseModel):
     title: Optional[str] = None
@@ -78,7 +83,41 @@ class ChatResponse(ChatBase):
     role_id: uuid.UUID
     created_at: datetime.datetime
     updated_at: datetime.datetime
+    message_count: int = 0
+    last_message_at: datetime.datetime
+    last_message_preview: Optional[str] = None
     # messages: List[MessageResponse] = [] # 可以选择在获取聊天详情时包含消息列表
 
     class Config:
         from_attributes = True
+
+class ChatPage(BaseModel):
+    items: List[ChatResponse]
+    next_cursor: Optional[str] = None # 继续翻页时作为 before/after 传入的游标，没有更多数据时为 None
+
+# --- Reply Job Schemas ---
+class ReplyJobResponse(BaseModel):
+    id: uuid.UUID
+    chat_id: uuid.UUID
+    status: Literal["queued", "running", "done", "failed"]
+    order_in_chat: int # AI 回复的序号
+    attempts: int
+    error: Optional[str] = None
+    reply: Optional[MessageResponse] = None # status 为 done 时的 AI 回复
+    created_at: datetime.datetime
+    updated_at: datetime.datetime
+
+# --- Search Schemas ---
+class SearchHit(BaseModel):
+    id: uuid.UUID
+    chat_id: uuid.UUID
+    chat_title: Optional[str] = None
+    sender_type: Literal["user", "ai"]
+    timestamp: datetime.datetime
+    order_in_chat: int
+    snippet: str # 命中位置附近的消息片段
+    highlights: List[Tuple[int, int]] = [] # snippet 中命中的区间 [start, end)
+
+class SearchPage(BaseModel):
+    items: List[SearchHit]
+    next_cursor: Optional[str] = None # 继续翻页时作为 cursor 传入，没有更多结果时为 None
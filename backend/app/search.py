@@ -0,0 +1,105 @@
+# app/search.py
+# 聊天记录搜索。内容是中英文混合的，中文没有空格分词，PostgreSQL 的 simple 解析器会把一整段中文当成一个词；
+# 所以 messages.search_vector 在建索引前把每个中日韩文字单独切成一个词 (见 models.MESSAGE_SEARCH_VECTOR)，
+# 中文搜索词按连续的字做词组匹配 (等价于子串匹配)，英文等按词匹配，单个词时按前缀匹配。
+# 匹配和排序都使用存储的 tsvector 及其 GIN 索引，不在查询时重新分词；按 (相关度, 时间, id) 游标分页。
+# 摘要片段和高亮位置在 Python 中计算，对中文子串同样适用。
+import base64
+import datetime
+import os
+import re
+import uuid
+from typing import List, Optional, Tuple
+from sqlalchemy import Select, func, literal, select, tuple_
+from dotenv import load_dotenv
+from . import models
+
+load_dotenv()
+
+SEARCH_SNIPPET_CHARS = int(os.getenv("SEARCH_SNIPPET_CHARS", "120")) # 返回的片段长度 (字符)
+SEARCH_MAX_TERMS = 8
+ELLIPSIS = "…"
+
+# 不含中日韩文字的单个词，按前缀匹配 (输入到一半的词也能搜到)
+_WORD = re.compile(rf"[^\W_{models.CJK_CHAR_RANGES}]+")
+_CJK_CHAR = re.compile(rf"[{models.CJK_CHAR_RANGES}]")
+
+def parse_terms(q: str) -> List[str]:
+    """按空白拆分搜索词并去重 (不区分大小写)，所有词都要命中 (AND)；不含任何文字或数字的词被忽略。"""
+    terms = []
+    seen = set()
+    for term in q.split():
+        key = term.casefold()
+        if key not in seen and (_WORD.search(term) or _CJK_CHAR.search(term)):
+            seen.add(key)
+            terms.append(term)
+    return terms[:SEARCH_MAX_TERMS]
+
+def _term_query(term: str):
+    if _WORD.fullmatch(term):
+        return func.to_tsquery("simple", literal(f"{term}:*"))
+    # 与 search_vector 相同的方式切分后做词组查询，标点和空格只起分隔作用
+    spaced = func.regexp_replace(literal(term), f"([{models.CJK_CHAR_RANGES}])", " \\1 ", "g")
+    return func.phraseto_tsquery("simple", spaced)
+
+def tsquery(terms: List[str]):
+    query = _term_query(terms[0])
+    for term in terms[1:]:
+        query = query.op("&&")(_term_query(term))
+    return query
+
+def encode_cursor(rank: float, timestamp: datetime.datetime, message_id: uuid.UUID) -> str:
+    raw = f"{rank!r}|{timestamp.isoformat()}|{message_id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode()
+
+def decode_cursor(cursor: str) -> Tuple[float, datetime.datetime, uuid.UUID]:
+    """解析 next_cursor，格式不对时抛出 ValueError。"""
+    rank, timestamp, message_id = base64.urlsafe_b64decode(cursor.encode()).decode().split("|")
+    return float(rank), datetime.datetime.fromisoformat(timestamp), uuid.UUID(message_id)
+
+def build_query(
+    user_id: uuid.UUID,
+    terms: List[str],
+    chat_id: Optional[uuid.UUID] = None,
+    after: Optional[Tuple[float, datetime.datetime, uuid.UUID]] = None,
+) -> Select:
+    """当前用户聊天中命中所有搜索词的消息，按相关度、时间、id 倒序；after 为上一页最后一条的 (rank, timestamp, id)。
+
+    search_vector @@ 查询由 GIN 索引支撑 (btree_gin 可用时索引包含 chat_id，可以逐个聊天查找)；
+    通过 chats 主键连接限定为该用户的聊天。已归档聊天的消息不在 messages 中，不会被搜到。
+    """
+    query_vector = tsquery(terms)
+    rank = func.ts_rank(models.Message.search_vector, query_vector)
+    query = (
+        select(
+            models.Message.id, models.Message.chat_id, models.Message.sender_type, models.Message.content,
+            models.Message.timestamp, models.Message.order_in_chat,
+            models.Chat.title.label("chat_title"), rank.label("rank"),
+        )
+        .join(models.Chat, models.Chat.id == models.Message.chat_id)
+        .where(models.Chat.user_id == user_id, models.Message.search_vector.op("@@")(query_vector))
+        .order_by(rank.desc(), models.Message.timestamp.desc(), models.Message.id.desc())
+    )
+    if chat_id is not None:
+        query = query.where(models.Message.chat_id == chat_id)
+    if after is not None:
+        query = query.where(tuple_(rank, models.Message.timestamp, models.Message.id) < tuple_(*after))
+    return query
+
+def snippet(content: str, terms: List[str], length: int = SEARCH_SNIPPET_CHARS) -> Tuple[str, List[Tuple[int, int]]]:
+    """截取第一个命中位置附近的片段，返回 (片段, 片段内命中区间 [start, end) 的列表)。"""
+    pattern = re.compile("|".join(re.escape(term) for term in sorted(terms, key=len, reverse=True)), re.IGNORECASE)
+    matches = list(pattern.finditer(content))
+    first = matches[0].start() if matches else 0
+    # 命中位置前保留约三分之一的上下文
+    start = max(0, min(first - length // 3, len(content) - length))
+    end = min(len(content), start + length)
+    prefix = ELLIPSIS if start > 0 else ""
+    suffix = ELLIPSIS if end < len(content) else ""
+    offset = len(prefix) - start
+    highlights = [
+        (max(m.start(), start) + offset, min(m.end(), end) + offset)
+        for m in matches
+        if m.start() < end and m.end() > start
+    ]
+    return prefix + content[start:end] + suffix, highlights
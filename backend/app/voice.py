@@ -0,0 +1,321 @@
+# app/voice.py
+# 语音聊天的流水线组件：端点检测 (判断一句话说完)、语音识别 (STT)、按句切分 LLM 输出和语音合成 (TTS)。
+# 各阶段重叠执行以降低首个音频的延迟：说话过程中按停顿分段先行识别，检测到发言结束立即调用 LLM，
+# LLM 的 token 还在生成时就把已经完整的句子逐句送去合成。
+# STT / TTS 引擎可插拔，由 VOICE_STT_ENGINE / VOICE_TTS_ENGINE 选择；stub 引擎不依赖外部服务，用于本地开发和测试。
+import asyncio
+import io
+import math
+import os
+import re
+import sys
+import time
+import wave
+from array import array
+from typing import AsyncIterator, Callable, Dict, List, Optional
+from dotenv import load_dotenv
+from . import llm_service, metrics
+
+load_dotenv()
+
+VOICE_STT_ENGINE = os.getenv("VOICE_STT_ENGINE", "stub")
+VOICE_TTS_ENGINE = os.getenv("VOICE_TTS_ENGINE", "stub")
+VOICE_SAMPLE_RATE = int(os.getenv("VOICE_SAMPLE_RATE", "16000"))                 # 客户端上传的音频：PCM16 单声道小端
+VOICE_VAD_THRESHOLD = float(os.getenv("VOICE_VAD_THRESHOLD", "500"))             # 音频块的 RMS 达到该值视为有人声
+VOICE_PAUSE_MS = float(os.getenv("VOICE_PAUSE_MS", "250"))                       # 句中停顿：先识别已说完的一段
+VOICE_END_SILENCE_MS = float(os.getenv("VOICE_END_SILENCE_MS", "700"))           # 静音这么久视为发言结束
+VOICE_MAX_UTTERANCE_SECONDS = float(os.getenv("VOICE_MAX_UTTERANCE_SECONDS", "30"))
+VOICE_MAX_SENTENCE_CHARS = int(os.getenv("VOICE_MAX_SENTENCE_CHARS", "60"))      # 没有句末标点时，累积到这么长就在逗号处切开送去合成
+VOICE_ENGINE_TIMEOUT = float(os.getenv("VOICE_ENGINE_TIMEOUT", "30"))            # 一次识别或合成请求的超时 (秒)
+VOICE_STT_MODEL = os.getenv("VOICE_STT_MODEL", "whisper-1")
+VOICE_STT_LANGUAGE = os.getenv("VOICE_STT_LANGUAGE")
+VOICE_TTS_MODEL = os.getenv("VOICE_TTS_MODEL", "tts-1")
+VOICE_TTS_VOICE = os.getenv("VOICE_TTS_VOICE", "alloy")
+VOICE_STUB_STT_LATENCY = float(os.getenv("VOICE_STUB_STT_LATENCY", "0"))         # stub 引擎模拟的处理耗时 (秒)
+VOICE_STUB_TTS_LATENCY = float(os.getenv("VOICE_STUB_TTS_LATENCY", "0"))
+
+AUDIO_CHUNK_BYTES = 4096
+MIN_SEGMENT_SECONDS = 0.3 # 短于这个长度的分段不单独识别，并入下一段
+
+# stage 为相邻两个事件之间的耗时；voice_to_voice 是从用户说完到开始播放回复的总延迟
+voice_stage_latency_seconds = metrics.Histogram("voice_stage_latency_seconds", "Latency between stages of a voice chat turn.", ("stage",))
+
+VOICE_STAGES = (
+    ("stt", "utterance_end", "transcript"),
+    ("llm_first_token", "transcript", "first_token"),
+    ("first_sentence", "first_token", "first_sentence"),
+    ("tts_first_audio", "first_sentence", "first_audio"),
+    ("voice_to_voice", "utterance_end", "first_audio"),
+)
+
+class StageClock:
+    """记录一轮语音对话中各事件第一次发生的时间；创建时即记为发言结束。"""
+    def __init__(self):
+        self._marks: Dict[str, float] = {"utterance_end": time.perf_counter()}
+
+    def mark(self, event: str):
+        self._marks.setdefault(event, time.perf_counter())
+
+    def observe(self) -> Dict[str, float]:
+        """把已经发生的阶段耗时写入指标，并返回 stage -> 秒 (发给客户端)。"""
+        latency = {}
+        for stage, start, end in VOICE_STAGES:
+            if start in self._marks and end in self._marks:
+                seconds = self._marks[end] - self._marks[start]
+                voice_stage_latency_seconds.observe(seconds, stage=stage)
+                latency[stage] = round(seconds, 4)
+        return latency
+
+class Endpointer:
+    """基于能量的端点检测。process 返回 "start" (开始说话)、"pause" (句中停顿)、"end" (发言结束) 或 None。"""
+    def __init__(
+        self,
+        sample_rate: int = VOICE_SAMPLE_RATE,
+        threshold: float = VOICE_VAD_THRESHOLD,
+        pause_ms: float = VOICE_PAUSE_MS,
+        end_silence_ms: float = VOICE_END_SILENCE_MS,
+        max_seconds: float = VOICE_MAX_UTTERANCE_SECONDS,
+    ):
+        self.sample_rate = sample_rate
+        self.threshold = threshold
+        self.pause_seconds = pause_ms / 1000
+        self.end_silence_seconds = end_silence_ms / 1000
+        self.max_seconds = max_seconds
+        self.reset()
+
+    def reset(self):
+        self.speaking = False
+        self.duration = 0.0
+        self._silence = 0.0
+        self._paused = False
+        self._carry = b""
+
+    @property
+    def in_speech(self) -> bool:
+        """已经开始说话且不在停顿中；停顿期间的静音不必送去识别。"""
+        return self.speaking and not self._paused
+
+    def process(self, pcm: bytes) -> Optional[str]:
+        data = self._carry + pcm
+        # 分块边界可能切在一个采样中间，多出的字节留到下一块
+        cut = len(data) - len(data) % 2
+        data, self._carry = data[:cut], data[cut:]
+        samples = array("h")
+        samples.frombytes(data)
+        if not samples:
+            return None
+        if sys.byteorder == "big":
+            samples.byteswap()
+        seconds = len(samples) / self.sample_rate
+        self.duration += seconds
+        rms = math.sqrt(sum(s * s for s in samples) / len(samples))
+        if rms >= self.threshold:
+            started = not self.speaking
+            self.speaking = True
+            self._silence = 0.0
+            self._paused = False
+            if started:
+                return "start"
+        elif self.speaking:
+            self._silence += seconds
+        if not self.speaking:
+            return None
+        if self._silence >= self.end_silence_seconds or self.duration >= self.max_seconds:
+            return "end"
+        if self._silence >= self.pause_seconds and not self._paused:
+            self._paused = True
+            return "pause"
+        return None
+
+_SENTENCE_END = re.compile(r"[。！？!?；;…\n]+[”」』）)\"']*|\.(?=\s)")
+_SOFT_BREAK = re.compile(r"[，,、：:]")
+
+class SentenceSplitter:
+    """把流式的 LLM token 切成可以单独合成的句子。"""
+    def __init__(self, max_chars: int = VOICE_MAX_SENTENCE_CHARS):
+        self.max_chars = max_chars
+        self._buffer = ""
+
+    def feed(self, text: str) -> List[str]:
+        self._buffer += text
+        sentences = []
+        while True:
+            match = _SENTENCE_END.search(self._buffer)
+            if match is None:
+                break
+            self._take(match.end(), sentences)
+        if len(self._buffer) >= self.max_chars:
+            # 很长的一句先在最后一个逗号处切开，否则整段切开，避免第一句的合成等太久
+            breaks = list(_SOFT_BREAK.finditer(self._buffer))
+            self._take(breaks[-1].end() if breaks else len(self._buffer), sentences)
+        return sentences
+
+    def flush(self) -> List[str]:
+        sentences = []
+        self._take(len(self._buffer), sentences)
+        return sentences
+
+    def _take(self, end: int, sentences: List[str]):
+        sentence, self._buffer = self._buffer[:end].strip(), self._buffer[end:]
+        # 只有标点的片段 (例如单独的换行) 不需要合成
+        if any(c.isalnum() for c in sentence):
+            sentences.append(sentence)
+
+def _pcm_seconds(size: int, sample_rate: int = VOICE_SAMPLE_RATE) -> float:
+    return size / 2 / sample_rate
+
+def _wav(pcm: bytes, sample_rate: int = VOICE_SAMPLE_RATE) -> bytes:
+    buffer = io.BytesIO()
+    with wave.open(buffer, "wb") as out:
+        out.setnchannels(1)
+        out.setsampwidth(2)
+        out.setframerate(sample_rate)
+        out.writeframes(pcm)
+    return buffer.getvalue()
+
+def _join_text(parts: List[str]) -> str:
+    """拼接分段识别的结果：英文单词之间补空格，中文直接相连。"""
+    text = ""
+    for part in parts:
+        if text and part and text[-1].isascii() and text[-1].isalnum() and part[0].isascii() and part[0].isalnum():
+            text += " "
+        text += part
+    return text
+
+# --- 语音识别 ---
+
+class SpeechToText:
+    """一次发言的识别会话：音频分块送入，发言结束时取得完整文本。每次发言创建一个新的会话。"""
+    async def feed(self, pcm: bytes) -> Optional[str]:
+        """送入一块音频；返回到目前为止的部分识别结果，没有更新时返回 None。"""
+        raise NotImplementedError
+
+    async def pause(self):
+        """检测到句中停顿：可以先识别已经收到的部分。"""
+
+    async def finish(self) -> str:
+        raise NotImplementedError
+
+    def close(self):
+        """放弃该会话 (连接断开)，取消仍在进行的识别。"""
+
+class StubSpeechToText(SpeechToText):
+    """不做真正的识别，按收到的音频时长生成确定的文本。"""
+    def __init__(self):
+        self._bytes = 0
+        self._reported = -1
+
+    async def feed(self, pcm: bytes) -> Optional[str]:
+        self._bytes += len(pcm)
+        tenths = int(_pcm_seconds(self._bytes) * 10)
+        if tenths == self._reported:
+            return None
+        self._reported = tenths
+        return self._text()
+
+    async def finish(self) -> str:
+        if VOICE_STUB_STT_LATENCY:
+            await asyncio.sleep(VOICE_STUB_STT_LATENCY)
+        return self._text()
+
+    def _text(self) -> str:
+        return f"这是一段 {_pcm_seconds(self._bytes):.1f} 秒的语音消息"
+
+class OpenAISpeechToText(SpeechToText):
+    """OpenAI 兼容的转写接口 (/audio/transcriptions)。该接口不支持流式输入，
+    所以每遇到一次句中停顿就把这一段单独送去识别，发言结束时只需等待最后一段。"""
+    def __init__(self):
+        self._segment = bytearray()
+        self._tasks: List[asyncio.Task] = []
+        self._reported = 0
+
+    async def feed(self, pcm: bytes) -> Optional[str]:
+        self._segment += pcm
+        # 已完成识别的前若干段作为部分结果
+        done = 0
+        while done < len(self._tasks) and self._tasks[done].done() and not self._tasks[done].cancelled() and self._tasks[done].exception() is None:
+            done += 1
+        if done == self._reported:
+            return None
+        self._reported = done
+        return _join_text([task.result() for task in self._tasks[:done]])
+
+    async def pause(self):
+        if _pcm_seconds(len(self._segment)) >= MIN_SEGMENT_SECONDS:
+            self._tasks.append(asyncio.create_task(self._transcribe(bytes(self._segment))))
+            self._segment.clear()
+
+    async def finish(self) -> str:
+        if self._segment:
+            self._tasks.append(asyncio.create_task(self._transcribe(bytes(self._segment))))
+            self._segment.clear()
+        try:
+            return _join_text(list(await asyncio.gather(*self._tasks)))
+        finally:
+            self.close()
+
+    def close(self):
+        for task in self._tasks:
+            task.cancel()
+
+    async def _transcribe(self, pcm: bytes) -> str:
+        kwargs = {"language": VOICE_STT_LANGUAGE} if VOICE_STT_LANGUAGE else {}
+        result = await asyncio.wait_for(
+            llm_service.client.audio.transcriptions.create(model=VOICE_STT_MODEL, file=("segment.wav", _wav(pcm)), **kwargs),
+            timeout=VOICE_ENGINE_TIMEOUT,
+        )
+        return result.text.strip()
+
+# --- 语音合成 ---
+
+class TextToSpeech:
+    """把一句文本合成为音频，分块产出；format 告诉客户端如何播放。"""
+    format = "pcm16/16000"
+
+    def synthesize(self, text: str) -> AsyncIterator[bytes]:
+        raise NotImplementedError
+
+class StubTextToSpeech(TextToSpeech):
+    """生成与文本长度成比例的静音 PCM16，每个字约 0.1 秒。"""
+    format = f"pcm16/{VOICE_SAMPLE_RATE}"
+
+    async def synthesize(self, text: str) -> AsyncIterator[bytes]:
+        if VOICE_STUB_TTS_LATENCY:
+            await asyncio.sleep(VOICE_STUB_TTS_LATENCY)
+        remaining = len(text) * VOICE_SAMPLE_RATE // 10 * 2
+        while remaining > 0:
+            size = min(AUDIO_CHUNK_BYTES, remaining)
+            remaining -= size
+            yield b"\0" * size
+
+class OpenAITextToSpeech(TextToSpeech):
+    """OpenAI 兼容的合成接口 (/audio/speech)，以流式读取响应，第一块音频到达即可推送。"""
+    format = "pcm16/24000"
+
+    async def synthesize(self, text: str) -> AsyncIterator[bytes]:
+        async with llm_service.client.audio.speech.with_streaming_response.create(
+            model=VOICE_TTS_MODEL, voice=VOICE_TTS_VOICE, input=text, response_format="pcm", timeout=VOICE_ENGINE_TIMEOUT,
+        ) as response:
+            async for chunk in response.iter_bytes(AUDIO_CHUNK_BYTES):
+                yield chunk
+
+# 引擎注册表：名称 -> 工厂。可以在启动前注册其他实现，例如 STT_ENGINES["local"] = MyRecognizer
+STT_ENGINES: Dict[str, Callable[[], SpeechToText]] = {"stub": StubSpeechToText, "openai": OpenAISpeechToText}
+TTS_ENGINES: Dict[str, Callable[[], TextToSpeech]] = {"stub": StubTextToSpeech, "openai": OpenAITextToSpeech}
+
+_tts: Optional[TextToSpeech] = None
+
+def new_stt() -> SpeechToText:
+    try:
+        return STT_ENGINES[VOICE_STT_ENGINE]()
+    except KeyError:
+        raise ValueError(f"Unknown VOICE_STT_ENGINE: {VOICE_STT_ENGINE}") from None
+
+def tts_engine() -> TextToSpeech:
+    global _tts
+    if _tts is None:
+        try:
+            _tts = TTS_ENGINES[VOICE_TTS_ENGINE]()
+        except KeyError:
+            raise ValueError(f"Unknown VOICE_TTS_ENGINE: {VOICE_TTS_ENGINE}") from None
+    return _tts
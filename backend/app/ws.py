@@ -0,0 +1,114 @@
+# app/ws.py
+# WebSocket 连接的发送端：每个连接一个有界发送队列和一个发送协程，外加心跳。
+# 队列满时生产者 (例如正在推送 token 的对话) 会被挂起，从而把客户端的读取速度反压到上游 LLM 流；
+# 客户端长时间不读取时断开连接，而不是在服务端无限堆积数据。
+import asyncio
+import json
+import os
+import time
+from typing import Union
+from fastapi import WebSocket
+from starlette.websockets import WebSocketDisconnect, WebSocketState
+from dotenv import load_dotenv
+from . import metrics
+
+load_dotenv()
+
+WS_SEND_QUEUE_SIZE = int(os.getenv("WS_SEND_QUEUE_SIZE", "256"))     # 每个连接最多缓存的待发送帧数
+WS_SEND_TIMEOUT = float(os.getenv("WS_SEND_TIMEOUT", "10"))          # 队列满时生产者最多等待多久 (秒)，超时视为慢消费者并断开
+WS_HEARTBEAT_INTERVAL = float(os.getenv("WS_HEARTBEAT_INTERVAL", "20"))
+WS_IDLE_TIMEOUT = float(os.getenv("WS_IDLE_TIMEOUT", "60"))          # 这么久没有收到客户端任何帧 (包括 pong) 就断开
+
+# 应用自定义的关闭码 (4000-4999)
+CLOSE_UNAUTHORIZED = 4401
+CLOSE_NOT_FOUND = 4404
+CLOSE_IDLE_TIMEOUT = 4408
+CLOSE_SLOW_CONSUMER = 4409
+
+ws_connections = metrics.Gauge("ws_connections", "Open WebSocket chat connections.")
+ws_frames_sent_total = metrics.Counter("ws_frames_sent_total", "Frames sent over WebSocket chat connections.", ("type",))
+ws_disconnects_total = metrics.Counter("ws_disconnects_total", "WebSocket chat connections closed by the server, by reason.", ("reason",))
+
+class ChannelClosed(Exception):
+    """连接已经关闭 (客户端断开或被服务端断开)，不能再发送。"""
+
+class WebSocketChannel:
+    def __init__(self, websocket: WebSocket, queue_size: int = WS_SEND_QUEUE_SIZE):
+        self.websocket = websocket
+        self.last_received = time.monotonic()
+        self._queue: "asyncio.Queue[Union[str, bytes]]" = asyncio.Queue(maxsize=queue_size)
+        self._closed = asyncio.Event()
+        self._tasks = []
+
+    @property
+    def closed(self) -> bool:
+        return self._closed.is_set()
+
+    def start(self):
+        self._tasks = [asyncio.create_task(self._sender()), asyncio.create_task(self._heartbeat())]
+        ws_connections.inc()
+
+    async def wait_closed(self):
+        await self._closed.wait()
+
+    def touch(self):
+        """收到客户端的任意帧时调用，用于空闲检测。"""
+        self.last_received = time.monotonic()
+
+    async def send(self, frame: dict):
+        """把一帧放入发送队列；队列满时等待，超过 WS_SEND_TIMEOUT 则断开连接并抛出 ChannelClosed。"""
+        await self._put(json.dumps(frame, ensure_ascii=False), frame.get("type", ""))
+
+    async def send_bytes(self, data: bytes):
+        """发送一个二进制帧 (语音聊天的音频)，与文本帧共用发送队列，保持先后顺序和反压。"""
+        await self._put(data, "binary")
+
+    async def _put(self, data: Union[str, bytes], frame_type: str):
+        if self.closed:
+            raise ChannelClosed()
+        try:
+            await asyncio.wait_for(self._queue.put(data), timeout=WS_SEND_TIMEOUT)
+        except asyncio.TimeoutError:
+            await self.close(CLOSE_SLOW_CONSUMER, "slow_consumer")
+            raise ChannelClosed() from None
+        ws_frames_sent_total.inc(type=frame_type)
+
+    async def close(self, code: int = 1000, reason: str = "normal"):
+        if self.closed:
+            return
+        self._closed.set()
+        ws_connections.dec()
+        if reason != "normal":
+            ws_disconnects_total.inc(reason=reason)
+        for task in self._tasks:
+            if task is not asyncio.current_task():
+                task.cancel()
+        if self.websocket.application_state == WebSocketState.CONNECTED:
+            try:
+                await self.websocket.close(code=code, reason=reason)
+            except (RuntimeError, WebSocketDisconnect):
+                pass # 客户端已经断开
+
+    async def _sender(self):
+        try:
+            while True:
+                data = await self._queue.get()
+                if isinstance(data, bytes):
+                    await self.websocket.send_bytes(data)
+                else:
+                    await self.websocket.send_text(data)
+        except (WebSocketDisconnect, RuntimeError):
+            await self.close() # 客户端已断开
+
+    async def _heartbeat(self):
+        while True:
+            await asyncio.sleep(WS_HEARTBEAT_INTERVAL)
+            if time.monotonic() - self.last_received > WS_IDLE_TIMEOUT:
+                await self.close(CLOSE_IDLE_TIMEOUT, "idle_timeout")
+                return
+            # 心跳不排队等待：队列已满说明客户端读得慢，下一轮再发
+            try:
+                self._queue.put_nowait(json.dumps({"type": "ping", "ts": time.time()}))
+                ws_frames_sent_total.inc(type="ping")
+            except asyncio.QueueFull:
+                pass
@@ -0,0 +1,91 @@
+# bench/fake_llm_server.py
+# 兼容 OpenAI /v1/chat/completions 的假 LLM 服务，用于基准测试和本地联调。
+# 用法: python bench/fake_llm_server.py --port 9999 --latency 0.5 --token-rate 50 --error-rate 0.01
+import argparse
+import asyncio
+import json
+import os
+import random
+import time
+import uuid
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, StreamingResponse
+import uvicorn
+
+# 配置也可以通过环境变量传入，便于用 uvicorn 直接启动: uvicorn bench.fake_llm_server:app
+LATENCY = float(os.getenv("FAKE_LLM_LATENCY", "0.5"))         # 首个 token 之前的延迟 (秒)
+TOKEN_RATE = float(os.getenv("FAKE_LLM_TOKEN_RATE", "50"))     # 每秒生成的 token 数，0 表示不限
+ERROR_RATE = float(os.getenv("FAKE_LLM_ERROR_RATE", "0"))      # 返回 500 的概率
+REPLY_TOKENS = int(os.getenv("FAKE_LLM_REPLY_TOKENS", "60"))   # 每条回复的 token 数
+
+app = FastAPI(title="Fake OpenAI-compatible LLM")
+
+_words = ["嘿", "！", "我", "是", "你", "的", "好", "朋友", "，", "今天", "纽约", "的", "天气", "不错", "。", " web", " slinging", " is", " fun", "!"]
+
+def _reply_tokens():
+    return [random.choice(_words) for _ in range(REPLY_TOKENS)]
+
+def _usage(body: dict, completion_tokens: int) -> dict:
+    prompt_tokens = sum(len(str(m.get("content", ""))) for m in body.get("messages", [])) // 2
+    return {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "total_tokens": prompt_tokens + completion_tokens}
+
+def _chunk(body: dict, completion_id: str, delta: dict, finish_reason=None) -> str:
+    data = {
+        "id": completion_id,
+        "object": "chat.completion.chunk",
+        "created": int(time.time()),
+        "model": body.get("model", "fake"),
+        "choices": [{"index": 0, "delta": delta, "finish_reason": finish_reason}],
+    }
+    return f"data: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+@app.post("/v1/chat/completions")
+async def chat_completions(request: Request):
+    body = await request.json()
+    if random.random() < ERROR_RATE:
+        return JSONResponse(status_code=500, content={"error": {"message": "injected failure", "type": "server_error"}})
+
+    tokens = _reply_tokens()
+    completion_id = f"chatcmpl-{uuid.uuid4().hex}"
+    per_token = 1 / TOKEN_RATE if TOKEN_RATE > 0 else 0
+
+    if body.get("stream"):
+        async def stream():
+            await asyncio.sleep(LATENCY)
+            yield _chunk(body, completion_id, {"role": "assistant", "content": ""})
+            for token in tokens:
+                if per_token:
+                    await asyncio.sleep(per_token)
+                yield _chunk(body, completion_id, {"content": token})
+            yield _chunk(body, completion_id, {}, finish_reason="stop")
+            usage = {"id": completion_id, "object": "chat.completion.chunk", "created": int(time.time()),
+                     "model": body.get("model", "fake"), "choices": [], "usage": _usage(body, len(tokens))}
+            yield f"data: {json.dumps(usage)}\n\n"
+            yield "data: [DONE]\n\n"
+        return StreamingResponse(stream(), media_type="text/event-stream")
+
+    await asyncio.sleep(LATENCY + per_token * len(tokens))
+    return {
+        "id": completion_id,
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": body.get("model", "fake"),
+        "choices": [{"index": 0, "message": {"role": "assistant", "content": "".join(tokens)}, "finish_reason": "stop"}],
+        "usage": _usage(body, len(tokens)),
+    }
+
+def main():
+    global LATENCY, TOKEN_RATE, ERROR_RATE, REPLY_TOKENS
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9999)
+    parser.add_argument("--latency", type=float, default=LATENCY, help="seconds before the first token")
+    parser.add_argument("--token-rate", type=float, default=TOKEN_RATE, help="tokens per second, 0 for unlimited")
+    parser.add_argument("--error-rate", type=float, default=ERROR_RATE, help="probability of a 500 response")
+    parser.add_argument("--reply-tokens", type=int, default=REPLY_TOKENS)
+    args = parser.parse_args()
+    LATENCY, TOKEN_RATE, ERROR_RATE, REPLY_TOKENS = args.latency, args.token_rate, args.error_rate, args.reply_tokens
+    uvicorn.run(app, host=args.host, port=args.port, log_level="warning")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,287 @@
+# bench/run_bench.py
+# 端到端负载/延迟基准测试：启动假 LLM 服务和后端，按不同并发度跑完整的用户流程，
+# 统计每个接口的吞吐量、p50/p95/p99 和每请求 SQL 语句数，并把结果保存为 JSON 便于对比回归。
+#
+# 用法 (在 backend/ 目录下):
+#   python bench/run_bench.py --concurrency 1,8,32 --turns 5 --out bench/results/today.json
+#   python bench/run_bench.py --concurrency 8 --compare bench/results/yesterday.json
+#   python bench/run_bench.py --app-env LLM_MAX_CONCURRENCY=8 --llm-latency 1.0
+import argparse
+import asyncio
+import datetime
+import json
+import os
+import re
+import socket
+import statistics
+import subprocess
+import sys
+import time
+import uuid
+from collections import Counter, defaultdict
+from typing import Dict, List, Optional
+import httpx
+
+BACKEND_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# 把具体的 URL 归并成路由模板，例如 /chats/<uuid>/messages -> /chats/{chat_id}/messages
+_UUID_RE = re.compile(r"[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}")
+
+def _endpoint(method: str, path: str) -> str:
+    return f"{method} {_UUID_RE.sub('{chat_id}', path)}"
+
+def _free_port() -> int:
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        return s.getsockname()[1]
+
+def _percentile(sorted_values: List[float], q: float) -> float:
+    if not sorted_values:
+        return 0.0
+    index = min(len(sorted_values) - 1, max(0, round(q * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+def _git_rev() -> Optional[str]:
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], cwd=BACKEND_DIR, text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+async def _wait_until_up(url: str, proc: subprocess.Popen, timeout: float = 60):
+    deadline = time.monotonic() + timeout
+    async with httpx.AsyncClient() as client:
+        while time.monotonic() < deadline:
+            if proc.poll() is not None:
+                raise RuntimeError(f"process exited with code {proc.returncode} before {url} became available")
+            try:
+                await client.get(url, timeout=1)
+                return
+            except httpx.HTTPError:
+                await asyncio.sleep(0.2)
+    raise RuntimeError(f"timed out waiting for {url}")
+
+def _stop(proc: subprocess.Popen):
+    if proc.poll() is None:
+        proc.terminate()
+        try:
+            proc.wait(timeout=15)
+        except subprocess.TimeoutExpired:
+            proc.kill()
+
+class Recorder:
+    """收集每个请求的耗时、状态码和 X-DB-Queries。"""
+
+    def __init__(self):
+        self.samples: Dict[str, List[dict]] = defaultdict(list)
+
+    async def request(self, client: httpx.AsyncClient, method: str, path: str, **kwargs) -> Optional[httpx.Response]:
+        start = time.perf_counter()
+        try:
+            response = await client.request(method, path, **kwargs)
+        except httpx.HTTPError as e:
+            self.samples[_endpoint(method, path)].append({"latency": time.perf_counter() - start, "status": type(e).__name__, "queries": None})
+            return None
+        queries = response.headers.get("x-db-queries")
+        self.samples[_endpoint(method, path)].append({
+            "latency": time.perf_counter() - start,
+            "status": response.status_code,
+            "queries": int(queries) if queries is not None else None,
+        })
+        return response
+
+    def summary(self, elapsed: float) -> Dict[str, dict]:
+        result = {}
+        for endpoint, samples in sorted(self.samples.items()):
+            latencies = sorted(s["latency"] for s in samples)
+            queries = [s["queries"] for s in samples if s["queries"] is not None]
+            errors = sum(1 for s in samples if not (isinstance(s["status"], int) and s["status"] < 400))
+            result[endpoint] = {
+                "requests": len(samples),
+                "errors": errors,
+                "throughput_rps": round(len(samples) / elapsed, 3) if elapsed else 0.0,
+                "p50_ms": round(_percentile(latencies, 0.50) * 1000, 2),
+                "p95_ms": round(_percentile(latencies, 0.95) * 1000, 2),
+                "p99_ms": round(_percentile(latencies, 0.99) * 1000, 2),
+                "mean_db_queries": round(statistics.mean(queries), 2) if queries else None,
+                "statuses": dict(sorted(Counter(str(s["status"]) for s in samples).items())),
+            }
+        return result
+
+async def _virtual_user(client: httpx.AsyncClient, recorder: Recorder, role_id: str, turns: int, stream: bool, run_id: str, index: int):
+    """单个虚拟用户的完整流程：注册 -> 登录 -> 创建聊天 -> 多轮对话 -> 读取消息。"""
+    username = f"bench_{run_id}_{index}"
+    password = "bench-password"
+    response = await recorder.request(client, "POST", "/register", json={"username": username, "email": f"{username}@example.com", "password": password})
+    if response is None or response.status_code != 201:
+        return
+    response = await recorder.request(client, "POST", "/token", data={"username": username, "password": password})
+    if response is None or response.status_code != 200:
+        return
+    headers = {"Authorization": f"Bearer {response.json()['access_token']}"}
+
+    response = await recorder.request(client, "POST", "/chats/", json={"role_id": role_id}, headers=headers)
+    if response is None or response.status_code != 201:
+        return
+    chat_id = response.json()["id"]
+
+    for turn in range(turns):
+        payload = {"sender_type": "user", "content": f"第 {turn + 1} 轮：今天过得怎么样？({uuid.uuid4().hex[:6]})"}
+        if stream:
+            # 流式接口的耗时统计到整个响应读完为止
+            path = f"/chats/{chat_id}/message/stream"
+            start = time.perf_counter()
+            try:
+                async with client.stream("POST", path, json=payload, headers=headers) as response:
+                    async for _ in response.aiter_bytes():
+                        pass
+                queries = response.headers.get("x-db-queries")
+                recorder.samples[_endpoint("POST", path)].append({"latency": time.perf_counter() - start, "status": response.status_code, "queries": int(queries) if queries is not None else None})
+            except httpx.HTTPError as e:
+                recorder.samples[_endpoint("POST", path)].append({"latency": time.perf_counter() - start, "status": type(e).__name__, "queries": None})
+        else:
+            await recorder.request(client, "POST", f"/chats/{chat_id}/message", json=payload, headers=headers)
+
+    await recorder.request(client, "GET", f"/chats/{chat_id}/messages", headers=headers)
+    await recorder.request(client, "GET", "/chats/", headers=headers)
+    await recorder.request(client, "GET", "/roles/", headers=headers)
+
+async def _run_level(base_url: str, concurrency: int, turns: int, stream: bool, timeout: float) -> dict:
+    recorder = Recorder()
+    run_id = uuid.uuid4().hex[:8]
+    limits = httpx.Limits(max_connections=concurrency * 2, max_keepalive_connections=concurrency * 2)
+    async with httpx.AsyncClient(base_url=base_url, timeout=timeout, limits=limits) as client:
+        # 用一个预热用户取得角色 ID，不计入统计
+        warmup = f"bench_{run_id}_warmup"
+        response = await client.post("/register", json={"username": warmup, "email": f"{warmup}@example.com", "password": "bench-password"})
+        response.raise_for_status()
+        response = await client.post("/token", data={"username": warmup, "password": "bench-password"})
+        response.raise_for_status()
+        response = await client.get("/roles/", headers={"Authorization": f"Bearer {response.json()['access_token']}"})
+        response.raise_for_status()
+        roles = response.json()
+        if not roles:
+            raise RuntimeError("no active roles found; the app should seed default roles on startup")
+
+        start = time.perf_counter()
+        await asyncio.gather(*(
+            _virtual_user(client, recorder, roles[i % len(roles)]["id"], turns, stream, run_id, i)
+            for i in range(concurrency)
+        ))
+        elapsed = time.perf_counter() - start
+    return {"concurrency": concurrency, "elapsed_s": round(elapsed, 3), "endpoints": recorder.summary(elapsed)}
+
+def _print_level(level: dict):
+    print(f"\n== concurrency {level['concurrency']} ({level['elapsed_s']}s) ==")
+    print(f"{'endpoint':<40} {'n':>6} {'err':>5} {'rps':>8} {'p50ms':>9} {'p95ms':>9} {'p99ms':>9} {'dbq':>6}")
+    for endpoint, stats in level["endpoints"].items():
+        dbq = "-" if stats["mean_db_queries"] is None else f"{stats['mean_db_queries']:.1f}"
+        print(f"{endpoint:<40} {stats['requests']:>6} {stats['errors']:>5} {stats['throughput_rps']:>8.2f} "
+              f"{stats['p50_ms']:>9.1f} {stats['p95_ms']:>9.1f} {stats['p99_ms']:>9.1f} {dbq:>6}")
+
+def _compare(current: dict, baseline: dict, threshold: float):
+    """按并发度和接口对比两次结果，p95 变慢或吞吐下降超过阈值时标记为回归。返回回归数量。"""
+    baseline_levels = {level["concurrency"]: level for level in baseline["results"]}
+    regressions = 0
+    print(f"\n== compared with {baseline['meta'].get('git_rev')} @ {baseline['meta'].get('timestamp')} ==")
+    for level in current["results"]:
+        old_level = baseline_levels.get(level["concurrency"])
+        if old_level is None:
+            continue
+        for endpoint, stats in level["endpoints"].items():
+            old = old_level["endpoints"].get(endpoint)
+            if old is None:
+                continue
+            notes = []
+            if old["p95_ms"] and stats["p95_ms"] > old["p95_ms"] * (1 + threshold):
+                notes.append("p95")
+            if old["throughput_rps"] and stats["throughput_rps"] < old["throughput_rps"] * (1 - threshold):
+                notes.append("throughput")
+            if old["mean_db_queries"] is not None and stats["mean_db_queries"] is not None and stats["mean_db_queries"] > old["mean_db_queries"]:
+                notes.append("db queries")
+            regressions += bool(notes)
+            print(f"c={level['concurrency']:<4} {endpoint:<40} p95 {old['p95_ms']:>8.1f} -> {stats['p95_ms']:>8.1f}ms  "
+                  f"rps {old['throughput_rps']:>7.2f} -> {stats['throughput_rps']:>7.2f}  "
+                  f"dbq {old['mean_db_queries']} -> {stats['mean_db_queries']}"
+                  + (f"  REGRESSION: {', '.join(notes)}" if notes else ""))
+    return regressions
+
+async def main():
+    parser = argparse.ArgumentParser(description="End-to-end load and latency benchmark")
+    parser.add_argument("--database-url", default=os.getenv("DATABASE_URL"), help="Postgres URL for the app under test (default: $DATABASE_URL)")
+    parser.add_argument("--concurrency", default="1,8,32", help="comma-separated virtual user counts, one run per level")
+    parser.add_argument("--turns", type=int, default=3, help="chat turns per virtual user")
+    parser.add_argument("--stream", action="store_true", help="use the SSE endpoint instead of POST /chats/{id}/message")
+    parser.add_argument("--llm-latency", type=float, default=0.2, help="fake LLM time to first token (s)")
+    parser.add_argument("--llm-token-rate", type=float, default=200, help="fake LLM tokens per second, 0 for unlimited")
+    parser.add_argument("--llm-error-rate", type=float, default=0.0, help="fake LLM probability of a 500 response")
+    parser.add_argument("--llm-reply-tokens", type=int, default=40)
+    parser.add_argument("--app-env", action="append", default=[], metavar="KEY=VALUE", help="extra environment for the app, repeatable")
+    parser.add_argument("--workers", type=int, default=1, help="uvicorn workers for the app")
+    parser.add_argument("--timeout", type=float, default=120, help="client timeout per request (s)")
+    parser.add_argument("--out", help="write results JSON here (default: bench/results/<timestamp>.json)")
+    parser.add_argument("--compare", help="baseline results JSON to compare against")
+    parser.add_argument("--threshold", type=float, default=0.10, help="relative change that counts as a regression")
+    args = parser.parse_args()
+
+    if not args.database_url:
+        parser.error("--database-url or DATABASE_URL is required")
+    levels = [int(c) for c in args.concurrency.split(",") if c.strip()]
+
+    llm_port, app_port = _free_port(), _free_port()
+    llm_proc = subprocess.Popen(
+        [sys.executable, os.path.join(BACKEND_DIR, "bench", "fake_llm_server.py"), "--port", str(llm_port),
+         "--latency", str(args.llm_latency), "--token-rate", str(args.llm_token_rate),
+         "--error-rate", str(args.llm_error_rate), "--reply-tokens", str(args.llm_reply_tokens)],
+        cwd=BACKEND_DIR,
+    )
+    app_env = dict(os.environ)
+    app_env.update({
+        "DATABASE_URL": args.database_url,
+        "QINIU_OPENAI_BASE_URL": f"http://127.0.0.1:{llm_port}/v1",
+        "DB_QUERY_COUNT_HEADER": "true",
+        "LLM_RATE_PER_MINUTE": "0",
+    })
+    for item in args.app_env:
+        key, _, value = item.partition("=")
+        app_env[key] = value
+    app_proc = subprocess.Popen(
+        [sys.executable, "-m", "uvicorn", "main:app", "--host", "127.0.0.1", "--port", str(app_port),
+         "--workers", str(args.workers), "--log-level", "warning", "--no-access-log"],
+        cwd=BACKEND_DIR, env=app_env,
+    )
+
+    base_url = f"http://127.0.0.1:{app_port}"
+    results = []
+    try:
+        await _wait_until_up(f"http://127.0.0.1:{llm_port}/docs", llm_proc)
+        await _wait_until_up(f"{base_url}/", app_proc)
+        for concurrency in levels:
+            level = await _run_level(base_url, concurrency, args.turns, args.stream, args.timeout)
+            _print_level(level)
+            results.append(level)
+    finally:
+        _stop(app_proc)
+        _stop(llm_proc)
+
+    report = {
+        "meta": {
+            "timestamp": datetime.datetime.now(datetime.timezone.utc).isoformat(),
+            "git_rev": _git_rev(),
+            "config": {key: value for key, value in vars(args).items() if key not in ("database_url", "out", "compare")},
+        },
+        "results": results,
+    }
+    out = args.out or os.path.join(BACKEND_DIR, "bench", "results", datetime.datetime.now().strftime("%Y%m%d-%H%M%S") + ".json")
+    os.makedirs(os.path.dirname(os.path.abspath(out)), exist_ok=True)
+    with open(out, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"\nresults written to {out}")
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+        if _compare(report, baseline, args.threshold):
+            sys.exit(1)
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -1,13 +1,30 @@
 # main.py
-from fastapi import FastAPI, Depends, HTTPException, status
+from fastapi import FastAPI, Depends, Header, HTTPException, status, BackgroundTasks, Query, Request, Response, WebSocket, WebSocketDisconnect
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
 from fastapi.security import OAuth2PasswordRequestForm
+from sqlalchemy import select, insert, update, func, literal, tuple_, and_
 from sqlalchemy.orm import Session
-from app.database import SessionLocal, engine, Base, get_db # get_db 现在从这里导入
+from sqlalchemy.ext.asyncio import AsyncSession
+from anyio import CancelScope
+from app.database import AsyncSessionLocal, autocommit_engine, get_db, get_async_db, read_session, recent_writes, start_query_count # get_db 现在从这里导入
 from app import models, schemas, auth
-from datetime import timedelta
-from typing import List
+from datetime import datetime, timedelta
+from typing import Awaitable, Callable, List, Optional, Set, Tuple
+from pydantic import ValidationError
+import asyncio
+import base64
+import logging
+import os
+import time
 import uuid
-from app import models, schemas, auth, llm_service # 导入 llm_service
+import json
+from contextlib import asynccontextmanager
+from app import models, schemas, auth, archive, chat_turns, idempotency, llm_service, llm_cache, llm_gateway, message_writer, migrations, passwords, reply_jobs, search, voice, ws # 导入 llm_service
+from app.role_registry import role_registry
+from app import metrics
+from app.metrics import render_prometheus
+
+logger = logging.getLogger(__name__)
 
 # 定义 OpenAPI tags metadata，用于组织 Swagger UI
 tags_metadata = [
@@ -39,7 +56,18 @@ security_definitions = {
     }
 }
 
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    # 数据库迁移和默认角色初始化放在启动阶段而不是导入时执行，多个 worker 之间由 advisory 锁串行化
+    await migrations.run_startup()
+    reply_jobs.pool.start(_run_reply_job)
+    yield
+    await reply_jobs.pool.stop() # 正在执行的回复任务放回队列
+    await message_writer.writer.close() # 写完合并写入队列中剩余的消息
+    passwords.shutdown_pool()
+
 app = FastAPI(
+    lifespan=lifespan,
     title="AI Role Playing Website API",
     description="API for an AI-powered role-playing website featuring characters like Spider-Man and a Girlfriend Trainer.",
     version="0.1.0",
@@ -49,20 +77,92 @@ app = FastAPI(
     # swagger_ui_oauth2_redirect_url="/oauth2-redirect" # 移除此行
 )
 
-# 创建所有数据库表
-Base.metadata.create_all(bind=engine)
+class QueryCountHeaderMiddleware:
+    """在响应头 X-DB-Queries 中返回本请求执行的 SQL 语句数，供基准测试统计 (流式响应只统计到开始发送为止)。"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        counter = start_query_count()
+
+        async def send_with_count(message):
+            if message["type"] == "http.response.start":
+                message["headers"] = list(message.get("headers", [])) + [(b"x-db-queries", str(counter[0]).encode())]
+            await send(message)
+
+        await self.app(scope, receive, send_with_count)
+
+if os.getenv("DB_QUERY_COUNT_HEADER", "false").lower() in ("1", "true", "yes"):
+    app.add_middleware(QueryCountHeaderMiddleware)
+
+http_request_duration_seconds = metrics.Histogram("http_request_duration_seconds", "HTTP request duration until the response body is complete.", ("method", "route", "status"))
+chat_turn_phase_seconds = metrics.Histogram("chat_turn_phase_seconds", "Time spent in each phase of a chat turn.", ("route", "role", "phase"))
+
+class MetricsMiddleware:
+    """按路由模板记录每个请求的耗时；未匹配到路由的请求归为 "unmatched"，避免标签基数失控。"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+        start = time.perf_counter()
+        status_code = 500
+
+        async def send_with_status(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_status)
+        finally:
+            # 路由匹配后 FastAPI 会把 route 写回 scope
+            route = getattr(scope.get("route"), "path", "unmatched")
+            http_request_duration_seconds.observe(time.perf_counter() - start, method=scope["method"], route=route, status=str(status_code))
 
-# 在应用启动时创建默认角色
-db = SessionLocal()
-try:
-    models.create_default_roles(db)
-finally:
-    db.close()
+app.add_middleware(MetricsMiddleware)
+
+@app.exception_handler(llm_gateway.RateLimited)
+async def rate_limited_handler(request: Request, exc: llm_gateway.RateLimited):
+    return JSONResponse(
+        status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+        content={"detail": "Too many messages, please slow down"},
+        headers={"Retry-After": str(max(1, round(exc.retry_after)))},
+    )
+
+@app.exception_handler(llm_gateway.QueueTimeout)
+async def queue_timeout_handler(request: Request, exc: llm_gateway.QueueTimeout):
+    return JSONResponse(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        content={"detail": "AI service is busy, please retry shortly"},
+        headers={"Retry-After": "5"},
+    )
+
+@app.exception_handler(llm_service.LLMUnavailable)
+async def llm_unavailable_handler(request: Request, exc: llm_service.LLMUnavailable):
+    # 不再把道歉文本当作 AI 回复保存，客户端可以稍后重试
+    return JSONResponse(
+        status_code=status.HTTP_503_SERVICE_UNAVAILABLE,
+        content={"detail": "Sorry, I am unable to respond at the moment."},
+        headers={"Retry-After": "5"},
+    )
 
 @app.get("/", tags=["General"], include_in_schema=False)
 async def read_root():
     return {"message": "Hello, FastAPI Backend!"}
 
+@app.get("/metrics", tags=["General"], include_in_schema=False)
+async def read_metrics():
+    return PlainTextResponse(render_prometheus(), media_type="text/plain; version=0.0.4")
+
 @app.get("/items/{item_id}", tags=["General"], include_in_schema=False)
 async def read_item(item_id: int, q: str = None, db: Session = Depends(get_db)):
     return {"item_id": item_id, "q": q}
@@ -70,34 +170,42 @@ async def read_item(item_id: int, q: str = None, db: Session = Depends(get_db)):
 # --- 用户认证相关的 API 路由 ---
 
 @app.post("/register", response_model=schemas.UserResponse, status_code=status.HTTP_201_CREATED, tags=["Authentication"])
-def register_user(user: schemas.UserCreate, db: Session = Depends(get_db)):
-    db_user_by_username = auth.get_user_by_username(db, username=user.username)
+async def register_user(user: schemas.UserCreate, db: AsyncSession = Depends(get_async_db)):
+    db_user_by_username = await auth.get_user_by_username(db, username=user.username)
     if db_user_by_username:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Username already registered")
-    db_user_by_email = auth.get_user_by_email(db, email=user.email)
+    db_user_by_email = await auth.get_user_by_email(db, email=user.email)
     if db_user_by_email:
         raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Email already registered")
 
-    hashed_password = auth.get_password_hash(user.password)
+    hashed_password = await auth.get_password_hash_async(user.password)
     db_user = models.User(
         username=user.username,
         email=user.email,
         hashed_password=hashed_password
     )
     db.add(db_user)
-    db.commit()
-    db.refresh(db_user)
+    await db.commit()
+    await db.refresh(db_user)
     return db_user
 
 @app.post("/token", response_model=schemas.Token, tags=["Authentication"])
-def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(), db: Session = Depends(get_db)):
-    user = auth.get_user_by_username(db, username=form_data.username)
-    if not user or not auth.verify_password(form_data.password, user.hashed_password):
+async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(), db: AsyncSession = Depends(get_async_db)):
+    user = await auth.get_user_by_username(db, username=form_data.username)
+    valid, new_hash = (False, None)
+    if user:
+        valid, new_hash = await auth.verify_and_update_password_async(form_data.password, user.hashed_password)
+    if not valid:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
             detail="Incorrect username or password",
             headers={"WWW-Authenticate": "Bearer"},
         )
+    if new_hash:
+        # BCRYPT_ROUNDS 改变后，在登录时透明地升级旧哈希
+        user.hashed_password = new_hash
+        await db.commit()
+        auth.invalidate_user(user.id)
     access_token_expires = timedelta(minutes=auth.ACCESS_TOKEN_EXPIRE_MINUTES)
     access_token = auth.create_access_token(
         data={"username": user.username, "user_id": str(user.id)},
@@ -105,133 +213,1144 @@ def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(), db:
     )
     return {"access_token": access_token, "token_type": "bearer"}
 
-@app.get("/users/me/", response_model=schemas.UserResponse, tags=["Users"], dependencies=[Depends(auth.get_current_active_user)]) # 通过 dependencies 参数声明认证
+@app.get("/users/me/", response_model=schemas.UserResponse, tags=["Users"])
 async def read_users_me(current_user: models.User = Depends(auth.get_current_active_user)):
     return current_user
 
 # --- 角色相关的 API 路由 ---
 
-@app.post("/roles/", response_model=schemas.RoleResponse, status_code=status.HTTP_201_CREATED, tags=["Roles"], dependencies=[Depends(auth.get_current_active_user)]) # 声明认证
-def create_role(role: schemas.RoleCreate, db: Session = Depends(get_db), current_user: models.User = Depends(auth.get_current_active_user)):
+@app.post("/roles/", response_model=schemas.RoleResponse, status_code=status.HTTP_201_CREATED, tags=["Roles"])
+async def create_role(role: schemas.RoleCreate, db: AsyncSession = Depends(get_async_db), current_user: auth.Principal = Depends(auth.get_current_principal)):
     db_role = models.Role(
         name=role.name,
         description=role.description,
         system_prompt=role.system_prompt,
         few_shot_examples=role.few_shot_examples,
-        is_active=role.is_active
+        is_active=role.is_active,
+        response_cache_enabled=role.response_cache_enabled
     )
     db.add(db_role)
-    db.commit()
-    db.refresh(db_role)
+    await db.commit()
+    await db.refresh(db_role)
+    role_registry.invalidate()
     return db_role
 
-@app.get("/roles/", response_model=List[schemas.RoleResponse], tags=["Roles"], dependencies=[Depends(auth.get_current_active_user)]) # 声明认证
-def get_roles(db: Session = Depends(get_db), current_user: models.User = Depends(auth.get_current_active_user)):
-    roles = db.query(models.Role).filter(models.Role.is_active == True).all()
-    return roles
+@app.get("/roles/", response_model=List[schemas.RoleResponse], tags=["Roles"])
+async def get_roles(db: AsyncSession = Depends(get_async_db), current_user: auth.Principal = Depends(auth.get_current_principal)):
+    return await role_registry.active_roles(db)
 
-@app.get("/roles/{role_id}", response_model=schemas.RoleResponse, tags=["Roles"], dependencies=[Depends(auth.get_current_active_user)]) # 声明认证
-def get_role(role_id: uuid.UUID, db: Session = Depends(get_db), current_user: models.User = Depends(auth.get_current_active_user)):
-    role = db.query(models.Role).filter(models.Role.id == role_id, models.Role.is_active == True).first()
+@app.get("/roles/{role_id}", response_model=schemas.RoleResponse, tags=["Roles"])
+async def get_role(role_id: uuid.UUID, db: AsyncSession = Depends(get_async_db), current_user: auth.Principal = Depends(auth.get_current_principal)):
+    role = await role_registry.get(db, role_id, active_only=True)
     if not role:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Role not found or inactive")
     return role
 
 # --- 聊天相关的 API 路由 ---
 
-@app.post("/chats/", response_model=schemas.ChatResponse, status_code=status.HTTP_201_CREATED, tags=["Chats"], dependencies=[Depends(auth.get_current_active_user)]) # 声明认证
-def create_chat(chat_create: schemas.ChatCreate, db: Session = Depends(get_db), current_user: models.User = Depends(auth.get_current_active_user)):
-    role = db.query(models.Role).filter(models.Role.id == chat_create.role_id, models.Role.is_active == True).first()
+async def get_read_db(request: Request, current_user: auth.Principal = Depends(auth.get_current_principal)):
+    """只读接口的会话依赖：走只读副本，当前用户或路径中的聊天刚写入过时改走主库 (读己之写)。"""
+    keys = [current_user.id]
+    if "chat_id" in request.path_params:
+        keys.append(request.path_params["chat_id"])
+    async with read_session(*keys) as db:
+        yield db
+
+@app.post("/chats/", response_model=schemas.ChatResponse, status_code=status.HTTP_201_CREATED, tags=["Chats"])
+async def create_chat(chat_create: schemas.ChatCreate, db: AsyncSession = Depends(get_async_db), current_user: auth.Principal = Depends(auth.get_current_principal)):
+    role = await role_registry.get(db, chat_create.role_id, active_only=True)
     if not role:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Role not found or inactive")
 
-    db_chat = models.Chat(
-        user_id=current_user.id,
-        role_id=chat_create.role_id,
-        title=chat_create.title if chat_create.title else f"Chat with {role.name}"
-    )
-    db.add(db_chat)
-    db.commit()
-    db.refresh(db_chat)
-
+    chat_id = uuid.uuid4()
     initial_ai_message_content = f"Hello, I am {role.name}. How can I help you today?"
-    initial_ai_message = models.Message(
-        chat_id=db_chat.id,
-        sender_type="ai",
-        content=initial_ai_message_content,
-        order_in_chat=0
+    # 聊天和开场白在同一条自动提交的语句中写入 (开场白作为数据修改 CTE)，只需一次往返
+    greeting = insert(models.Message).values(
+        message_writer.message_row(chat_id, "ai", initial_ai_message_content, 0)
+    ).cte("greeting")
+    stmt = (
+        insert(models.Chat)
+        .values(
+            id=chat_id,
+            user_id=current_user.id,
+            role_id=chat_create.role_id,
+            title=chat_create.title if chat_create.title else f"Chat with {role.name}",
+            next_order=1, # 序号 0 留给开场白
+            # 带 CTE 的 INSERT 不会应用 Python 端的列默认值，需要显式给出
+            summarized_until=-1,
+            message_count=1,
+            last_message_preview=initial_ai_message_content[:models.MESSAGE_PREVIEW_LENGTH]
+        )
+        .returning(
+            models.Chat.id, models.Chat.user_id, models.Chat.role_id, models.Chat.title, models.Chat.created_at, models.Chat.updated_at,
+            models.Chat.message_count, models.Chat.last_message_at, models.Chat.last_message_preview
+        )
+        .add_cte(greeting)
     )
-    db.add(initial_ai_message)
-    db.commit()
-    db.refresh(initial_ai_message)
+    async with autocommit_engine.connect() as conn:
+        db_chat = (await conn.execute(stmt)).one()
+    recent_writes.mark(current_user.id, chat_id)
+    return dict(db_chat._mapping)
 
-    return db_chat
+def _encode_chat_cursor(chat: models.Chat) -> str:
+    raw = f"{chat.last_message_at.isoformat()}|{chat.id}"
+    return base64.urlsafe_b64encode(raw.encode()).decode()
 
-@app.get("/chats/", response_model=List[schemas.ChatResponse], tags=["Chats"], dependencies=[Depends(auth.get_current_active_user)]) # 声明认证
-def get_user_chats(db: Session = Depends(get_db), current_user: models.User = Depends(auth.get_current_active_user)):
-    chats = db.query(models.Chat).filter(models.Chat.user_id == current_user.id).order_by(models.Chat.created_at.desc()).all()
-    return chats
+def _decode_chat_cursor(cursor: str):
+    try:
+        last_message_at, chat_id = base64.urlsafe_b64decode(cursor.encode()).decode().split("|")
+        return datetime.fromisoformat(last_message_at), uuid.UUID(chat_id)
+    except ValueError:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid cursor")
 
-@app.get("/chats/{chat_id}/messages", response_model=List[schemas.MessageResponse], tags=["Chats"], dependencies=[Depends(auth.get_current_active_user)]) # 声明认证
-def get_chat_messages(chat_id: uuid.UUID, db: Session = Depends(get_db), current_user: models.User = Depends(auth.get_current_active_user)):
-    chat = db.query(models.Chat).filter(models.Chat.id == chat_id, models.Chat.user_id == current_user.id).first()
-    if not chat:
-        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Chat not found or unauthorized")
+@app.get("/chats/", response_model=schemas.ChatPage, tags=["Chats"])
+async def get_user_chats(
+    before: Optional[str] = Query(None, description="返回最近活动早于该游标的聊天"),
+    after: Optional[str] = Query(None, description="返回最近活动晚于该游标的聊天"),
+    limit: int = Query(20, ge=1, le=100),
+    db: AsyncSession = Depends(get_read_db),
+    current_user: auth.Principal = Depends(auth.get_current_principal),
+):
+    """按最近活动时间倒序分页返回聊天及其消息数、最后一条消息预览。
+
+    基于 (last_message_at, id) 的游标，由 ix_chats_user_id_last_message_at_id 支撑；
+    翻页期间收到新消息的聊天会移到列表最前面，不会在后面的页里再次出现。
+    """
+    if before and after:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Use either before or after, not both")
+    key = tuple_(models.Chat.last_message_at, models.Chat.id)
+    query = select(models.Chat).where(models.Chat.user_id == current_user.id)
+    if after:
+        # 向更新的方向翻页：先按升序取，再翻转为倒序返回
+        query = query.where(key > tuple_(*_decode_chat_cursor(after))).order_by(models.Chat.last_message_at, models.Chat.id)
+    else:
+        if before:
+            query = query.where(key < tuple_(*_decode_chat_cursor(before)))
+        query = query.order_by(models.Chat.last_message_at.desc(), models.Chat.id.desc())
+
+    result = await db.execute(query.limit(limit + 1))
+    chats = result.scalars().all()
+    has_more = len(chats) > limit
+    chats = chats[:limit]
+    next_cursor = _encode_chat_cursor(chats[-1]) if has_more else None
+    if after:
+        chats.reverse()
+    return {"items": chats, "next_cursor": next_cursor}
 
-    messages = db.query(models.Message).filter(models.Message.chat_id == chat_id).order_by(models.Message.order_in_chat).all()
-    return messages
+@app.get("/chats/{chat_id}/messages", response_model=schemas.MessagePage, tags=["Chats"])
+async def get_chat_messages(
+    chat_id: uuid.UUID,
+    before: Optional[int] = Query(None, description="返回 order_in_chat 小于该值的消息"),
+    after: Optional[int] = Query(None, description="返回 order_in_chat 大于该值的消息"),
+    limit: int = Query(50, ge=1, le=200),
+    db: AsyncSession = Depends(get_read_db),
+    current_user: auth.Principal = Depends(auth.get_current_principal),
+):
+    """按 order_in_chat 游标分页返回消息，页内总是按时间升序。
 
-@app.post("/chats/{chat_id}/message", response_model=schemas.MessageResponse, tags=["Chats"], dependencies=[Depends(auth.get_current_active_user)]) # 声明认证
-async def send_message(chat_id: uuid.UUID, message: schemas.MessageCreate, db: Session = Depends(get_db), current_user: models.User = Depends(auth.get_current_active_user)):
-    chat = db.query(models.Chat).filter(models.Chat.id == chat_id, models.Chat.user_id == current_user.id).first()
-    if not chat:
+    默认返回最近的 limit 条消息，next_cursor 作为 before 可继续加载更早的消息；
+    传入 after 时向更新的方向翻页，next_cursor 作为 after 继续。
+    """
+    if before is not None and after is not None:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Use either before or after, not both")
+    result = await db.execute(select(models.Chat.archived_at).where(models.Chat.id == chat_id, models.Chat.user_id == current_user.id))
+    chat = result.first()
+    if chat is None:
         raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Chat not found or unauthorized")
+    if chat.archived_at is not None:
+        # 恢复写在主库上，恢复后的消息从主库读取
+        await archive.rehydrate(chat_id)
+        async with AsyncSessionLocal() as primary_db:
+            return await _message_page(primary_db, chat_id, before, after, limit)
+    return await _message_page(db, chat_id, before, after, limit)
+
+async def _message_page(db: AsyncSession, chat_id: uuid.UUID, before: Optional[int], after: Optional[int], limit: int) -> dict:
+    query = select(models.Message).where(models.Message.chat_id == chat_id)
+    if after is not None:
+        query = query.where(models.Message.order_in_chat > after).order_by(models.Message.order_in_chat)
+    else:
+        if before is not None:
+            query = query.where(models.Message.order_in_chat < before)
+        query = query.order_by(models.Message.order_in_chat.desc())
+
+    result = await db.execute(query.limit(limit + 1))
+    messages = result.scalars().all()
+    has_more = len(messages) > limit
+    messages = messages[:limit]
+    next_cursor = messages[-1].order_in_chat if has_more else None
+    if after is None:
+        messages.reverse()
+    return {"items": messages, "next_cursor": next_cursor}
+
+@app.get("/search", response_model=schemas.SearchPage, tags=["Chats"])
+async def search_messages(
+    q: str = Query(..., min_length=1, max_length=200, description="搜索词，多个词用空格分隔，需全部命中"),
+    chat_id: Optional[uuid.UUID] = Query(None, description="只在该聊天中搜索"),
+    cursor: Optional[str] = Query(None, description="上一页返回的 next_cursor"),
+    limit: int = Query(20, ge=1, le=50),
+    db: AsyncSession = Depends(get_read_db),
+    current_user: auth.Principal = Depends(auth.get_current_principal),
+):
+    """在当前用户的聊天记录中搜索，按相关度和时间倒序分页返回带高亮区间的消息片段。"""
+    terms = search.parse_terms(q)
+    if not terms:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Empty search query")
+    try:
+        after = search.decode_cursor(cursor) if cursor else None
+    except ValueError:
+        raise HTTPException(status_code=status.HTTP_400_BAD_REQUEST, detail="Invalid cursor")
+    result = await db.execute(search.build_query(current_user.id, terms, chat_id, after).limit(limit + 1))
+    rows = result.all()
+    has_more = len(rows) > limit
+    items = []
+    for row in rows[:limit]:
+        text_snippet, highlights = search.snippet(row.content, terms)
+        items.append({
+            "id": row.id, "chat_id": row.chat_id, "chat_title": row.chat_title, "sender_type": row.sender_type,
+            "timestamp": row.timestamp, "order_in_chat": row.order_in_chat, "snippet": text_snippet, "highlights": highlights,
+        })
+    next_cursor = None
+    if has_more:
+        last = rows[limit - 1]
+        next_cursor = search.encode_cursor(last.rank, last.timestamp, last.id)
+    return {"items": items, "next_cursor": next_cursor}
 
-    current_message_count = db.query(models.Message).filter(models.Message.chat_id == chat_id).count()
+# 本进程中正在合并摘要的聊天：同一聊天同时只有一个合并任务，期间的其他轮次不再安排 (多进程之间仍由下面的乐观并发兜底)
+_summary_refreshes: Set[uuid.UUID] = set()
 
-    # 保存用户消息
-    db_user_message = models.Message(
-        chat_id=chat_id,
-        sender_type="user",
-        content=message.content,
-        order_in_chat=current_message_count
+async def _refresh_chat_summary(chat_id: uuid.UUID, fold_before: int):
+    """把 order_in_chat < fold_before 且尚未摘要的消息增量合并进聊天摘要 (在响应发送后执行)。
+
+    每次 LLM 调用最多合并 SUMMARY_BATCH_TOKENS 的消息，每批成功后立即推进 summarized_until，积压再多也能逐批追上；
+    某一批失败时停止，之后的轮次从这一批重新开始。
+    """
+    if chat_id in _summary_refreshes:
+        return
+    _summary_refreshes.add(chat_id)
+    try:
+        async with autocommit_engine.connect() as conn:
+            chat = (await conn.execute(
+                select(models.Chat.summary, models.Chat.summarized_until).where(models.Chat.id == chat_id)
+            )).first()
+        if chat is None:
+            return
+        summary, summarized_until = chat.summary, chat.summarized_until
+        # 每条消息至少 MESSAGE_TOKEN_OVERHEAD 个 token，多读的行不会进入这一批
+        fetch_limit = llm_service.SUMMARY_BATCH_TOKENS // llm_service.MESSAGE_TOKEN_OVERHEAD + 1
+        while summarized_until < fold_before - 1:
+            async with autocommit_engine.connect() as conn:
+                rows = (await conn.execute(
+                    select(models.Message.sender_type, models.Message.content, models.Message.order_in_chat)
+                    .where(models.Message.chat_id == chat_id, models.Message.order_in_chat > summarized_until, models.Message.order_in_chat < fold_before)
+                    .order_by(models.Message.order_in_chat)
+                    .limit(fetch_limit)
+                )).all()
+            if not rows:
+                return
+            batch = [{"sender_type": sender_type, "content": content} for sender_type, content, _ in rows]
+            batch_size = llm_service.summary_batch_size(batch)
+            async with llm_gateway.gateway.slot(llm_gateway.BACKGROUND_KEY):
+                new_summary = await llm_service.summarize_history(summary, batch[:batch_size])
+            if not new_summary:
+                return
+            batch_until = rows[batch_size - 1].order_in_chat
+            # 乐观并发：只有在期间没有其他请求更新过摘要时才写入
+            async with autocommit_engine.connect() as conn:
+                result = await conn.execute(
+                    update(models.Chat)
+                    .where(models.Chat.id == chat_id, models.Chat.summarized_until == summarized_until)
+                    .values(summary=new_summary, summarized_until=batch_until)
+                )
+            if result.rowcount == 0:
+                return
+            summary, summarized_until = new_summary, batch_until
+    finally:
+        _summary_refreshes.discard(chat_id)
+
+async def _wait_turn(operation: Awaitable):
+    """等待获取聊天的租约 (chat_turns.turns.acquire)，等不到上一轮结束时返回 409。"""
+    try:
+        return await operation
+    except chat_turns.TurnBusy:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="Another reply is still being generated in this chat") from None
+
+async def _reserve_turn(chat_id: uuid.UUID, content: str, current_user: auth.Principal, timer: metrics.PhaseTimer, job_id: Optional[uuid.UUID] = None, turn: Optional[uuid.UUID] = None):
+    """校验聊天归属、为本轮预留序号并保存用户消息，返回 (reserved 行, 用户消息的 order_in_chat)。
+
+    传入 job_id 时，回复任务也在同一条语句中写入，用户消息和任务要么都保存要么都不保存；入队不获取租约，
+    但同步的一轮正在进行时等它结束 (chat_turns.enqueue_condition)，等待超时返回 409。
+    传入 turn 时调用方已经用 chat_turns.turns.acquire 持有该聊天的租约，这里只校验租约仍属于本轮并续期，不再等待。
+    """
+    # 一条语句完成归属校验并为本轮的用户消息和 AI 回复预留两个连续序号，
+    # 行锁保证并发发送到同一聊天时不会拿到相同的序号
+    inline_message = job_id is not None or not message_writer.MESSAGE_WRITE_BEHIND
+    values = {"next_order": models.Chat.next_order + 2}
+    if inline_message:
+        # 用户消息随本语句写入，聊天列表的统计也在这里一并更新 (同一行不能在一条语句中被两个 CTE 更新)
+        values.update(
+            message_count=models.Chat.message_count + 1,
+            last_message_at=func.now(),
+            last_message_preview=content[:models.MESSAGE_PREVIEW_LENGTH],
+        )
+    conditions = [models.Chat.id == chat_id, models.Chat.user_id == current_user.id]
+    if turn is not None:
+        conditions.append(chat_turns.held_condition(turn))
+        values.update(chat_turns.lease_values(turn))
+    elif job_id is not None:
+        conditions.append(chat_turns.enqueue_condition())
+    reserved_cte = (
+        update(models.Chat)
+        .where(*conditions)
+        .values(**values)
+        .returning(models.Chat.next_order, models.Chat.role_id, models.Chat.summary, models.Chat.summarized_until, models.Chat.archived_at)
+        .cte("reserved")
     )
-    db.add(db_user_message)
-    db.commit()
-    db.refresh(db_user_message)
+    stmt = select(reserved_cte)
+    user_message_id = uuid.uuid4()
+    if inline_message:
+        # 用户消息也写在同一条自动提交的语句里，预留序号和保存消息只需一次往返
+        stmt = stmt.add_cte(
+            insert(models.Message).from_select(
+                ["id", "chat_id", "sender_type", "content", "order_in_chat"],
+                select(
+                    literal(user_message_id, models.Message.id.type),
+                    literal(chat_id, models.Message.chat_id.type),
+                    literal("user", models.Message.sender_type.type),
+                    literal(content, models.Message.content.type),
+                    reserved_cte.c.next_order - 2,
+                ),
+            ).cte("user_message")
+        )
+    if job_id is not None:
+        stmt = stmt.add_cte(
+            insert(models.ReplyJob).from_select(
+                ["id", "chat_id", "user_id", "order_in_chat"],
+                select(
+                    literal(job_id, models.ReplyJob.id.type),
+                    literal(chat_id, models.ReplyJob.chat_id.type),
+                    literal(current_user.id, models.ReplyJob.user_id.type),
+                    reserved_cte.c.next_order - 1,
+                ),
+            ).cte("reply_job")
+        )
+    with timer.phase("reserve"):
+        if turn is None and job_id is not None:
+            # 语句在拿不到租约时不会写入任何行，可以等待后重试
+            reserved = await _wait_turn(chat_turns.turns.run_with_lease(chat_id, current_user.id, stmt))
+        else:
+            async with autocommit_engine.connect() as conn:
+                reserved = (await conn.execute(stmt)).first()
+    if not reserved:
+        if turn is not None:
+            # acquire 已经确认过聊天归属，这里没有更新到行说明租约在排队期间过期并被其他轮次获取
+            raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="Another reply is still being generated in this chat")
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Chat not found or unauthorized")
+    user_order = reserved.next_order - 2
+    recent_writes.mark(current_user.id, chat_id)
+
+    if not inline_message:
+        # 合并写入：等所在批次提交后再继续，保证调用 LLM 之前用户消息已经持久化
+        with timer.phase("save_user_message"):
+            await message_writer.save_message({"id": user_message_id, "chat_id": chat_id, "sender_type": "user", "content": content, "order_in_chat": user_order})
+    return reserved, user_order
 
-    # --- 调用 LLM 服务获取真实回复 ---
-    role = db.query(models.Role).filter(models.Role.id == chat.role_id).first()
+async def _turn_context(chat_id: uuid.UUID, chat, user_order: int, user_message: str, db: AsyncSession, background_tasks: BackgroundTasks, timer: metrics.PhaseTimer):
+    """加载角色和历史并构建本轮的 LLM 上下文，返回 (role, llm_chat_history)。
+
+    chat 需要有 role_id、summary 和 summarized_until，已归档的聊天需要先恢复。只读取摘要之后最近的 CONTEXT_MAX_MESSAGES 条历史，
+    再按 token 预算裁剪；被挤出窗口的消息积累到一定数量后，在 background_tasks 中合并进聊天摘要。
+    """
+    with timer.phase("load_role"):
+        role = await role_registry.get(db, chat.role_id)
     if not role:
         raise HTTPException(status_code=status.HTTP_500_INTERNAL_SERVER_ERROR, detail="Associated role not found")
 
-    # 获取聊天历史 (需要调整，以符合 LLM 接口的 messages 格式)
-    # 我们需要从数据库中获取所有历史消息，并按顺序组织成 LLM 需要的格式
-    chat_history_db = db.query(models.Message).filter(models.Message.chat_id == chat_id).order_by(models.Message.order_in_chat).all()
-    
+    # 只读取摘要之后、本条用户消息之前的最近若干条历史 (当前消息单独作为 user_message 传入)
+    with timer.phase("load_history"):
+        result = await db.execute(
+            select(models.Message.sender_type, models.Message.content, models.Message.order_in_chat)
+            .where(models.Message.chat_id == chat_id, models.Message.order_in_chat > chat.summarized_until, models.Message.order_in_chat < user_order)
+            .order_by(models.Message.order_in_chat.desc())
+            .limit(llm_service.CONTEXT_MAX_MESSAGES)
+        )
+        rows = result.all()
+
     # 转换为 LLM 期望的格式 (只包含 sender_type 和 content)
-    llm_chat_history = []
-    for msg in chat_history_db:
-        llm_chat_history.append({"sender_type": msg.sender_type, "content": msg.content})
+    with timer.phase("build_context"):
+        llm_chat_history = []
+        for sender_type, content, order_in_chat in reversed(rows):
+            llm_chat_history.append({"sender_type": sender_type, "content": content, "order_in_chat": order_in_chat})
 
-    ai_response_content = await llm_service.get_qwen_response(
-        system_prompt=role.system_prompt,
-        chat_history=llm_chat_history, # 传递所有历史消息
-        user_message=message.content,
-        few_shot_examples=role.few_shot_examples,
-        model="qwen3-235b-a22b-thinking-2507" # 确保使用正确的模型ID
+        llm_chat_history = llm_service.build_context(
+            chat_history=llm_chat_history,
+            user_message=user_message,
+            prefix_tokens=role.prefix_tokens,
+            summary=chat.summary,
+        )
+
+    # 窗口之外尚未摘要的消息足够多时，安排一次增量摘要
+    fold_before = llm_chat_history[0]["order_in_chat"] if llm_chat_history else user_order
+    if fold_before - chat.summarized_until - 1 >= llm_service.SUMMARY_MIN_BATCH and chat_id not in _summary_refreshes:
+        background_tasks.add_task(_refresh_chat_summary, chat_id, fold_before)
+
+    return role, llm_chat_history
+
+async def _prepare_turn(chat_id: uuid.UUID, message: schemas.MessageCreate, db: AsyncSession, current_user: auth.Principal, background_tasks: BackgroundTasks, timer: metrics.PhaseTimer, turn: uuid.UUID):
+    """在调用方持有的租约下 (turn 为 chat_turns 的令牌，调用方负责获取和释放) 预留序号、保存用户消息，
+    并返回 (role, llm_chat_history, summary, 下一条消息的 order_in_chat)。各阶段耗时记录在 timer 中。"""
+    reserved, user_order = await _reserve_turn(chat_id, message.content, current_user, timer, turn=turn)
+    if reserved.archived_at is not None:
+        # 继续一个已归档的聊天：先恢复历史消息再读取上下文
+        with timer.phase("rehydrate"):
+            await archive.rehydrate(chat_id)
+    role, llm_chat_history = await _turn_context(chat_id, reserved, user_order, message.content, db, background_tasks, timer)
+    return role, llm_chat_history, reserved.summary, user_order + 1
+
+def _response_cache_key(role, llm_chat_history, summary, user_message: str):
+    """角色开启了回复缓存且处于开场几轮时返回缓存键，否则返回 None。"""
+    if not role.response_cache_enabled or not llm_cache.is_cacheable(llm_chat_history, summary):
+        return None
+    return llm_cache.make_key(role.id, role.updated_at, llm_service.primary_model(), llm_service.DEFAULT_TEMPERATURE, llm_chat_history, user_message)
+
+async def _idempotent(key: Optional[str], user_id: uuid.UUID, request_hash: str, run: Callable[[], Awaitable[dict]]) -> Tuple[dict, bool]:
+    """带 Idempotency-Key 时同一个请求只执行一次 run()：重复的请求等待第一个请求完成并得到相同的结果。
+
+    返回 (JSON 结果, 是否为保存的结果)；run() 抛出异常时不保存，之后的重试会重新执行。
+    """
+    if key is None:
+        return await run(), False
+    try:
+        owner, stored = await idempotency.begin(user_id, key, request_hash)
+    except idempotency.KeyReused:
+        raise HTTPException(status_code=status.HTTP_422_UNPROCESSABLE_ENTITY, detail="Idempotency-Key was already used for a different request") from None
+    except idempotency.InProgress:
+        raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail="A request with this Idempotency-Key is still in progress") from None
+    if owner is None:
+        return stored, True
+    try:
+        result = await run()
+    except BaseException:
+        with CancelScope(shield=True):
+            await idempotency.abandon(user_id, key, owner)
+        raise
+    with CancelScope(shield=True):
+        await idempotency.complete(user_id, key, owner, result)
+    return result, False
+
+IdempotencyKeyHeader = Header(None, alias="Idempotency-Key", min_length=1, max_length=idempotency.MAX_KEY_LENGTH)
+
+@app.post("/chats/{chat_id}/message", response_model=schemas.MessageResponse, tags=["Chats"])
+async def send_message(
+    request: Request,
+    chat_id: uuid.UUID,
+    message: schemas.MessageCreate,
+    background_tasks: BackgroundTasks,
+    response: Response,
+    db: AsyncSession = Depends(get_async_db),
+    current_user: auth.Principal = Depends(auth.get_current_principal),
+    idempotency_key: Optional[str] = IdempotencyKeyHeader,
+):
+    """发送一条消息并返回 AI 回复。
+
+    带 Idempotency-Key 头时，重试或重复提交同一个键不会再生成一次回复：第一个请求仍在执行时等待它完成，
+    之后返回保存的结果 (响应头 Idempotent-Replayed: true)。同一聊天并发发送的消息按顺序逐轮处理。
+    """
+    result, replayed = await _idempotent(
+        idempotency_key, current_user.id, idempotency.fingerprint("message", chat_id, message.model_dump()),
+        lambda: _send_message(request, chat_id, message, background_tasks, db, current_user),
     )
-    # --- LLM 调用结束 ---
-
-    # 保存 AI 回复
-    db_ai_message = models.Message(
-        chat_id=chat_id,
-        sender_type="ai",
-        content=ai_response_content,
-        order_in_chat=current_message_count + 1
+    if replayed:
+        response.headers["Idempotent-Replayed"] = "true"
+    return result
+
+async def _send_message(request: Request, chat_id: uuid.UUID, message: schemas.MessageCreate, background_tasks: BackgroundTasks, db: AsyncSession, current_user: auth.Principal) -> dict:
+    timer = metrics.PhaseTimer(chat_turn_phase_seconds)
+    # 先按用户限流，再在网关分配到上游槽位后才保存用户消息，排队超时 (503) 不会留下没有回复的消息
+    llm_gateway.gateway.check_rate(current_user.id)
+    async with chat_turns.turns.hold(chat_id) as turn:
+        # 先等同一聊天的上一轮结束再排队获取上游槽位，等待期间不占用槽位
+        with timer.phase("wait_turn"):
+            acquired = await _wait_turn(chat_turns.turns.acquire(chat_id, current_user.id, turn))
+        if not acquired:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Chat not found or unauthorized")
+        async with llm_gateway.gateway.slot(current_user.id):
+            role, llm_chat_history, summary, ai_order = await _prepare_turn(chat_id, message, db, current_user, background_tasks, timer, turn)
+
+            # --- 调用 LLM 服务获取真实回复 ---
+            with timer.phase("llm"):
+                ai_response_content = await llm_service.get_qwen_response(
+                    system_prompt=role.system_prompt,
+                    chat_history=llm_chat_history, # 传递裁剪后的最近历史
+                    user_message=message.content,
+                    few_shot_examples=role.few_shot_examples,
+                    summary=summary,
+                    prompt_prefix=role.prompt_prefix,
+                    cache_key=_response_cache_key(role, llm_chat_history, summary, message.content),
+                    role_label=role.name
+                )
+        # --- LLM 调用结束 ---
+
+        # 保存 AI 回复，之后才释放租约，下一轮读到的历史包含这条回复
+        with timer.phase("save_reply"):
+            db_ai_message = await message_writer.save_message(message_writer.message_row(chat_id, "ai", ai_response_content, ai_order))
+
+    timer.observe(route=auth.route_label(request), role=role.name)
+    return db_ai_message
+
+async def _save_ai_reply(chat_id: uuid.UUID, content: str, order_in_chat: int) -> dict:
+    """保存流式生成的 AI 回复并返回序列化后的消息。
+
+    客户端断开时任务会被取消 (WebSocket 收尾时可能被取消两次)，保存在单独的任务中完成，已生成的内容不会丢失。
+    """
+    return await chat_turns.run_to_completion(message_writer.save_message(message_writer.message_row(chat_id, "ai", content, order_in_chat)))
+
+def _sse_event(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+@app.post("/chats/{chat_id}/message/stream", tags=["Chats"])
+async def send_message_stream(request: Request, chat_id: uuid.UUID, message: schemas.MessageCreate, background_tasks: BackgroundTasks, current_user: auth.Principal = Depends(auth.get_current_principal)):
+    """与 send_message 相同，但以 Server-Sent Events 的形式逐 token 推送 AI 回复。
+
+    事件类型：`token` (增量文本)、`done` (已保存的 AI 消息)、`error` (上游出错、排队超时或等待上一轮超时)。
+    流结束或客户端断开时，已生成的内容都会保存为一条 AI 消息；排队超时时用户消息不会被保存。
+    """
+    timer = metrics.PhaseTimer(chat_turn_phase_seconds)
+    route = auth.route_label(request)
+    llm_gateway.gateway.check_rate(current_user.id)
+    # 聊天不存在时在返回响应之前返回 404。租约在生成器内部获取，响应体没有开始发送时不会占着该聊天
+    async with read_session(current_user.id, chat_id) as db:
+        owned = await db.scalar(select(models.Chat.id).where(models.Chat.id == chat_id, models.Chat.user_id == current_user.id))
+    if owned is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Chat not found or unauthorized")
+
+    async def event_stream():
+        role = None
+        chunks = []
+        saved = None
+        try:
+            async with chat_turns.turns.hold(chat_id) as turn:
+                # 响应头已经发出，等待上一轮超时 (409) 以 error 事件返回
+                with timer.phase("wait_turn"):
+                    acquired = await _wait_turn(chat_turns.turns.acquire(chat_id, current_user.id, turn))
+                if not acquired:
+                    raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Chat not found or unauthorized")
+                try:
+                    # 分配到上游槽位后才保存用户消息，排队超时不会留下没有回复的用户消息
+                    async with llm_gateway.gateway.slot(current_user.id):
+                        async with AsyncSessionLocal() as db:
+                            role, llm_chat_history, summary, ai_order = await _prepare_turn(chat_id, message, db, current_user, background_tasks, timer, turn)
+                        with timer.phase("llm"):
+                            async for token in llm_service.stream_qwen_response(
+                                system_prompt=role.system_prompt,
+                                chat_history=llm_chat_history,
+                                user_message=message.content,
+                                few_shot_examples=role.few_shot_examples,
+                                summary=summary,
+                                prompt_prefix=role.prompt_prefix,
+                                cache_key=_response_cache_key(role, llm_chat_history, summary, message.content),
+                                role_label=role.name
+                            ):
+                                chunks.append(token)
+                                yield _sse_event("token", {"content": token})
+                finally:
+                    # 流结束、出错或客户端断开时保存已生成的内容，保存之后才释放租约
+                    if chunks:
+                        with timer.phase("save_reply"):
+                            saved = await _save_ai_reply(chat_id, "".join(chunks), ai_order)
+        except llm_gateway.QueueTimeout:
+            yield _sse_event("error", {"detail": "AI service is busy, please retry shortly"})
+        except HTTPException as e:
+            yield _sse_event("error", {"status": e.status_code, "detail": e.detail})
+        except Exception:
+            logger.exception("Error streaming Qwen API")
+            yield _sse_event("error", {"detail": "Sorry, I am unable to respond at the moment."})
+        finally:
+            if role is not None:
+                timer.observe(route=route, role=role.name)
+        if saved is not None:
+            yield _sse_event("done", saved)
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
     )
-    db.add(db_ai_message)
-    db.commit()
-    db.refresh(db_ai_message)
 
-    return db_ai_message
\ No newline at end of file
+# --- 异步回复任务 ---
+
+async def _load_reply_job(job_id: uuid.UUID, user_id: uuid.UUID) -> Optional[dict]:
+    """读取任务状态，已完成时附带 AI 回复；每次查询单独取连接，等待期间不占用连接。"""
+    async with autocommit_engine.connect() as conn:
+        result = await conn.execute(
+            select(
+                models.ReplyJob.id, models.ReplyJob.chat_id, models.ReplyJob.status, models.ReplyJob.order_in_chat,
+                models.ReplyJob.attempts, models.ReplyJob.error, models.ReplyJob.created_at, models.ReplyJob.updated_at,
+                models.Message.id.label("reply_id"), models.Message.content.label("reply_content"), models.Message.timestamp.label("reply_timestamp"),
+            )
+            .outerjoin(models.Message, and_(
+                models.Message.chat_id == models.ReplyJob.chat_id,
+                models.Message.order_in_chat == models.ReplyJob.order_in_chat,
+                models.ReplyJob.status == "done",
+            ))
+            .where(models.ReplyJob.id == job_id, models.ReplyJob.user_id == user_id)
+        )
+        row = result.first()
+    if row is None:
+        return None
+    job = {key: getattr(row, key) for key in ("id", "chat_id", "status", "order_in_chat", "attempts", "error", "created_at", "updated_at")}
+    if row.reply_id is not None:
+        job["reply"] = {
+            "id": row.reply_id, "chat_id": row.chat_id, "sender_type": "ai", "content": row.reply_content,
+            "timestamp": row.reply_timestamp, "order_in_chat": row.order_in_chat,
+        }
+    return job
+
+@app.post("/chats/{chat_id}/message/jobs", response_model=schemas.ReplyJobResponse, status_code=status.HTTP_202_ACCEPTED, tags=["Chats"])
+async def enqueue_message(
+    chat_id: uuid.UUID,
+    message: schemas.MessageCreate,
+    response: Response,
+    current_user: auth.Principal = Depends(auth.get_current_principal),
+    idempotency_key: Optional[str] = IdempotencyKeyHeader,
+):
+    """异步模式：保存用户消息并把 AI 回复的生成放入任务队列，立即返回 202 和任务。
+
+    用 GET /jobs/{job_id} 查询结果 (可带 wait 参数等待完成)；任务持久化在数据库中，服务重启后会继续执行。
+    带 Idempotency-Key 头重复提交时不会再入队，返回第一次创建的任务。
+    """
+    async def enqueue() -> dict:
+        llm_gateway.gateway.check_rate(current_user.id)
+        job_id = uuid.uuid4()
+        await _reserve_turn(chat_id, message.content, current_user, metrics.PhaseTimer(chat_turn_phase_seconds), job_id=job_id)
+        reply_jobs.pool.notify()
+        return schemas.ReplyJobResponse.model_validate(await _load_reply_job(job_id, current_user.id)).model_dump(mode="json")
+
+    job, replayed = await _idempotent(idempotency_key, current_user.id, idempotency.fingerprint("message/jobs", chat_id, message.model_dump()), enqueue)
+    if replayed:
+        # 保存的是入队时的状态，重复提交时返回任务当前的状态
+        response.headers["Idempotent-Replayed"] = "true"
+        job = await _load_reply_job(uuid.UUID(job["id"]), current_user.id) or job
+    response.headers["Location"] = f"/jobs/{job['id']}"
+    return job
+
+@app.get("/jobs/{job_id}", response_model=schemas.ReplyJobResponse, tags=["Chats"])
+async def get_reply_job(
+    job_id: uuid.UUID,
+    wait: float = Query(0, ge=0, le=30, description="任务未完成时最多等待的秒数 (长轮询)"),
+    current_user: auth.Principal = Depends(auth.get_current_principal),
+):
+    deadline = time.monotonic() + wait
+    while True:
+        job = await _load_reply_job(job_id, current_user.id)
+        if job is None:
+            raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Job not found or unauthorized")
+        remaining = deadline - time.monotonic()
+        if job["status"] in reply_jobs.TERMINAL_STATUSES or remaining <= 0:
+            return job
+        # 本进程执行的任务完成时立即返回；在其他进程执行的任务按轮询间隔重新查询
+        await reply_jobs.pool.wait_finished(job_id, min(remaining, reply_jobs.REPLY_JOB_POLL_INTERVAL))
+
+async def _run_reply_job(job):
+    """reply_jobs worker 的处理函数：按入队时保存的用户消息生成并保存 AI 回复。
+
+    与同步接口一样在该聊天的租约下读取历史、调用 LLM 并保存回复；聊天正被其他轮次占用时不等待，
+    任务放回队列稍后再领取。重复执行是安全的 (例如保存回复后、标记完成前进程重启)：回复已存在时直接结束。
+    """
+    timer = metrics.PhaseTimer(chat_turn_phase_seconds)
+    background_tasks = BackgroundTasks()
+    user_order = job.order_in_chat - 1
+    # 以任务 id 作为租约令牌，同一聊天新入队的消息不必等本任务结束 (见 chat_turns.enqueue_condition)
+    async with chat_turns.turns.hold(job.chat_id, token=job.id) as turn:
+        try:
+            acquired = await chat_turns.turns.acquire(job.chat_id, job.user_id, turn, timeout=0, after_jobs=False)
+        except chat_turns.TurnBusy:
+            raise reply_jobs.JobDeferred() from None
+        if not acquired:
+            raise reply_jobs.JobFailed("Chat not found")
+        # 只在准备上下文时持有数据库会话，调用 LLM 期间不占用连接
+        async with AsyncSessionLocal() as db:
+            chat = (await db.execute(
+                select(models.Chat.role_id, models.Chat.summary, models.Chat.summarized_until, models.Chat.archived_at)
+                .where(models.Chat.id == job.chat_id)
+            )).first()
+            if chat is None:
+                raise reply_jobs.JobFailed("Chat not found")
+            if chat.archived_at is not None:
+                with timer.phase("rehydrate"):
+                    await archive.rehydrate(job.chat_id)
+            result = await db.execute(
+                select(models.Message.order_in_chat, models.Message.content)
+                .where(models.Message.chat_id == job.chat_id, models.Message.order_in_chat.in_((user_order, job.order_in_chat)))
+            )
+            messages = {row.order_in_chat: row.content for row in result}
+            if job.order_in_chat in messages:
+                return
+            if user_order not in messages:
+                raise reply_jobs.JobFailed("User message not found")
+            user_message = messages[user_order]
+            try:
+                role, llm_chat_history = await _turn_context(job.chat_id, chat, user_order, user_message, db, background_tasks, timer)
+            except HTTPException as e:
+                raise reply_jobs.JobFailed(e.detail) from None
+
+        async with llm_gateway.gateway.slot(job.user_id):
+            with timer.phase("llm"):
+                content = await llm_service.get_qwen_response(
+                    system_prompt=role.system_prompt,
+                    chat_history=llm_chat_history,
+                    user_message=user_message,
+                    few_shot_examples=role.few_shot_examples,
+                    summary=chat.summary,
+                    prompt_prefix=role.prompt_prefix,
+                    cache_key=_response_cache_key(role, llm_chat_history, chat.summary, user_message),
+                    role_label=role.name
+                )
+        # 保存回复之后才释放租约，下一轮读到的历史包含这条回复
+        with timer.phase("save_reply"):
+            await message_writer.save_message(message_writer.message_row(job.chat_id, "ai", content, job.order_in_chat))
+    timer.observe(route="job", role=role.name)
+    try:
+        await background_tasks() # 聊天摘要等后续工作
+    except Exception:
+        logger.exception("Background work for reply job %s failed", job.id)
+
+# --- WebSocket 聊天通道 ---
+
+WS_AUTH_TIMEOUT = float(os.getenv("WS_AUTH_TIMEOUT", "10"))             # 未在 URL 中携带 token 时，等待 auth 帧的时间
+WS_MAX_CONCURRENT_TURNS = int(os.getenv("WS_MAX_CONCURRENT_TURNS", "4")) # 每个连接同时进行中的对话轮数上限
+WS_REPLAY_BATCH = 100
+WS_REPLAY_MAX_BATCHES = 10 # 单次 resume 最多补发的批数，超出时 has_more=true，客户端用最后的序号再次 resume
+
+# 连接断开后仍需完成的后台任务 (例如聊天摘要)，保持引用避免被垃圾回收
+_ws_background_jobs: Set[asyncio.Task] = set()
+
+async def _ws_error(channel: ws.WebSocketChannel, detail: str, status_code: int, chat_id: Optional[uuid.UUID] = None, ref=None, **extra):
+    try:
+        await channel.send({"type": "error", "chat_id": str(chat_id) if chat_id else None, "ref": ref, "status": status_code, "detail": detail, **extra})
+    except ws.ChannelClosed:
+        pass
+
+async def _ws_authenticate(websocket: WebSocket, token: Optional[str]):
+    """URL 中没有 token 时等待第一帧 {"type": "auth", "token": ...}；成功返回 (principal, token 过期时间)，失败关闭连接并返回 None。"""
+    if token is None:
+        try:
+            frame = json.loads(await asyncio.wait_for(websocket.receive_text(), timeout=WS_AUTH_TIMEOUT))
+            token = frame.get("token") if isinstance(frame, dict) and frame.get("type") == "auth" else None
+        except (asyncio.TimeoutError, ValueError, WebSocketDisconnect):
+            token = None
+    principal = None
+    if token:
+        try:
+            async with AsyncSessionLocal() as db:
+                principal = await auth.authenticate_token(token, db, "/ws")
+        except HTTPException:
+            principal = None
+    if principal is None:
+        ws.ws_disconnects_total.inc(reason="unauthorized")
+        await websocket.close(code=ws.CLOSE_UNAUTHORIZED, reason="unauthorized")
+        return None
+    return principal, auth.token_expires_at(token)
+
+async def _ws_resume(channel: ws.WebSocketChannel, principal: auth.Principal, chat_id: uuid.UUID, after: int):
+    """补发 order_in_chat > after 的消息，用于断线重连后恢复。"""
+    async with read_session(principal.id, chat_id) as db:
+        result = await db.execute(select(models.Chat.archived_at).where(models.Chat.id == chat_id, models.Chat.user_id == principal.id))
+        chat = result.first()
+    if chat is None:
+        await _ws_error(channel, "Chat not found or unauthorized", status.HTTP_404_NOT_FOUND, chat_id)
+        return
+    if chat.archived_at is not None:
+        await archive.rehydrate(chat_id) # 恢复后该聊天被标记为刚写入，下面的读取走主库
+    async with read_session(principal.id, chat_id) as db:
+        for _ in range(WS_REPLAY_MAX_BATCHES):
+            result = await db.execute(
+                select(models.Message)
+                .where(models.Message.chat_id == chat_id, models.Message.order_in_chat > after)
+                .order_by(models.Message.order_in_chat)
+                .limit(WS_REPLAY_BATCH + 1)
+            )
+            messages = result.scalars().all()
+            has_more = len(messages) > WS_REPLAY_BATCH
+            messages = messages[:WS_REPLAY_BATCH]
+            await channel.send({
+                "type": "history",
+                "chat_id": str(chat_id),
+                "messages": [schemas.MessageResponse.model_validate(m).model_dump(mode="json") for m in messages],
+                "has_more": has_more,
+            })
+            if not has_more:
+                return
+            after = messages[-1].order_in_chat
+
+async def _ws_turn(channel: ws.WebSocketChannel, principal: auth.Principal, chat_id: uuid.UUID, content, ref):
+    """一轮对话：与 SSE 接口相同的流程，token 以帧的形式推送到该连接。"""
+    timer = metrics.PhaseTimer(chat_turn_phase_seconds)
+    background_tasks = BackgroundTasks()
+    try:
+        message = schemas.MessageCreate(sender_type="user", content=content)
+        llm_gateway.gateway.check_rate(principal.id)
+        async with chat_turns.turns.hold(chat_id) as turn:
+            # 与 send_message 相同的顺序：先等同一聊天的上一轮结束，再排队获取上游槽位，分配到槽位后才保存用户消息
+            with timer.phase("wait_turn"):
+                acquired = await _wait_turn(chat_turns.turns.acquire(chat_id, principal.id, turn))
+            if not acquired:
+                raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Chat not found or unauthorized")
+            role = None
+            chunks = []
+            saved = None
+            try:
+                async with llm_gateway.gateway.slot(principal.id):
+                    async with AsyncSessionLocal() as db:
+                        role, llm_chat_history, summary, ai_order = await _prepare_turn(chat_id, message, db, principal, background_tasks, timer, turn)
+                    await channel.send({"type": "accepted", "chat_id": str(chat_id), "ref": ref, "order_in_chat": ai_order - 1})
+                    try:
+                        with timer.phase("llm"):
+                            async for token in llm_service.stream_qwen_response(
+                                system_prompt=role.system_prompt,
+                                chat_history=llm_chat_history,
+                                user_message=message.content,
+                                few_shot_examples=role.few_shot_examples,
+                                summary=summary,
+                                prompt_prefix=role.prompt_prefix,
+                                cache_key=_response_cache_key(role, llm_chat_history, summary, message.content),
+                                role_label=role.name
+                            ):
+                                chunks.append(token)
+                                # 发送队列满时在这里等待，客户端读取慢会减慢对上游流的读取
+                                await channel.send({"type": "token", "chat_id": str(chat_id), "ref": ref, "content": token})
+                    except (ws.ChannelClosed, asyncio.CancelledError):
+                        raise
+                    except Exception:
+                        logger.exception("Error streaming Qwen API over WebSocket")
+                        await _ws_error(channel, "Sorry, I am unable to respond at the moment.", status.HTTP_503_SERVICE_UNAVAILABLE, chat_id, ref)
+            finally:
+                # 断开或出错时也保存已生成的部分回复，重连后可通过 resume 取回；保存之后才释放租约
+                if chunks:
+                    with timer.phase("save_reply"):
+                        saved = await _save_ai_reply(chat_id, "".join(chunks), ai_order)
+                if role is not None:
+                    timer.observe(route="/ws", role=role.name)
+        if saved is not None:
+            await channel.send({"type": "done", "chat_id": str(chat_id), "ref": ref, "message": saved})
+    except ValidationError:
+        await _ws_error(channel, "Invalid message content", status.HTTP_422_UNPROCESSABLE_ENTITY, chat_id, ref)
+    except HTTPException as e:
+        await _ws_error(channel, e.detail, e.status_code, chat_id, ref)
+    except llm_gateway.RateLimited as e:
+        await _ws_error(channel, "Too many messages, please slow down", status.HTTP_429_TOO_MANY_REQUESTS, chat_id, ref, retry_after=max(1, round(e.retry_after)))
+    except llm_gateway.QueueTimeout:
+        await _ws_error(channel, "AI service is busy, please retry shortly", status.HTTP_503_SERVICE_UNAVAILABLE, chat_id, ref, retry_after=5)
+    except ws.ChannelClosed:
+        pass
+    finally:
+        if background_tasks.tasks:
+            job = asyncio.create_task(background_tasks())
+            _ws_background_jobs.add(job)
+            job.add_done_callback(_ws_background_jobs.discard)
+
+def _ws_chat_id(frame: dict) -> Optional[uuid.UUID]:
+    try:
+        return uuid.UUID(str(frame.get("chat_id")))
+    except ValueError:
+        return None
+
+async def _ws_receive_loop(websocket: WebSocket, channel: ws.WebSocketChannel, principal: auth.Principal, expires_at: Optional[float], turns: Set[asyncio.Task]):
+    while True:
+        text = await websocket.receive_text()
+        channel.touch()
+        try:
+            frame = json.loads(text)
+            frame_type = frame.get("type")
+        except (ValueError, AttributeError):
+            await _ws_error(channel, "Invalid frame", status.HTTP_400_BAD_REQUEST)
+            continue
+
+        if frame_type == "ping":
+            await channel.send({"type": "pong", "ts": frame.get("ts")})
+        elif frame_type == "pong":
+            pass
+        elif frame_type in ("message", "resume"):
+            if expires_at is not None and time.time() >= expires_at:
+                await _ws_error(channel, "Token expired, please reconnect", status.HTTP_401_UNAUTHORIZED)
+                await channel.close(ws.CLOSE_UNAUTHORIZED, "token_expired")
+                return
+            chat_id = _ws_chat_id(frame)
+            if chat_id is None:
+                await _ws_error(channel, "Invalid chat_id", status.HTTP_400_BAD_REQUEST, ref=frame.get("ref"))
+            elif frame_type == "resume":
+                after = frame.get("after", -1)
+                await _ws_resume(channel, principal, chat_id, after if isinstance(after, int) else -1)
+            elif len(turns) >= WS_MAX_CONCURRENT_TURNS:
+                await _ws_error(channel, "Too many replies in progress on this connection", status.HTTP_429_TOO_MANY_REQUESTS, chat_id, frame.get("ref"))
+            else:
+                task = asyncio.create_task(_ws_turn(channel, principal, chat_id, frame.get("content"), frame.get("ref")))
+                turns.add(task)
+                task.add_done_callback(turns.discard)
+        else:
+            await _ws_error(channel, f"Unknown frame type: {frame_type}", status.HTTP_400_BAD_REQUEST)
+
+@app.websocket("/ws")
+async def chat_websocket(websocket: WebSocket, token: Optional[str] = None):
+    """WebSocket 聊天通道：每个连接只认证一次，可以在同一连接上同时进行多个聊天。
+
+    认证：连接后的第一帧 {"type": "auth", "token": "..."}，或 URL 参数 ?token= (会出现在访问日志中，不推荐)。
+    客户端帧：
+      {"type": "message", "chat_id": ..., "content": ..., "ref": 可选的客户端标识}
+      {"type": "resume", "chat_id": ..., "after": 已收到的最后一条消息的 order_in_chat}
+      {"type": "ping"} / {"type": "pong"}
+    服务端帧：ready、accepted (用户消息已保存)、token、done (已保存的 AI 消息)、history、error、ping/pong。
+    服务端每 WS_HEARTBEAT_INTERVAL 秒发送 ping，WS_IDLE_TIMEOUT 秒内没有收到任何帧则断开。
+    """
+    await websocket.accept()
+    authenticated = await _ws_authenticate(websocket, token)
+    if authenticated is None:
+        return
+    principal, expires_at = authenticated
+
+    channel = ws.WebSocketChannel(websocket)
+    channel.start()
+    turns: Set[asyncio.Task] = set()
+    receiver = asyncio.create_task(_ws_receive_loop(websocket, channel, principal, expires_at, turns))
+    closed = asyncio.create_task(channel.wait_closed())
+    try:
+        await channel.send({"type": "ready", "user_id": str(principal.id), "heartbeat_interval": ws.WS_HEARTBEAT_INTERVAL})
+        await asyncio.wait({receiver, closed}, return_when=asyncio.FIRST_COMPLETED)
+    except ws.ChannelClosed:
+        pass
+    finally:
+        receiver.cancel()
+        closed.cancel()
+        # 取消进行中的回复，停止消耗上游 token；已生成的部分会在各自的 finally 中保存
+        for task in list(turns):
+            task.cancel()
+        await asyncio.gather(receiver, *turns, return_exceptions=True)
+        await channel.close()
+
+# --- 语音聊天 ---
+
+async def _voice_speak(channel: ws.WebSocketChannel, tts: voice.TextToSpeech, sentences: asyncio.Queue, clock: voice.StageClock):
+    """按顺序合成排队的句子并推送音频，与 LLM 流并行：播报第一句时后面的 token 仍在生成。None 表示没有更多句子。"""
+    index = 0
+    while True:
+        sentence = await sentences.get()
+        if sentence is None:
+            return
+        await channel.send({"type": "audio_start", "index": index, "text": sentence, "format": tts.format})
+        async for audio in tts.synthesize(sentence):
+            clock.mark("first_audio")
+            await channel.send_bytes(audio)
+        await channel.send({"type": "audio_end", "index": index})
+        index += 1
+
+async def _voice_turn(channel: ws.WebSocketChannel, principal: auth.Principal, chat_id: uuid.UUID, stt: voice.SpeechToText, clock: voice.StageClock):
+    """一轮语音对话：完成识别后与文字聊天相同地保存用户消息并调用 LLM，回复逐句合成为语音。"""
+    timer = metrics.PhaseTimer(chat_turn_phase_seconds)
+    background_tasks = BackgroundTasks()
+    try:
+        try:
+            with timer.phase("stt"):
+                text = (await stt.finish()).strip()
+        except Exception:
+            # 识别失败：这一句话作废，连接保持可用
+            logger.exception("Speech recognition failed")
+            await _ws_error(channel, "Speech recognition failed, please try again", status.HTTP_503_SERVICE_UNAVAILABLE, chat_id)
+            return
+        clock.mark("transcript")
+        await channel.send({"type": "transcript", "chat_id": str(chat_id), "text": text, "final": True})
+        if not text:
+            return
+        message = schemas.MessageCreate(sender_type="user", content=text)
+        llm_gateway.gateway.check_rate(principal.id)
+        async with chat_turns.turns.hold(chat_id) as turn:
+            # 与文字聊天相同的顺序：租约 -> 上游槽位 -> 保存用户消息，排队超时不会留下没有回复的用户消息
+            with timer.phase("wait_turn"):
+                acquired = await _wait_turn(chat_turns.turns.acquire(chat_id, principal.id, turn))
+            if not acquired:
+                raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Chat not found or unauthorized")
+            tts = voice.tts_engine()
+            sentences: asyncio.Queue = asyncio.Queue()
+            speaker = None
+            splitter = voice.SentenceSplitter()
+            role = None
+            chunks = []
+            saved = None
+            latency = {}
+            try:
+                async with llm_gateway.gateway.slot(principal.id):
+                    async with AsyncSessionLocal() as db:
+                        role, llm_chat_history, summary, ai_order = await _prepare_turn(chat_id, message, db, principal, background_tasks, timer, turn)
+                    await channel.send({"type": "accepted", "chat_id": str(chat_id), "order_in_chat": ai_order - 1})
+                    speaker = asyncio.create_task(_voice_speak(channel, tts, sentences, clock))
+                    with timer.phase("llm"):
+                        async for token in llm_service.stream_qwen_response(
+                            system_prompt=role.system_prompt,
+                            chat_history=llm_chat_history,
+                            user_message=message.content,
+                            few_shot_examples=role.few_shot_examples,
+                            summary=summary,
+                            prompt_prefix=role.prompt_prefix,
+                            cache_key=_response_cache_key(role, llm_chat_history, summary, message.content),
+                            role_label=role.name
+                        ):
+                            clock.mark("first_token")
+                            chunks.append(token)
+                            await channel.send({"type": "token", "chat_id": str(chat_id), "content": token})
+                            for sentence in splitter.feed(token):
+                                clock.mark("first_sentence")
+                                sentences.put_nowait(sentence)
+                for sentence in splitter.flush():
+                    clock.mark("first_sentence")
+                    sentences.put_nowait(sentence)
+                sentences.put_nowait(None)
+                # LLM 已经结束，剩下的时间是合成还没播报的句子
+                with timer.phase("tts"):
+                    await speaker
+            except (ws.ChannelClosed, asyncio.CancelledError, HTTPException, llm_gateway.QueueTimeout):
+                raise
+            except Exception:
+                logger.exception("Error in voice turn")
+                await _ws_error(channel, "Sorry, I am unable to respond at the moment.", status.HTTP_503_SERVICE_UNAVAILABLE, chat_id)
+            finally:
+                if speaker is not None:
+                    speaker.cancel()
+                # 被打断 (用户又开始说话) 或断开时也保存已生成的部分回复，保存之后才释放租约
+                if chunks:
+                    with timer.phase("save_reply"):
+                        saved = await _save_ai_reply(chat_id, "".join(chunks), ai_order)
+                if role is not None:
+                    latency = clock.observe()
+                    timer.observe(route="/ws/voice", role=role.name)
+        if saved is not None:
+            await channel.send({"type": "done", "chat_id": str(chat_id), "message": saved, "latency": latency})
+    except ValidationError:
+        await _ws_error(channel, "Invalid message content", status.HTTP_422_UNPROCESSABLE_ENTITY, chat_id)
+    except HTTPException as e:
+        await _ws_error(channel, e.detail, e.status_code, chat_id)
+    except llm_gateway.RateLimited as e:
+        await _ws_error(channel, "Too many messages, please slow down", status.HTTP_429_TOO_MANY_REQUESTS, chat_id, retry_after=max(1, round(e.retry_after)))
+    except llm_gateway.QueueTimeout:
+        await _ws_error(channel, "AI service is busy, please retry shortly", status.HTTP_503_SERVICE_UNAVAILABLE, chat_id, retry_after=5)
+    except ws.ChannelClosed:
+        pass
+    finally:
+        stt.close()
+        if background_tasks.tasks:
+            job = asyncio.create_task(background_tasks())
+            _ws_background_jobs.add(job)
+            job.add_done_callback(_ws_background_jobs.discard)
+
+def _voice_interrupt(turns: Set[asyncio.Task]):
+    """停止进行中的回复。被打断的轮次移出 turns，在后台保存已生成的部分并释放租约，不会在收尾时被再次取消。"""
+    for task in list(turns):
+        turns.discard(task)
+        task.cancel()
+        _ws_background_jobs.add(task)
+        task.add_done_callback(_ws_background_jobs.discard)
+
+async def _voice_receive_loop(websocket: WebSocket, channel: ws.WebSocketChannel, principal: auth.Principal, expires_at: Optional[float], chat_id: uuid.UUID, turns: Set[asyncio.Task]):
+    endpointer = voice.Endpointer()
+    stt = voice.new_stt()
+    try:
+        while True:
+            received = await websocket.receive()
+            if received["type"] == "websocket.disconnect":
+                return
+            channel.touch()
+            utterance_end = False
+            if received.get("bytes") is not None:
+                audio = received["bytes"]
+                event = endpointer.process(audio)
+                if event == "start" and turns:
+                    # 用户开始说话时停止上一轮的播报 (barge-in)
+                    _voice_interrupt(turns)
+                    await channel.send({"type": "interrupted", "chat_id": str(chat_id)})
+                # 开口之前和停顿中的静音不送去识别
+                if endpointer.in_speech:
+                    partial = await stt.feed(audio)
+                    if partial is not None:
+                        await channel.send({"type": "transcript", "chat_id": str(chat_id), "text": partial, "final": False})
+                if event == "pause":
+                    await stt.pause()
+                utterance_end = event == "end"
+            else:
+                try:
+                    frame = json.loads(received.get("text") or "")
+                    frame_type = frame.get("type")
+                except (ValueError, AttributeError):
+                    await _ws_error(channel, "Invalid frame", status.HTTP_400_BAD_REQUEST)
+                    continue
+                if frame_type == "ping":
+                    await channel.send({"type": "pong", "ts": frame.get("ts")})
+                elif frame_type == "pong":
+                    pass
+                elif frame_type == "end_of_utterance":
+                    # 按住说话的客户端松开按键时发送，不必等待静音检测
+                    utterance_end = True
+                elif frame_type == "interrupt":
+                    _voice_interrupt(turns)
+                else:
+                    await _ws_error(channel, f"Unknown frame type: {frame_type}", status.HTTP_400_BAD_REQUEST)
+            if not utterance_end:
+                continue
+            if endpointer.speaking:
+                if expires_at is not None and time.time() >= expires_at:
+                    await _ws_error(channel, "Token expired, please reconnect", status.HTTP_401_UNAUTHORIZED)
+                    await channel.close(ws.CLOSE_UNAUTHORIZED, "token_expired")
+                    return
+                clock = voice.StageClock()
+                _voice_interrupt(turns)
+                task = asyncio.create_task(_voice_turn(channel, principal, chat_id, stt, clock))
+                turns.add(task)
+                task.add_done_callback(turns.discard)
+                stt = voice.new_stt()
+            else:
+                stt.close()
+                stt = voice.new_stt()
+            endpointer.reset()
+    finally:
+        stt.close()
+
+@app.websocket("/ws/voice")
+async def voice_websocket(websocket: WebSocket, chat_id: uuid.UUID, token: Optional[str] = None):
+    """语音聊天通道：一个连接对应一个聊天，语音的识别文本和 AI 回复与文字消息一样保存在该聊天中。
+
+    认证方式与 /ws 相同。客户端上传二进制帧：PCM16 单声道小端音频，采样率见 ready 帧，建议每帧 20-100ms。
+    服务端根据静音判断一句话说完；也可以发送 {"type": "end_of_utterance"} 立即结束，{"type": "interrupt"} 停止当前回复。
+    服务端帧：ready、transcript (final=false 为部分识别结果)、accepted、token、audio_start / 二进制音频 / audio_end (每句一次)、
+    done (已保存的 AI 消息和各阶段延迟)、interrupted、error、ping/pong。用户在回复播报中开口说话时，当前回复会被打断。
+    """
+    await websocket.accept()
+    authenticated = await _ws_authenticate(websocket, token)
+    if authenticated is None:
+        return
+    principal, expires_at = authenticated
+    async with read_session(principal.id, chat_id) as db:
+        owned = await db.scalar(select(models.Chat.id).where(models.Chat.id == chat_id, models.Chat.user_id == principal.id))
+    if owned is None:
+        ws.ws_disconnects_total.inc(reason="not_found")
+        await websocket.close(code=ws.CLOSE_NOT_FOUND, reason="chat_not_found")
+        return
+
+    channel = ws.WebSocketChannel(websocket)
+    channel.start()
+    turns: Set[asyncio.Task] = set()
+    receiver = asyncio.create_task(_voice_receive_loop(websocket, channel, principal, expires_at, chat_id, turns))
+    closed = asyncio.create_task(channel.wait_closed())
+    try:
+        await channel.send({
+            "type": "ready",
+            "chat_id": str(chat_id),
+            "sample_rate": voice.VOICE_SAMPLE_RATE,
+            "audio_format": voice.tts_engine().format,
+            "heartbeat_interval": ws.WS_HEARTBEAT_INTERVAL,
+        })
+        await asyncio.wait({receiver, closed}, return_when=asyncio.FIRST_COMPLETED)
+    except ws.ChannelClosed:
+        pass
+    finally:
+        receiver.cancel()
+        closed.cancel()
+        for task in list(turns):
+            task.cancel()
+        await asyncio.gather(receiver, *turns, return_exceptions=True)
+        await channel.close()
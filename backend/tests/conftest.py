@@ -0,0 +1,64 @@
+# tests/conftest.py
+# 单元测试不调用上游 LLM：导入 app 模块之前填入占位配置，.env 中的密钥和数据库不会被使用。
+# 需要数据库的测试只在设置了 TEST_DATABASE_URL (一个可以随意写入的 PostgreSQL 库) 时运行，启动时会执行迁移。
+import os
+import uuid
+
+os.environ["SECRET_KEY"] = "test-secret"
+os.environ["QINIU_OPENAI_API_KEY"] = "sk-test"
+os.environ["QINIU_OPENAI_BASE_URL"] = "http://127.0.0.1:9/v1"
+os.environ["DATABASE_URL"] = os.getenv("TEST_DATABASE_URL", "postgresql://test@127.0.0.1:9/test")
+for name in ("ASYNC_DATABASE_URL", "DATABASE_REPLICA_URL"):
+    os.environ.pop(name, None)
+
+import pytest
+
+@pytest.fixture(scope="session")
+def anyio_backend():
+    # 被测代码直接使用 asyncio 的原语
+    return "asyncio"
+
+@pytest.fixture
+async def db_user():
+    """在测试库中创建一个用户并返回其 id；没有设置 TEST_DATABASE_URL 时跳过。"""
+    if not os.getenv("TEST_DATABASE_URL"):
+        pytest.skip("TEST_DATABASE_URL not set")
+    from sqlalchemy import delete, insert
+    from app import migrations, models
+    from app.database import async_engine, autocommit_engine
+
+    await migrations.migrate(seed_roles=False)
+    user_id = uuid.uuid4()
+    async with autocommit_engine.connect() as conn:
+        await conn.execute(insert(models.User).values(
+            id=user_id, username=f"test_{user_id.hex[:12]}", email=f"{user_id.hex[:12]}@example.com", hashed_password="x",
+        ))
+    yield user_id
+    async with autocommit_engine.connect() as conn:
+        await conn.execute(delete(models.IdempotencyKey).where(models.IdempotencyKey.user_id == user_id))
+        await conn.execute(delete(models.User).where(models.User.id == user_id))
+    # 连接池绑定在当前事件循环上
+    await async_engine.dispose()
+
+@pytest.fixture
+async def chat(db_user):
+    """在测试库中为 db_user 创建一个角色和聊天，返回聊天 id。"""
+    from sqlalchemy import delete, insert
+    from app import models
+    from app.database import autocommit_engine
+    from app.role_registry import role_registry
+
+    role_id, chat_id = uuid.uuid4(), uuid.uuid4()
+    async with autocommit_engine.connect() as conn:
+        await conn.execute(insert(models.Role).values(
+            id=role_id, name=f"test_{role_id.hex[:12]}", description="test", system_prompt="test", is_active=True,
+        ))
+        await conn.execute(insert(models.Chat).values(id=chat_id, user_id=db_user, role_id=role_id))
+    # 与创建角色的接口一样，让角色缓存重新加载
+    role_registry.invalidate()
+    yield chat_id
+    async with autocommit_engine.connect() as conn:
+        await conn.execute(delete(models.ReplyJob).where(models.ReplyJob.chat_id == chat_id))
+        await conn.execute(delete(models.Message).where(models.Message.chat_id == chat_id))
+        await conn.execute(delete(models.Chat).where(models.Chat.id == chat_id))
+        await conn.execute(delete(models.Role).where(models.Role.id == role_id))
@@ -0,0 +1,43 @@
+import time
+import uuid
+from app import auth
+from app.auth import Principal, PrincipalCache
+
+def _principal(name: str = "alice") -> Principal:
+    return Principal(id=uuid.uuid4(), username=name)
+
+def test_cached_principal_expires_with_the_token():
+    cache = PrincipalCache(maxsize=10, ttl=60)
+    principal = _principal()
+    cache.put("expired", principal, time.time() - 1)
+    cache.put("valid", principal, time.time() + 3600)
+    assert cache.get("expired") is None
+    assert cache.get("valid") == principal
+
+def test_invalidate_user_drops_all_of_the_users_tokens():
+    cache = PrincipalCache(maxsize=10, ttl=60)
+    alice, bob = _principal("alice"), _principal("bob")
+    exp = time.time() + 3600
+    cache.put("a1", alice, exp)
+    cache.put("a2", alice, exp)
+    cache.put("b1", bob, exp)
+    cache.invalidate_user(alice.id)
+    assert cache.get("a1") is None and cache.get("a2") is None
+    assert cache.get("b1") == bob
+
+def test_least_recently_used_token_is_evicted():
+    cache = PrincipalCache(maxsize=2, ttl=60)
+    exp = time.time() + 3600
+    principals = [_principal(str(i)) for i in range(3)]
+    cache.put("t0", principals[0], exp)
+    cache.put("t1", principals[1], exp)
+    cache.get("t0")
+    cache.put("t2", principals[2], exp)
+    assert cache.get("t1") is None
+    assert cache.get("t0") == principals[0]
+
+def test_module_level_invalidate_user_uses_the_shared_cache():
+    principal = _principal()
+    auth.principal_cache.put("shared", principal, time.time() + 3600)
+    auth.invalidate_user(principal.id)
+    assert auth.principal_cache.get("shared") is None
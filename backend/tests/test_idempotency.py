@@ -0,0 +1,89 @@
+import uuid
+import pytest
+from app import idempotency
+
+pytestmark = pytest.mark.anyio
+
+def test_fingerprint_depends_on_route_path_and_body():
+    chat_id = uuid.uuid4()
+    body = {"sender_type": "user", "content": "hi"}
+    assert idempotency.fingerprint("message", chat_id, body) == idempotency.fingerprint("message", chat_id, dict(reversed(body.items())))
+    assert idempotency.fingerprint("message", chat_id, body) != idempotency.fingerprint("message/jobs", chat_id, body)
+    assert idempotency.fingerprint("message", chat_id, body) != idempotency.fingerprint("message", uuid.uuid4(), body)
+    assert idempotency.fingerprint("message", chat_id, body) != idempotency.fingerprint("message", chat_id, {**body, "content": "hi!"})
+
+async def test_completed_request_is_replayed(db_user):
+    request_hash = idempotency.fingerprint("message", "chat", {"content": "hi"})
+    owner, stored = await idempotency.begin(db_user, "key-1", request_hash)
+    assert owner is not None and stored is None
+    await idempotency.complete(db_user, "key-1", owner, {"content": "reply"})
+
+    owner, stored = await idempotency.begin(db_user, "key-1", request_hash)
+    assert owner is None
+    assert stored == {"content": "reply"}
+
+async def test_key_reused_for_a_different_request(db_user):
+    owner, _ = await idempotency.begin(db_user, "key-2", idempotency.fingerprint("message", "chat", {"content": "hi"}))
+    await idempotency.complete(db_user, "key-2", owner, {"content": "reply"})
+    with pytest.raises(idempotency.KeyReused):
+        await idempotency.begin(db_user, "key-2", idempotency.fingerprint("message", "chat", {"content": "other"}))
+
+async def test_abandoned_request_runs_again(db_user):
+    request_hash = idempotency.fingerprint("message", "chat", {"content": "hi"})
+    first, _ = await idempotency.begin(db_user, "key-3", request_hash)
+    await idempotency.abandon(db_user, "key-3", first)
+    second, stored = await idempotency.begin(db_user, "key-3", request_hash)
+    assert second is not None and second != first
+    assert stored is None
+
+async def test_stale_owner_cannot_overwrite_the_result(db_user):
+    request_hash = idempotency.fingerprint("message", "chat", {"content": "hi"})
+    first, _ = await idempotency.begin(db_user, "key-4", request_hash)
+    await idempotency.abandon(db_user, "key-4", first)
+    second, _ = await idempotency.begin(db_user, "key-4", request_hash)
+    await idempotency.complete(db_user, "key-4", first, {"content": "stale"})
+    await idempotency.complete(db_user, "key-4", second, {"content": "reply"})
+    _, stored = await idempotency.begin(db_user, "key-4", request_hash)
+    assert stored == {"content": "reply"}
+
+# --- 流式接口的租约在响应体开始后才获取 ---
+
+async def _turn_token(chat_id: uuid.UUID):
+    from sqlalchemy import select
+    from app import models
+    from app.database import autocommit_engine
+
+    async with autocommit_engine.connect() as conn:
+        return await conn.scalar(select(models.Chat.turn_token).where(models.Chat.id == chat_id))
+
+async def _send_stream(chat_id: uuid.UUID, user_id: uuid.UUID):
+    import main
+    from fastapi import BackgroundTasks
+    from starlette.requests import Request
+    from app import auth, schemas
+
+    message = schemas.MessageCreate(sender_type="user", content="hi")
+    return await main.send_message_stream(Request({"type": "http"}), chat_id, message, BackgroundTasks(), auth.Principal(id=user_id, username="test"))
+
+async def test_stream_holds_the_lease_only_while_the_body_runs(db_user, chat, monkeypatch):
+    from app import llm_service
+    held = []
+
+    async def stream(**kwargs):
+        held.append(await _turn_token(chat))
+        yield "你好"
+
+    monkeypatch.setattr(llm_service, "stream_qwen_response", stream)
+    response = await _send_stream(chat, db_user)
+    # 响应体还没有开始：没有占着租约，即使客户端在此时断开也不会锁住聊天
+    assert await _turn_token(chat) is None
+    events = [event async for event in response.body_iterator]
+    assert events[-1].startswith("event: done")
+    assert held[0] is not None
+    assert await _turn_token(chat) is None
+
+async def test_stream_to_unknown_chat_is_rejected_before_the_body(db_user):
+    from fastapi import HTTPException
+    with pytest.raises(HTTPException) as exc_info:
+        await _send_stream(uuid.uuid4(), db_user)
+    assert exc_info.value.status_code == 404
@@ -0,0 +1,103 @@
+import asyncio
+import pytest
+from app import llm_cache
+from app.llm_cache import ResponseCache
+
+pytestmark = pytest.mark.anyio
+
+async def test_concurrent_misses_share_one_upstream_call():
+    cache = ResponseCache(maxsize=10, ttl=60)
+    calls = 0
+    release = asyncio.Event()
+
+    async def compute():
+        nonlocal calls
+        calls += 1
+        await release.wait()
+        return "reply"
+
+    tasks = [asyncio.create_task(cache.get_or_compute("k", compute)) for _ in range(5)]
+    await asyncio.sleep(0)
+    release.set()
+    assert await asyncio.gather(*tasks) == ["reply"] * 5
+    assert calls == 1
+    # 之后的请求直接命中缓存
+    assert await cache.get_or_compute("k", compute) == "reply"
+    assert calls == 1
+
+async def test_errors_are_shared_but_not_cached():
+    cache = ResponseCache(maxsize=10, ttl=60)
+    calls = 0
+    release = asyncio.Event()
+
+    async def failing():
+        nonlocal calls
+        calls += 1
+        await release.wait()
+        raise RuntimeError("upstream down")
+
+    tasks = [asyncio.create_task(cache.get_or_compute("k", failing)) for _ in range(3)]
+    await asyncio.sleep(0)
+    release.set()
+    results = await asyncio.gather(*tasks, return_exceptions=True)
+    assert all(isinstance(r, RuntimeError) for r in results)
+    assert calls == 1
+
+    async def compute():
+        return "reply"
+
+    assert await cache.get_or_compute("k", compute) == "reply"
+
+async def test_follower_takes_over_when_the_leader_is_cancelled():
+    cache = ResponseCache(maxsize=10, ttl=60)
+    leader_started = asyncio.Event()
+    calls = []
+
+    async def hang():
+        calls.append("leader")
+        leader_started.set()
+        await asyncio.Event().wait()
+
+    async def compute():
+        calls.append("follower")
+        return "reply"
+
+    leader = asyncio.create_task(cache.get_or_compute("k", hang))
+    await leader_started.wait()
+    follower = asyncio.create_task(cache.get_or_compute("k", compute))
+    await asyncio.sleep(0)
+    leader.cancel()
+    assert await follower == "reply"
+    assert calls == ["leader", "follower"]
+    with pytest.raises(asyncio.CancelledError):
+        await leader
+
+async def test_streaming_flight_finishes_for_waiters():
+    cache = ResponseCache(maxsize=10, ttl=60)
+    assert await cache.join("k") is None
+    flight = cache.lead("k")
+    waiter = asyncio.create_task(cache.join("k"))
+    await asyncio.sleep(0)
+    flight.finish("streamed reply")
+    assert await waiter == "streamed reply"
+    assert cache.get("k") == "streamed reply"
+
+async def test_entries_expire_after_ttl(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(llm_cache.time, "monotonic", lambda: now[0])
+    cache = ResponseCache(maxsize=10, ttl=60)
+    cache.put("k", "reply")
+    now[0] += 59
+    assert cache.get("k") == "reply"
+    now[0] += 1
+    assert cache.get("k") is None
+
+def test_least_recently_used_entry_is_evicted():
+    cache = ResponseCache(maxsize=2, ttl=60)
+    cache.put("a", "1")
+    cache.put("b", "2")
+    cache.get("a")
+    cache.put("c", "3")
+    assert cache.get("b") is None
+    assert cache.get("a") == "1"
+    assert cache.get("c") == "3"
@@ -0,0 +1,194 @@
+import asyncio
+import json
+import time
+from dataclasses import dataclass
+from typing import Dict, List, Optional
+import httpx
+import pytest
+from openai import AsyncOpenAI
+from app import llm_service
+from app.llm_service import LLMBackend, LLMUnavailable
+
+pytestmark = pytest.mark.anyio
+
+PRIMARY = LLMBackend(model="primary", base_url="http://primary.test/v1")
+FALLBACK = LLMBackend(model="fallback", base_url="http://fallback.test/v1")
+MESSAGES = [{"role": "user", "content": "hi"}]
+
+@dataclass
+class Reply:
+    text: str
+    delay: float = 0.0
+    status: int = 200
+
+def Fail(status: int, delay: float = 0.0) -> Reply:
+    return Reply("", delay, status)
+
+class FakeUpstream:
+    """OpenAI 兼容接口的桩：按模型依次返回预设的响应 (最后一个重复使用)，记录每次请求和被取消的请求。"""
+
+    def __init__(self):
+        self.script: Dict[str, List[Reply]] = {}
+        self.calls: List[tuple] = []
+        self.cancelled: List[str] = []
+
+    def on(self, model: str, *replies: Reply):
+        self.script[model] = list(replies)
+
+    def count(self, model: str) -> int:
+        return sum(1 for called, _ in self.calls if called == model)
+
+    async def handle(self, request: httpx.Request) -> httpx.Response:
+        body = json.loads(request.content)
+        model = body["model"]
+        self.calls.append((model, time.monotonic()))
+        replies = self.script[model]
+        reply = replies.pop(0) if len(replies) > 1 else replies[0]
+        try:
+            await asyncio.sleep(reply.delay)
+        except asyncio.CancelledError:
+            self.cancelled.append(model)
+            raise
+        if reply.status != 200:
+            return httpx.Response(reply.status, json={"error": {"message": f"status {reply.status}"}})
+        if body.get("stream"):
+            return httpx.Response(200, headers={"content-type": "text/event-stream"}, content=_sse(model, reply.text))
+        return httpx.Response(200, json={
+            "id": "cmpl", "object": "chat.completion", "created": 0, "model": model,
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": reply.text}, "finish_reason": "stop"}],
+            "usage": {"prompt_tokens": 1, "completion_tokens": 1, "total_tokens": 2},
+        })
+
+def _sse(model: str, text: str) -> bytes:
+    events = []
+    for word in text.split(" "):
+        chunk = {
+            "id": "cmpl", "object": "chat.completion.chunk", "created": 0, "model": model,
+            "choices": [{"index": 0, "delta": {"content": word + " "}, "finish_reason": None}],
+        }
+        events.append(f"data: {json.dumps(chunk)}\n\n")
+    events.append("data: [DONE]\n\n")
+    return "".join(events).encode()
+
+@pytest.fixture
+def upstream(monkeypatch):
+    fake = FakeUpstream()
+    http_client = httpx.AsyncClient(transport=httpx.MockTransport(fake.handle))
+    clients = {
+        backend.base_url: AsyncOpenAI(api_key="sk-test", base_url=backend.base_url, http_client=http_client, max_retries=0)
+        for backend in (PRIMARY, FALLBACK)
+    }
+    monkeypatch.setattr(llm_service, "_clients", clients)
+    monkeypatch.setattr(llm_service, "LLM_BACKENDS", [PRIMARY, FALLBACK])
+    monkeypatch.setattr(llm_service, "LLM_MAX_RETRIES", 2)
+    monkeypatch.setattr(llm_service, "LLM_RETRY_BASE_DELAY", 0.0)
+    monkeypatch.setattr(llm_service, "LLM_ATTEMPT_TIMEOUT", 5.0)
+    monkeypatch.setattr(llm_service, "LLM_HEDGE_ENABLED", False)
+    monkeypatch.setattr(llm_service, "_latencies", {})
+    return fake
+
+async def _complete(model: Optional[str] = None) -> str:
+    return await llm_service._complete(MESSAGES, model, 0.7, 50, "test")
+
+@pytest.mark.parametrize("status", [429, 500, 503])
+async def test_retryable_errors_are_retried_then_fall_back(upstream, status):
+    upstream.on("primary", Fail(status))
+    upstream.on("fallback", Reply("from fallback"))
+    assert await _complete() == "from fallback"
+    assert upstream.count("primary") == llm_service.LLM_MAX_RETRIES + 1
+    assert upstream.count("fallback") == 1
+
+async def test_transient_error_recovers_on_the_same_backend(upstream):
+    upstream.on("primary", Fail(502), Reply("recovered"))
+    upstream.on("fallback", Reply("from fallback"))
+    assert await _complete() == "recovered"
+    assert upstream.count("primary") == 2
+    assert upstream.count("fallback") == 0
+
+@pytest.mark.parametrize("status", [400, 401, 404, 422])
+async def test_rejected_requests_neither_retry_nor_fall_back(upstream, status):
+    upstream.on("primary", Fail(status))
+    upstream.on("fallback", Reply("from fallback"))
+    with pytest.raises(LLMUnavailable):
+        await _complete()
+    assert [model for model, _ in upstream.calls] == ["primary"]
+
+async def test_stuck_attempt_hits_its_deadline_and_is_retried(upstream, monkeypatch):
+    monkeypatch.setattr(llm_service, "LLM_ATTEMPT_TIMEOUT", 0.05)
+    upstream.on("primary", Reply("too late", delay=1), Reply("in time"))
+    assert await _complete() == "in time"
+    assert upstream.count("primary") == 2
+    await asyncio.sleep(0)
+    assert upstream.cancelled == ["primary"]
+
+async def test_empty_completion_falls_back_without_retrying(upstream):
+    upstream.on("primary", Reply(""))
+    upstream.on("fallback", Reply("from fallback"))
+    assert await _complete() == "from fallback"
+    assert upstream.count("primary") == 1
+
+async def test_all_backends_failing_raises_llm_unavailable(upstream):
+    upstream.on("primary", Fail(500))
+    upstream.on("fallback", Fail(500))
+    with pytest.raises(LLMUnavailable):
+        await _complete()
+    assert len(upstream.calls) == 2 * (llm_service.LLM_MAX_RETRIES + 1)
+
+async def test_explicit_model_replaces_the_head_of_the_chain(upstream):
+    upstream.on("custom", Fail(500))
+    upstream.on("fallback", Reply("from fallback"))
+    assert await _complete(model="custom") == "from fallback"
+    assert upstream.count("custom") == llm_service.LLM_MAX_RETRIES + 1
+    assert upstream.count("primary") == 0
+
+def _enable_hedging(monkeypatch, p95: float):
+    monkeypatch.setattr(llm_service, "LLM_HEDGE_ENABLED", True)
+    monkeypatch.setattr(llm_service, "LLM_HEDGE_MIN_DELAY", 0.01)
+    monkeypatch.setattr(llm_service, "LLM_HEDGE_MIN_SAMPLES", 20)
+    window = llm_service._latency_window(PRIMARY)
+    for _ in range(20):
+        window.record(p95)
+
+async def test_hedge_fires_after_the_p95_delay_and_cancels_the_loser(upstream, monkeypatch):
+    _enable_hedging(monkeypatch, p95=0.1)
+    upstream.on("primary", Reply("slow", delay=5), Reply("hedged"))
+    assert await _complete() == "hedged"
+    (_, first), (_, second) = upstream.calls
+    assert second - first >= 0.09
+    # 取消在 _hedged_completion 的 finally 中发出，等落败的请求处理完取消
+    for _ in range(100):
+        if upstream.cancelled:
+            break
+        await asyncio.sleep(0.001)
+    assert upstream.cancelled == ["primary"]
+
+async def test_no_hedge_when_the_first_answer_is_fast(upstream, monkeypatch):
+    _enable_hedging(monkeypatch, p95=0.5)
+    upstream.on("primary", Reply("fast"))
+    assert await _complete() == "fast"
+    assert upstream.count("primary") == 1
+
+async def test_hedge_falls_back_to_the_first_answer_when_the_second_fails(upstream, monkeypatch):
+    _enable_hedging(monkeypatch, p95=0.05)
+    upstream.on("primary", Reply("first", delay=0.2), Fail(400))
+    assert await _complete() == "first"
+    assert upstream.count("primary") == 2
+
+async def _stream() -> str:
+    parts = []
+    async for part in llm_service.stream_qwen_response(system_prompt="sys", chat_history=[], user_message="hi", role_label="test"):
+        parts.append(part)
+    return "".join(parts)
+
+async def test_stream_falls_back_before_the_first_chunk(upstream):
+    upstream.on("primary", Fail(503))
+    upstream.on("fallback", Reply("streamed from fallback"))
+    assert await _stream() == "streamed from fallback "
+    assert upstream.count("primary") == llm_service.LLM_MAX_RETRIES + 1
+
+async def test_rejected_stream_does_not_fall_back(upstream):
+    upstream.on("primary", Fail(400))
+    upstream.on("fallback", Reply("streamed from fallback"))
+    with pytest.raises(LLMUnavailable):
+        await _stream()
+    assert upstream.count("fallback") == 0
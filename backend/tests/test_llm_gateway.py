@@ -0,0 +1,76 @@
+import asyncio
+import pytest
+from app import llm_gateway
+from app.llm_gateway import LLMGateway, QueueTimeout, RateLimited
+
+pytestmark = pytest.mark.anyio
+
+async def _queue(gateway: LLMGateway, key: str, name: str, order: list):
+    async with gateway.slot(key):
+        order.append(name)
+
+async def test_slots_are_handed_out_round_robin_per_user():
+    gateway = LLMGateway(max_concurrency=1, max_queue_time=5, rate_per_minute=0)
+    await gateway.acquire("holder")
+    order = []
+    tasks = []
+    for key, name in [("a", "a1"), ("a", "a2"), ("a", "a3"), ("b", "b1"), ("c", "c1")]:
+        tasks.append(asyncio.create_task(_queue(gateway, key, name, order)))
+        await asyncio.sleep(0) # 按顺序进入队列
+    assert gateway.queue_depth == 5
+
+    gateway.release()
+    await asyncio.gather(*tasks)
+    # a 先入队，但每个用户每轮只分到一个槽位
+    assert order == ["a1", "b1", "c1", "a2", "a3"]
+    assert gateway.in_flight == 0
+    assert gateway.queue_depth == 0
+
+async def test_enters_directly_while_below_the_limit():
+    gateway = LLMGateway(max_concurrency=2, max_queue_time=5, rate_per_minute=0)
+    await gateway.acquire("a")
+    await gateway.acquire("a")
+    assert gateway.in_flight == 2
+    assert gateway.queue_depth == 0
+
+async def test_queue_timeout_leaves_no_waiter_behind():
+    gateway = LLMGateway(max_concurrency=1, max_queue_time=0.05, rate_per_minute=0)
+    before = llm_gateway.llm_gateway_queue_timeouts_total.value()
+    await gateway.acquire("holder")
+    with pytest.raises(QueueTimeout):
+        await gateway.acquire("a")
+    assert gateway.queue_depth == 0
+    assert llm_gateway.llm_gateway_queue_timeouts_total.value() == before + 1
+
+    gateway.release()
+    assert gateway.in_flight == 0
+    await gateway.acquire("a")
+    assert gateway.in_flight == 1
+
+async def test_cancelled_waiter_is_removed_from_the_queue():
+    gateway = LLMGateway(max_concurrency=1, max_queue_time=5, rate_per_minute=0)
+    await gateway.acquire("holder")
+    waiter = asyncio.create_task(gateway.acquire("a"))
+    await asyncio.sleep(0)
+    assert gateway.queue_depth == 1
+    waiter.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await waiter
+    assert gateway.queue_depth == 0
+    gateway.release()
+    assert gateway.in_flight == 0
+
+def test_rate_limit_allows_a_burst_then_rejects():
+    gateway = LLMGateway(max_concurrency=1, max_queue_time=5, rate_per_minute=6, burst=2)
+    gateway.check_rate("a")
+    gateway.check_rate("a")
+    with pytest.raises(RateLimited) as info:
+        gateway.check_rate("a")
+    assert 0 < info.value.retry_after <= 10
+    # 限流按用户计算
+    gateway.check_rate("b")
+
+def test_rate_limit_disabled():
+    gateway = LLMGateway(max_concurrency=1, max_queue_time=5, rate_per_minute=0, burst=1)
+    for _ in range(10):
+        gateway.check_rate("a")
@@ -0,0 +1,42 @@
+from app import llm_service
+from app.llm_service import build_context, estimate_tokens, summary_batch_size
+
+def _history(count: int):
+    # 每条 6 个汉字，加上每条消息的开销共 10 个 token
+    return [{"sender_type": "user" if i % 2 else "ai", "content": "字" * 6, "order_in_chat": i} for i in range(count)]
+
+def test_estimate_tokens():
+    assert estimate_tokens("") == 0
+    assert estimate_tokens("你好") == 2
+    assert estimate_tokens("abcd") == 1
+    assert estimate_tokens("abcde") == 2
+    assert llm_service.MESSAGE_TOKEN_OVERHEAD == 4
+
+def test_keeps_the_newest_messages_that_fit_the_budget():
+    history = _history(5)
+    # 55 - 前缀 20 - 当前消息 5 = 30，放得下 3 条
+    kept = build_context(history, "问", prefix_tokens=20, token_budget=55)
+    assert [m["order_in_chat"] for m in kept] == [2, 3, 4]
+
+def test_summary_is_charged_against_the_budget():
+    kept = build_context(_history(5), "问", prefix_tokens=20, summary="摘要", token_budget=55)
+    assert [m["order_in_chat"] for m in kept] == [3, 4]
+
+def test_stops_at_the_first_message_that_does_not_fit():
+    history = _history(3)
+    history[1]["content"] = "长" * 100
+    kept = build_context(history, "问", prefix_tokens=0, token_budget=30)
+    assert [m["order_in_chat"] for m in kept] == [2]
+
+def test_nothing_is_kept_when_the_prefix_exhausts_the_budget():
+    assert build_context(_history(3), "问", prefix_tokens=100, token_budget=55) == []
+
+def test_summary_batch_size_is_capped_by_tokens():
+    history = _history(5)
+    assert summary_batch_size(history, token_budget=25) == 2
+    assert summary_batch_size(history, token_budget=1000) == 5
+    assert summary_batch_size([], token_budget=25) == 0
+
+def test_summary_batch_always_makes_progress():
+    # 单条超出预算的消息也要单独成批，由 summarize_history 截断
+    assert summary_batch_size(_history(3), token_budget=5) == 1
@@ -0,0 +1,37 @@
+import asyncio
+import uuid
+import pytest
+from app import chat_turns
+
+pytestmark = pytest.mark.anyio
+
+async def _enqueue(chat_id: uuid.UUID, user_id: uuid.UUID) -> uuid.UUID:
+    import main
+    from app import auth, metrics
+
+    job_id = uuid.uuid4()
+    await main._reserve_turn(chat_id, "hi", auth.Principal(id=user_id, username="test"), metrics.PhaseTimer(main.chat_turn_phase_seconds), job_id=job_id)
+    return job_id
+
+async def test_sync_turn_waits_for_queued_jobs(db_user, chat):
+    job_id = await _enqueue(chat, db_user)
+    with pytest.raises(chat_turns.TurnBusy):
+        await chat_turns.turns.acquire(chat, db_user, uuid.uuid4(), timeout=0)
+    # 回复任务自己获取租约时不等待 (包括它自己在内的) 排队中的任务
+    async with chat_turns.turns.hold(chat, token=job_id) as turn:
+        assert await chat_turns.turns.acquire(chat, db_user, turn, timeout=0, after_jobs=False)
+
+async def test_enqueue_waits_for_a_sync_turn(db_user, chat):
+    async with chat_turns.turns.hold(chat) as turn:
+        assert await chat_turns.turns.acquire(chat, db_user, turn, timeout=0)
+        enqueue = asyncio.create_task(_enqueue(chat, db_user))
+        await asyncio.sleep(0.3)
+        assert not enqueue.done()
+    # 释放租约时唤醒本进程的等待者
+    await asyncio.wait_for(enqueue, timeout=5)
+
+async def test_enqueue_does_not_wait_for_a_running_job(db_user, chat):
+    job_id = await _enqueue(chat, db_user)
+    async with chat_turns.turns.hold(chat, token=job_id) as turn:
+        assert await chat_turns.turns.acquire(chat, db_user, turn, timeout=0, after_jobs=False)
+        await asyncio.wait_for(_enqueue(chat, db_user), timeout=1)
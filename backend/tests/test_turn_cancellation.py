@@ -0,0 +1,127 @@
+import asyncio
+import uuid
+import pytest
+from app import chat_turns
+
+pytestmark = pytest.mark.anyio
+
+async def test_run_to_completion_survives_repeated_cancels():
+    started = asyncio.Event()
+    finish = asyncio.Event()
+    finished = []
+
+    async def save():
+        started.set()
+        await finish.wait()
+        finished.append(True)
+        return "saved"
+
+    task = asyncio.ensure_future(chat_turns.run_to_completion(save()))
+    await started.wait()
+    for _ in range(2):
+        task.cancel()
+        await asyncio.sleep(0.01)
+    assert not task.done()
+    finish.set()
+    with pytest.raises(asyncio.CancelledError):
+        await task
+    assert finished == [True]
+
+async def test_run_to_completion_returns_result_and_errors():
+    async def ok():
+        return 1
+
+    async def fail():
+        raise ValueError("boom")
+
+    assert await chat_turns.run_to_completion(ok()) == 1
+    with pytest.raises(ValueError):
+        await chat_turns.run_to_completion(fail())
+
+# --- WebSocket / 语音轮次被取消：已生成的部分回复保存下来，租约被释放 ---
+
+class FakeChannel:
+    def __init__(self):
+        self.frames = []
+        self.token_sent = asyncio.Event()
+
+    async def send(self, frame: dict):
+        self.frames.append(frame)
+        if frame["type"] == "token":
+            self.token_sent.set()
+
+    async def send_bytes(self, data: bytes):
+        pass
+
+class FakeSTT:
+    def __init__(self, text: str):
+        self.text = text
+
+    async def finish(self) -> str:
+        return self.text
+
+    def close(self):
+        pass
+
+@pytest.fixture
+def hanging_llm(monkeypatch):
+    """LLM 流吐出两个 token 后挂起；保存 AI 回复时先通知测试并稍作停顿，让测试在保存过程中再取消一次。"""
+    import main
+    from app import llm_service, message_writer
+
+    save_started = asyncio.Event()
+    save_message = message_writer.save_message
+
+    async def stream(**kwargs):
+        yield "你好"
+        yield "，世界"
+        await asyncio.Event().wait()
+
+    async def slow_save(row):
+        save_started.set()
+        await asyncio.sleep(0.05)
+        return await save_message(row)
+
+    monkeypatch.setattr(llm_service, "stream_qwen_response", stream)
+    monkeypatch.setattr(message_writer, "save_message", slow_save)
+    return main, save_started
+
+async def _cancel_twice(task: asyncio.Task, channel: FakeChannel, save_started: asyncio.Event):
+    await asyncio.wait_for(channel.token_sent.wait(), timeout=5)
+    await asyncio.sleep(0.01)
+    task.cancel()
+    await asyncio.wait_for(save_started.wait(), timeout=5)
+    task.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await task
+
+async def _assert_partial_reply_saved(chat_id: uuid.UUID):
+    from sqlalchemy import select
+    from app import models
+    from app.database import autocommit_engine
+
+    async with autocommit_engine.connect() as conn:
+        rows = (await conn.execute(
+            select(models.Message.sender_type, models.Message.content).where(models.Message.chat_id == chat_id).order_by(models.Message.order_in_chat)
+        )).all()
+        turn_token = await conn.scalar(select(models.Chat.turn_token).where(models.Chat.id == chat_id))
+    assert [tuple(row) for row in rows] == [("user", "你好吗"), ("ai", "你好，世界")]
+    assert turn_token is None
+
+async def test_ws_turn_saves_partial_reply_when_cancelled_twice(db_user, chat, hanging_llm):
+    from app import auth
+    main, save_started = hanging_llm
+    channel = FakeChannel()
+    principal = auth.Principal(id=db_user, username="test")
+    task = asyncio.create_task(main._ws_turn(channel, principal, chat, "你好吗", "ref-1"))
+    await _cancel_twice(task, channel, save_started)
+    await _assert_partial_reply_saved(chat)
+
+async def test_voice_turn_saves_partial_reply_when_cancelled_twice(db_user, chat, hanging_llm):
+    from app import auth, voice
+    main, save_started = hanging_llm
+    channel = FakeChannel()
+    principal = auth.Principal(id=db_user, username="test")
+    task = asyncio.create_task(main._voice_turn(channel, principal, chat, FakeSTT("你好吗"), voice.StageClock()))
+    await _cancel_twice(task, channel, save_started)
+    await _assert_partial_reply_saved(chat)
@@ -0,0 +1,76 @@
+from array import array
+import sys
+from app.voice import Endpointer, SentenceSplitter
+
+def test_splits_on_sentence_ends_as_tokens_arrive():
+    splitter = SentenceSplitter(max_chars=60)
+    assert splitter.feed("你好") == []
+    assert splitter.feed("！今天天气") == ["你好！"]
+    assert splitter.feed("不错。Let's go") == ["今天天气不错。"]
+    assert splitter.feed(". Bye") == ["Let's go."]
+    assert splitter.flush() == ["Bye"]
+    assert splitter.flush() == []
+
+def test_keeps_closing_quotes_and_decimal_points():
+    splitter = SentenceSplitter(max_chars=60)
+    assert splitter.feed("他说：“走吧。”然后") == ["他说：“走吧。”"]
+    assert splitter.feed("pi is 3.14 or so") == []
+    assert splitter.flush() == ["然后pi is 3.14 or so"]
+
+def test_long_text_is_cut_at_the_last_soft_break():
+    splitter = SentenceSplitter(max_chars=10)
+    assert splitter.feed("一二三四，五六七八九十") == ["一二三四，"]
+    # 没有可以切开的标点时整段切开
+    assert splitter.feed("甲乙丙丁戊") == ["五六七八九十甲乙丙丁戊"]
+
+def test_punctuation_only_fragments_are_dropped():
+    splitter = SentenceSplitter(max_chars=60)
+    assert splitter.feed("好的。") == ["好的。"]
+    assert splitter.feed("\n\n") == []
+    assert splitter.feed("……") == []
+    assert splitter.flush() == []
+
+def _pcm(amplitude: int, ms: int, sample_rate: int = 1000) -> bytes:
+    samples = array("h", [amplitude] * (sample_rate * ms // 1000))
+    if sys.byteorder == "big":
+        samples.byteswap()
+    return samples.tobytes()
+
+def _endpointer(**kwargs) -> Endpointer:
+    options = dict(sample_rate=1000, threshold=500, pause_ms=200, end_silence_ms=500, max_seconds=30)
+    options.update(kwargs)
+    return Endpointer(**options)
+
+def test_detects_start_pause_and_end_of_utterance():
+    ep = _endpointer()
+    assert ep.process(_pcm(0, 100)) is None
+    assert ep.process(_pcm(2000, 100)) == "start"
+    assert ep.in_speech
+    assert ep.process(_pcm(2000, 100)) is None
+    events = [ep.process(_pcm(0, 100)) for _ in range(5)]
+    assert events == [None, "pause", None, None, "end"]
+    assert not ep.in_speech
+
+def test_speech_after_a_pause_resumes_the_utterance():
+    ep = _endpointer()
+    ep.process(_pcm(2000, 100))
+    assert [ep.process(_pcm(0, 100)) for _ in range(2)] == [None, "pause"]
+    assert ep.process(_pcm(2000, 100)) is None
+    assert ep.in_speech
+    # 静音重新计时
+    assert [ep.process(_pcm(0, 100)) for _ in range(5)] == [None, "pause", None, None, "end"]
+
+def test_max_utterance_length_ends_the_utterance():
+    ep = _endpointer(max_seconds=0.3)
+    assert ep.process(_pcm(2000, 100)) == "start"
+    assert ep.process(_pcm(2000, 100)) is None
+    assert ep.process(_pcm(2000, 100)) == "end"
+
+def test_chunks_split_inside_a_sample_are_carried_over():
+    ep = _endpointer()
+    data = _pcm(2000, 100)
+    assert ep.process(data[:51]) == "start"
+    ep.process(data[51:])
+    assert abs(ep.duration - 0.1) < 1e-9
+    ep.reset()
+    assert not ep.speaking and ep.duration == 0